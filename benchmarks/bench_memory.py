@@ -0,0 +1,164 @@
+"""Memory benchmark for the flashcard data model.
+
+Generates a multi-course deck (LaTeX and Typst courses, see corpus.py), loads it through the same pipeline as the
+flashcard session into a FlashcardDoubleLinkedList and reports, for growing deck sizes, the memory retained per card
+(tracemalloc, includes the text buffers cards share) and the size of the model objects per card (Flashcard, Section,
+TrackedText and Node instances, excludes the shared buffers). Both should stay flat as the deck grows.
+
+Usage:
+    python benchmarks/bench_memory.py                           # decks of 1000, 2500 and 5000 cards
+    python benchmarks/bench_memory.py --cards 5000 --save main  # store results as benchmarks/baselines/memory-main.json
+    python benchmarks/bench_memory.py --compare main            # compare with a stored baseline, exit 1 on regression
+"""
+from pathlib import Path
+import argparse
+import gc
+import json
+import platform
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from mathnotelib._enums import FileType
+from mathnotelib.models import FlashcardDoubleLinkedList, TrackedText
+from mathnotelib.services import CleanStage, DataGenerator, ProcessingPipeline
+from bench_pipeline import BASELINES_DIR, builder_stage, git_commit
+from corpus import CorpusSpec, generate_macros, write_corpus
+
+
+# One spec per course, lectures are cycled through in order until the deck is full
+COURSES: dict[str, CorpusSpec] = {
+        "analysis": CorpusSpec(FileType.LaTeX, files=100, file_size=20_000, seed=1),
+        "algebra": CorpusSpec(FileType.LaTeX, files=100, file_size=20_000, section_density=0.8, seed=2),
+        "topology": CorpusSpec(FileType.Typst, files=100, file_size=20_000, seed=3),
+        "probability": CorpusSpec(FileType.Typst, files=100, file_size=20_000, section_density=0.8, seed=4),
+        }
+
+
+def write_courses(directory: Path) -> tuple[list[Path], dict[FileType, dict]]:
+    """ Writes every course to directory, returns lecture paths interleaved across courses and the macros of each filetype """
+    macros: dict[FileType, dict] = {FileType.LaTeX: {}, FileType.Typst: {}}
+    courses = []
+    for name, spec in COURSES.items():
+        courses.append(write_corpus(spec, directory / name))
+        macros[spec.filetype].update(generate_macros(spec))
+    paths = [path for lectures in zip(*courses) for path in lectures]
+    return paths, macros
+
+
+def load_deck(paths: list[Path], macros: dict[FileType, dict], cards: int) -> FlashcardDoubleLinkedList:
+    """ Deck of the first cards flashcards, built the way FlashcardSession builds it """
+    pipeline = ProcessingPipeline(DataGenerator(paths))
+    pipeline.add_stage(CleanStage(macros))
+    pipeline.add_stage(builder_stage())
+    deck = FlashcardDoubleLinkedList()
+    count = 0
+    for flashcards in pipeline:
+        for card in flashcards:
+            deck.prepend(card)
+            count += 1
+            if count == cards:
+                return deck
+    raise ValueError(f"Corpus only has {count} flashcards, {cards} requested")
+
+
+def object_size(obj: object) -> int:
+    """ Size of obj and of its instance dictionary, if it has one """
+    size = sys.getsizeof(obj)
+    if (attributes := getattr(obj, "__dict__", None)) is not None:
+        size += sys.getsizeof(attributes)
+    return size
+
+
+def model_size(deck: FlashcardDoubleLinkedList) -> int:
+    """ Bytes taken by the model objects of deck, buffers shared between texts are not included """
+    total = 0
+    for node in deck:
+        total += object_size(node) + object_size(node.data)
+        for section in (node.data.main_section, node.data.proof_section):
+            if section is None:
+                continue
+            total += object_size(section)
+            total += sum(object_size(text) for text in (section.content, section.title) if isinstance(text, TrackedText))
+    return total
+
+
+def measure(paths: list[Path], macros: dict[FileType, dict], cards: int) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    deck = load_deck(paths, macros, cards)
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+            "cards": cards,
+            "retained_per_card": retained / cards,
+            "model_per_card": model_size(deck) / cards,
+            "peak": peak,
+            }
+
+
+def run(sizes: list[int]) -> dict:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths, macros = write_courses(Path(tmpdir))
+        results = [measure(paths, macros, cards) for cards in sizes]
+    return {
+            "meta": {"commit": git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+                     "courses": {name: spec.to_dict() for name, spec in COURSES.items()}},
+            "decks": results
+            }
+
+
+def format_results(results: dict) -> str:
+    lines = [f"{'cards':>7} {'retained (B/card)':>18} {'model (B/card)':>15} {'peak (MB)':>10}"]
+    for deck in results["decks"]:
+        lines.append(f"{deck['cards']:>7} {deck['retained_per_card']:>18.0f} {deck['model_per_card']:>15.0f} {deck['peak'] / 1e6:>10.2f}")
+    return "\n".join(lines)
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> tuple[str, bool]:
+    """ Returns (comparison table, True if bytes per card of any deck exceed threshold * baseline) """
+    lines = [f"{'cards':>7} {'metric':<18} {'baseline':>10} {'current':>10} {'ratio':>7}"]
+    regressed = False
+    base_decks = {deck["cards"]: deck for deck in baseline["decks"]}
+    if baseline["meta"].get("courses") != results["meta"]["courses"]:
+        return "courses changed, not compared", False
+    for deck in results["decks"]:
+        if (base_deck := base_decks.get(deck["cards"])) is None:
+            continue
+        for metric in ("retained_per_card", "model_per_card"):
+            ratio = deck[metric] / base_deck[metric] if base_deck[metric] else float("inf")
+            flag = ""
+            if ratio > threshold:
+                regressed = True
+                flag = "  REGRESSION"
+            lines.append(f"{deck['cards']:>7} {metric:<18} {base_deck[metric]:>10.0f} {deck[metric]:>10.0f} {ratio:>7.2f}{flag}")
+    return "\n".join(lines), regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure memory used per flashcard")
+    parser.add_argument("--cards", type=int, action="append", help="Deck size, may be repeated. Default 1000, 2500 and 5000")
+    parser.add_argument("--save", metavar="NAME", help="Store results as baseline memory-NAME")
+    parser.add_argument("--compare", metavar="NAME", help="Compare results with baseline memory-NAME")
+    parser.add_argument("--threshold", type=float, default=1.1, help="Ratio to baseline reported as a regression. Default 1.1")
+    args = parser.parse_args()
+
+    results = run(sorted(args.cards or [1000, 2500, 5000]))
+    print(format_results(results))
+    if args.save:
+        BASELINES_DIR.mkdir(exist_ok=True)
+        (BASELINES_DIR / f"memory-{args.save}.json").write_text(json.dumps(results, indent=2), encoding='utf-8')
+    if args.compare:
+        baseline = json.loads((BASELINES_DIR / f"memory-{args.compare}.json").read_text(encoding='utf-8'))
+        table, regressed = compare(results, baseline, args.threshold)
+        print()
+        print(table)
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""Benchmarks for the flashcard parsing pipeline.
+
+Each scenario generates a synthetic corpus (see corpus.py), then times reading, every pipeline stage, the fused
+CleanBuildStage, TrackedText operations and the end-to-end ProcessingPipeline. Results can be stored as a named
+baseline and later runs compared against it.
+
+Usage:
+    python benchmarks/bench_pipeline.py                         # run and print results
+    python benchmarks/bench_pipeline.py --save main             # store results as benchmarks/baselines/main.json
+    python benchmarks/bench_pipeline.py --compare main          # compare with a stored baseline, exit 1 on regression
+    python benchmarks/bench_pipeline.py --scenario latex-small --repeat 10
+"""
+from pathlib import Path
+from typing import Callable
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from mathnotelib._enums import FileType
+from mathnotelib.config import CONFIG
+from mathnotelib.models import Flashcard, TrackedText
+from mathnotelib.services import CleanBuildStage, CleanStage, DataGenerator, FlashcardBuilderStage, ProcessingPipeline
+from corpus import CorpusSpec, PROOF_PARENTS, generate_macros, write_corpus
+
+
+BASELINES_DIR = Path(__file__).resolve().parent / "baselines"
+
+SCENARIOS: dict[str, CorpusSpec] = {
+        "latex-small": CorpusSpec(FileType.LaTeX, files=40, file_size=10_000),
+        "latex-large": CorpusSpec(FileType.LaTeX, files=4, file_size=500_000),
+        "latex-dense": CorpusSpec(FileType.LaTeX, files=20, file_size=20_000, section_density=0.95),
+        "latex-nested": CorpusSpec(FileType.LaTeX, files=20, file_size=20_000, nesting_depth=8),
+        "latex-macros": CorpusSpec(FileType.LaTeX, files=20, file_size=20_000, macro_count=500),
+        "latex-notation": CorpusSpec(FileType.LaTeX, files=20, file_size=20_000, notation=0.8),
+        "typst-small": CorpusSpec(FileType.Typst, files=40, file_size=10_000),
+        "typst-large": CorpusSpec(FileType.Typst, files=4, file_size=500_000),
+        }
+
+
+def timed(func: Callable[[], object], repeat: int) -> dict[str, float]:
+    """ Runs func repeat times, returns min and median wall time in seconds """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times)}
+
+
+def builder_stage() -> FlashcardBuilderStage:
+    stage = FlashcardBuilderStage(list(CONFIG.section_names))
+    stage.add_subsection_finder("PROOF", PROOF_PARENTS)
+    return stage
+
+
+def tracked_text_ops(texts: list[TrackedText]) -> None:
+    for text in texts:
+        length = len(text)
+        for start in range(0, length, 97):
+            view = text[start:start + 200]
+            view.find("\\")
+            view.startswith("#")
+        for piece in text.split("\n"):
+            piece.strip()
+
+
+def run_scenario(spec: CorpusSpec, repeat: int) -> dict:
+    macros = {spec.filetype: generate_macros(spec)}
+    macros.setdefault(FileType.LaTeX, {})
+    macros.setdefault(FileType.Typst, {})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = write_corpus(spec, Path(tmpdir))
+        texts = [TrackedText(path.read_text(encoding='utf-8'), source=path) for path in paths]
+        clean_stage = CleanStage(macros)
+        build_stage = builder_stage()
+        cleaned = [clean_stage.process(text) for text in texts]
+        cards = sum(len(build_stage.process(text)) for text in cleaned)
+
+        def pipeline() -> list[list[Flashcard]]:
+            processing_pipeline = ProcessingPipeline(DataGenerator(paths))
+            processing_pipeline.add_stage(CleanStage(macros))
+            processing_pipeline.add_stage(builder_stage())
+            return list(processing_pipeline)
+
+        fused_stage = CleanBuildStage(CleanStage(macros), builder_stage())
+
+        results = {
+                "read": timed(lambda: list(DataGenerator(paths)), repeat),
+                "clean": timed(lambda: [clean_stage.process(text) for text in texts], repeat),
+                "build": timed(lambda: [build_stage.process(text) for text in cleaned], repeat),
+                "clean_build": timed(lambda: [fused_stage.process(text) for text in texts], repeat),
+                "tracked_text": timed(lambda: tracked_text_ops(texts), repeat),
+                "pipeline": timed(pipeline, repeat),
+                }
+        size = sum(path.stat().st_size for path in paths)
+    return {"spec": spec.to_dict(), "bytes": size, "cards": cards, "timings": results}
+
+
+def git_commit() -> str | None:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=Path(__file__).resolve().parent, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def run(scenarios: list[str], repeat: int) -> dict:
+    results = {}
+    for name in scenarios:
+        print(f"Running {name}...", file=sys.stderr)
+        results[name] = run_scenario(SCENARIOS[name], repeat)
+    return {
+            "meta": {"commit": git_commit(), "python": platform.python_version(), "platform": platform.platform(), "repeat": repeat},
+            "scenarios": results
+            }
+
+
+def format_results(results: dict) -> str:
+    lines = [f"{'scenario':<14} {'benchmark':<13} {'min (ms)':>10} {'median (ms)':>12} {'MB/s':>8}"]
+    for name, scenario in results["scenarios"].items():
+        for bench, timing in scenario["timings"].items():
+            throughput = scenario["bytes"] / timing["min"] / 1e6 if timing["min"] else float("inf")
+            lines.append(f"{name:<14} {bench:<13} {timing['min'] * 1e3:>10.2f} {timing['median'] * 1e3:>12.2f} {throughput:>8.2f}")
+    return "\n".join(lines)
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> tuple[str, bool]:
+    """ Returns (comparison table, True if any benchmark is slower than threshold * baseline) """
+    lines = [f"{'scenario':<14} {'benchmark':<13} {'baseline (ms)':>13} {'current (ms)':>13} {'ratio':>7}"]
+    regressed = False
+    for name, scenario in results["scenarios"].items():
+        base_scenario = baseline["scenarios"].get(name)
+        if base_scenario is None:
+            continue
+        if base_scenario["spec"] != scenario["spec"]:
+            lines.append(f"{name:<14} spec changed, not compared")
+            continue
+        for bench, timing in scenario["timings"].items():
+            base_timing = base_scenario["timings"].get(bench)
+            if base_timing is None:
+                continue
+            ratio = timing["min"] / base_timing["min"] if base_timing["min"] else float("inf")
+            flag = ""
+            if ratio > threshold:
+                regressed = True
+                flag = "  REGRESSION"
+            lines.append(f"{name:<14} {bench:<13} {base_timing['min'] * 1e3:>13.2f} {timing['min'] * 1e3:>13.2f} {ratio:>7.2f}{flag}")
+    return "\n".join(lines), regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the flashcard parsing pipeline")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS), help="Scenario to run, may be repeated. Default all")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", metavar="NAME", help="Store results as baseline NAME")
+    parser.add_argument("--compare", metavar="NAME", help="Compare results with baseline NAME")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Ratio to baseline reported as a regression. Default 1.2")
+    parser.add_argument("--json", type=Path, help="Also write results to this file")
+    args = parser.parse_args()
+
+    results = run(args.scenario or list(SCENARIOS), args.repeat)
+    print(format_results(results))
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2), encoding='utf-8')
+    if args.save:
+        BASELINES_DIR.mkdir(exist_ok=True)
+        (BASELINES_DIR / f"{args.save}.json").write_text(json.dumps(results, indent=2), encoding='utf-8')
+    if args.compare:
+        baseline = json.loads((BASELINES_DIR / f"{args.compare}.json").read_text(encoding='utf-8'))
+        table, regressed = compare(results, baseline, args.threshold)
+        print()
+        print(table)
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Synthetic LaTeX/Typst lecture generator used by the benchmarks.
+
+Usage:
+    python benchmarks/corpus.py OUTPUT_DIR [--filetype tex|typ] [--files N] [--file-size BYTES] ...
+"""
+from dataclasses import dataclass, asdict
+from pathlib import Path
+import argparse
+import json
+import random
+import string
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from mathnotelib._enums import FileType
+from mathnotelib.config import CONFIG
+from mathnotelib.models import langauage_char_registry
+
+
+WORDS = ["let", "be", "a", "compact", "set", "then", "every", "sequence", "has", "convergent", "subsequence",
+         "suppose", "continuous", "function", "bounded", "integral", "measure", "space", "open", "cover"]
+MATH = {
+        FileType.LaTeX: ["$x + y$", r"$\alpha_n \to 0$", r"$f(x) = [0, 1)$", r"$\int_0^1 f \, dx$", r"$50\%$"],
+        FileType.Typst: ["$x + y$", "$alpha_n -> 0$", "$f(x) = (0, 1)$", "$integral_0^1 f dif x$", "50%"],
+        }
+TEMPLATES = {
+        FileType.LaTeX: [r"\left| #1 \right|", r"\mathbb{#1}", r"\lim_{ #1 \to \infty}", r"\left\{ #1 \right\}"],
+        FileType.Typst: ["$lr(| #1 |)$", "$bb(#1)$", "$lim_(#1 -> oo)$", "*#1*"],
+        }
+# Short macro arguments, repeated throughout notation heavy lectures
+SYMBOLS = {
+        FileType.LaTeX: ["x", "n", "f_n", "A", r"\epsilon", "x_n - x"],
+        FileType.Typst: ["x", "n", "f_n", "A", "epsilon", "x_n - x"],
+        }
+# Sections that may be followed by a proof, see FlashcardBuilderStage.add_subsection_finder
+PROOF_PARENTS = ["THEOREM", "PROPOSITION", "LEMMA", "COROLLARY"]
+
+
+@dataclass
+class CorpusSpec:
+    """Parameters of a synthetic corpus
+
+    Attributes:
+        filetype: LaTeX or Typst
+        files: number of lecture files
+        file_size: approximate size of each file in bytes
+        section_density: probability that a paragraph is a section (definition, theorem, ...) rather than prose
+        nesting_depth: maximum depth of groups and macro calls nested inside a section
+        macro_count: number of user defined macros
+        notation: probability that a macro is applied to a short symbol (e.g., '\norm{x}') rather than nested text
+        seed: random seed, the same spec always generates the same corpus
+    """
+    filetype: FileType = FileType.LaTeX
+    files: int = 20
+    file_size: int = 20_000
+    section_density: float = 0.5
+    nesting_depth: int = 3
+    macro_count: int = 20
+    notation: float = 0.0
+    seed: int = 0
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data["filetype"] = self.filetype.value
+        return data
+
+
+def macro_names(count: int, rng: random.Random) -> list[str]:
+    """ Distinct alphabetic macro names, some share prefixes to exercise the macro matcher """
+    names: list[str] = []
+    seen = set()
+    while len(names) < count:
+        base = "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 6)))
+        for name in (base, base + "x") if rng.random() < 0.3 else (base,):
+            if name not in seen and len(names) < count:
+                seen.add(name)
+                names.append(name)
+    return names
+
+
+def generate_macros(spec: CorpusSpec) -> dict[str, dict]:
+    """ Macros in the format returned by Config.macros for spec.filetype """
+    rng = random.Random(spec.seed)
+    templates = TEMPLATES[spec.filetype]
+    return {name: {"num_args": "1", "command": rng.choice(templates)} for name in macro_names(spec.macro_count, rng)}
+
+
+class LectureGenerator:
+    """Generates lecture files for a CorpusSpec"""
+    def __init__(self, spec: CorpusSpec):
+        self.spec = spec
+        self.char_map = langauage_char_registry[spec.filetype]
+        self.macros = list(generate_macros(spec))
+        commands = {name: d[spec.filetype.value] for name, d in CONFIG.section_names.items()}
+        self.proof_command = commands.get("PROOF")
+        self.section_commands = [(name, command) for name, command in commands.items() if name != "PROOF"]
+
+    def body(self, rng: random.Random, depth: int = 0) -> str:
+        char_map = self.char_map
+        parts = []
+        for _ in range(rng.randint(2, 8)):
+            choice = rng.random()
+            if choice < 0.45:
+                parts.append(" ".join(rng.choices(WORDS, k=rng.randint(3, 10))))
+            elif choice < 0.6:
+                parts.append(rng.choice(MATH[self.spec.filetype]))
+            elif choice < 0.75 and depth < self.spec.nesting_depth and self.macros:
+                macro = rng.choice(self.macros)
+                if self.spec.notation and rng.random() < self.spec.notation:
+                    arg = rng.choice(SYMBOLS[self.spec.filetype])
+                else:
+                    arg = self.body(rng, depth + 1)
+                parts.append(f"{char_map.cmd_prefix}{macro}{char_map.arg_open_delim}{arg}{char_map.arg_close_delim}")
+            elif choice < 0.85 and depth < self.spec.nesting_depth:
+                parts.append(f"{char_map.opt_arg_open_delim}{self.body(rng, depth + 1)}{char_map.opt_arg_close_delim}")
+            elif choice < 0.92:
+                parts.append(f"{char_map.comment} {' '.join(rng.choices(WORDS, k=4))} {char_map.arg_open_delim}\n")
+            else:
+                parts.append("\n")
+        return " ".join(parts)
+
+    def section(self, rng: random.Random, command: str, title: str | None) -> str:
+        char_map = self.char_map
+        content = f"{char_map.opt_arg_open_delim}\n{self.body(rng)}\n{char_map.opt_arg_close_delim}"
+        if self.spec.filetype == FileType.Typst:
+            head = "" if title is None else f'(title: "{title}")'
+        else:
+            head = f"{char_map.arg_open_delim}{title or ''}{char_map.arg_close_delim}"
+        return f"{char_map.cmd_prefix}{command}{head}{content}"
+
+    def paragraph(self, rng: random.Random, index: int) -> str:
+        if rng.random() >= self.spec.section_density:
+            return self.body(rng)
+        name, command = rng.choice(self.section_commands)
+        paragraph = self.section(rng, command, f"{name.title()} {index}")
+        if name in PROOF_PARENTS and self.proof_command and rng.random() < 0.6:
+            paragraph += "\n" + self.section(rng, self.proof_command, None)
+        return paragraph
+
+    def lecture(self, rng: random.Random) -> str:
+        paragraphs: list[str] = []
+        size = 0
+        while size < self.spec.file_size:
+            paragraph = self.paragraph(rng, len(paragraphs))
+            paragraphs.append(paragraph)
+            size += len(paragraph.encode('utf-8')) + 2
+        return "\n\n".join(paragraphs) + "\n"
+
+
+def write_corpus(spec: CorpusSpec, directory: Path) -> list[Path]:
+    """ Writes spec.files lectures to directory, returns their paths """
+    directory.mkdir(parents=True, exist_ok=True)
+    generator = LectureGenerator(spec)
+    paths = []
+    for number in range(1, spec.files + 1):
+        rng = random.Random(f"{spec.seed}:{number}")
+        path = directory / f"lec_{number:02d}{spec.filetype.extension}"
+        path.write_text(generator.lecture(rng), encoding='utf-8')
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic lecture corpus")
+    parser.add_argument("output", type=Path)
+    parser.add_argument("--filetype", choices=["tex", "typ"], default="tex")
+    parser.add_argument("--files", type=int, default=CorpusSpec.files)
+    parser.add_argument("--file-size", type=int, default=CorpusSpec.file_size)
+    parser.add_argument("--section-density", type=float, default=CorpusSpec.section_density)
+    parser.add_argument("--nesting-depth", type=int, default=CorpusSpec.nesting_depth)
+    parser.add_argument("--macro-count", type=int, default=CorpusSpec.macro_count)
+    parser.add_argument("--notation", type=float, default=CorpusSpec.notation)
+    parser.add_argument("--seed", type=int, default=CorpusSpec.seed)
+    args = parser.parse_args()
+
+    spec = CorpusSpec(FileType.LaTeX if args.filetype == "tex" else FileType.Typst, args.files, args.file_size,
+                      args.section_density, args.nesting_depth, args.macro_count, args.notation, args.seed)
+    paths = write_corpus(spec, args.output)
+    (args.output / "macros.json").write_text(json.dumps(generate_macros(spec), indent=2), encoding='utf-8')
+    print(f"Wrote {len(paths)} files to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -43,6 +43,12 @@ class OutputFormat(Enum):
                 OutputFormat.SVG: ".svg"
                 }[self]
 
+class ExtractionBackend(Enum):
+    """How flashcards are extracted from lectures"""
+    Staged = "staged" # CleanStage then FlashcardBuilderStage
+    Fused = "fused" # CleanBuildStage, macros only expanded inside sections
+    TypstQuery = "typst-query" # TypstQueryStage for Typst lectures, CleanStage then FlashcardBuilderStage otherwise
+
 class LatexmkReturnCode(IntEnum):
     SUCCESS = 0
     BAD_ARGS = 10
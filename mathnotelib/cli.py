@@ -5,7 +5,8 @@ import logging
 import logging.config
 from pathlib import Path
 
-from .cmd import CourseCommand, FlashcardCommand, NoteCommand, NoteViewer
+from .cmd import CourseCommand, FlashcardCommand, FlashcardIndexCommand, NoteCommand, NoteViewer
+from ._enums import ExtractionBackend
 from .config import CONFIG
 
 """
@@ -139,12 +140,30 @@ flashcard_parser_arguments = [
         ("-f", "--file", {"nargs": 1, "help": "Load flashcards from file path. Must be full path, or flag must be set with '-d'/'--dir'"}),
         ("-d", "--dir", {"nargs": 1, "help": "set current working directory"})
         ]
+flashcard_index_parser_arguments = [
+        ("-c", "--course", {"action": "append", "help": "Only index this course, may be repeated. Defaults to all courses"}),
+        ("-s", "--section", {"action": "append", "help": "Only index this section (e.g. 'theorem'), may be repeated. Defaults to all sections"}),
+        ("-W", "--week", {"action": "append", "type": int, "help": "Only index lectures of this week, may be repeated. Defaults to all weeks"}),
+        ("-w", "--workers", {"type": int, "default": None, "help": "Number of worker processes. Defaults to the number of cpus"}),
+        ("-o", "--output", {"default": None, "help": "Write json lines to this file instead of stdout"}),
+        ("--includes", {"action": "store_true", "help": "Read each course from its main file, following \\input/#include"}),
+        ("--no-cache", {"action": "store_true", "help": "Do not read or fill the extraction cache"}),
+        ("--dedup", {"action": "store_true", "help": "Merge flashcards with the same content, each record lists the duplicates"}),
+        ("--backend", {"choices": [backend.value for backend in ExtractionBackend], "default": ExtractionBackend.Staged.value,
+                       "help": "Extraction stages: 'staged' (clean, then find sections), 'fused' (expand macros inside sections only) or 'typst-query' (typst query for Typst lectures, see README). Defaults to 'staged'"}),
+        ("--chunk-size", {"type": int, "metavar": "BYTES", "help": "Read lectures larger than BYTES in chunks of roughly BYTES, split between sections"}),
+        ]
+flashcard_subparsers = flashcard_parser.add_subparsers(title="Flashcard subcommands", dest="flashcard_command")
+flashcard_index_parser = flashcard_subparsers.add_parser("index", help="Extract flashcards of every course without the gui, one json object per line")
 
 
 global_parser.add_argument("--update-config", action="store_true", help="Update macro and preamble files. If any macro or preamble files have been modified --this command must be run before changes take effect")
 for arg in flashcard_parser_arguments:
     flashcard_parser.add_argument(*arg[:-1], **arg[-1])
 
+for arg in flashcard_index_parser_arguments:
+    flashcard_index_parser.add_argument(*arg[:-1], **arg[-1])
+
 for arg in course_parser_arguments:
     course_parser.add_argument(*arg[:-1], **arg[-1])
 
@@ -157,6 +176,7 @@ args = global_parser.parse_args()
 command_mapping = {
         "course": CourseCommand,
         "flashcard": FlashcardCommand,
+        "flashcard index": FlashcardIndexCommand,
         "note": NoteCommand,
         "view": NoteViewer
         }
@@ -169,7 +189,10 @@ def main():
         global_parser.print_help()
         return
     else:
-        instance = command_mapping[args.command](CONFIG)
+        command = args.command
+        if getattr(args, "flashcard_command", None) is not None:
+            command = f"{command} {args.flashcard_command}"
+        instance = command_mapping[command](CONFIG)
         logger.info(f"Calling command {type(instance)}")
         instance.cmd(args)
 
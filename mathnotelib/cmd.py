@@ -5,18 +5,13 @@ from typing import Protocol
 import argparse
 import sys
 
-from PyQt6.QtWidgets import QApplication
-
 from mathnotelib.services.flashcard_compiler import FlashcardCache
 
 from .utils import load_json, dump_json
 from .config import Config
 from .models import Course
-from ._enums import FileType
-from .services import NotesRepository, CourseRepository
-from .noteviewer import MainWindow
-
-from .flashcard import FlashcardMainWindow, FlashcardController, FlashcardSession, FlashcardCompiler
+from ._enums import ExtractionBackend, FileType
+from .services import NotesRepository, CourseRepository, ExtractionCache, FlashcardIndexer, IncludeGraph
 from mathnotelib import config
 
 
@@ -36,6 +31,9 @@ class NoteViewer(Command):
         self.config = project_config
 
     def cmd(self, namespace: argparse.Namespace) -> None:
+        # Qt is imported on use, so headless commands run without a display or PyQt6
+        from PyQt6.QtWidgets import QApplication
+        from .noteviewer import MainWindow
         app = QApplication(sys.argv)
         window = MainWindow()
         window.resize(800, 600)
@@ -48,6 +46,8 @@ class FlashcardCommand(Command):
     # should these really be class level?
 
     def __init__(self, project_config: Config):
+        from PyQt6.QtWidgets import QApplication
+        from .flashcard import FlashcardMainWindow, FlashcardController, FlashcardSession, FlashcardCompiler
         self.config = project_config
         self._has_dependecies()
         self._app: QApplication = QApplication(sys.argv)
@@ -106,6 +106,32 @@ class FlashcardCommand(Command):
 
         return None
 
+class FlashcardIndexCommand(Command):
+    """ Headless flashcard extraction, writes every flashcard of every course as json lines (see FlashcardIndexer) """
+    def __init__(self, project_config: Config):
+        self.config = project_config
+
+    def cmd(self, namespace: argparse.Namespace):
+        sections = None if namespace.section is None else [section.upper() for section in namespace.section]
+        cache = None if namespace.no_cache else ExtractionCache(self.config.cache_dir() / "extraction")
+        includes = None
+        if namespace.includes:
+            includes = IncludeGraph() if namespace.no_cache else IncludeGraph(self.config.cache_dir() / "includes")
+        try:
+            indexer = FlashcardIndexer(self.config, section_names=sections, workers=namespace.workers, cache=cache, includes=includes,
+                                       dedup=namespace.dedup, backend=ExtractionBackend(namespace.backend),
+                                       chunk_size=namespace.chunk_size)
+            if namespace.output is None:
+                stats = indexer.write(sys.stdout, namespace.course, namespace.week)
+            else:
+                with open(namespace.output, "w", encoding='utf-8') as f:
+                    stats = indexer.write(f, namespace.course, namespace.week)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        print(stats, file=sys.stderr)
+
+
 class CourseCommand(Command):
     """ Class command """
 
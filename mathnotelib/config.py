@@ -1,4 +1,5 @@
 from pathlib import Path
+import hashlib
 import json
 import shutil
 import os
@@ -6,6 +7,7 @@ import re
 from typing import Optional
 
 from ._enums import FileType
+from .models.macros import MacroMatcher, MacroTableCache, parse_typst_macros
 
 
 class Config:
@@ -91,6 +93,7 @@ class Config:
                 }
 
         self._macros: dict[FileType, dict] | None = None
+        self._macro_matchers: dict[FileType, MacroMatcher] | None = None
         self._update_config()
 
     def _update_config(self):
@@ -172,6 +175,8 @@ class Config:
             \newcommand{macro name}[nargs(int)]{
                 command
                 }
+        Parsed macros and their matchers are persisted in cache_dir() (see MacroTableCache), a macros file is only parsed
+        again after it changed
         returns: dict of the form {cmd_name: {args: #, tex_cmd: ""}}
         """
         if self._macros is not None:
@@ -179,67 +184,60 @@ class Config:
 
         tex_path = self.template_files[FileType.LaTeX]["macros"]
         typst_path = self.template_files[FileType.Typst]["macros"]
+        self._macros, self._macro_matchers = {}, {}
         if tex_path.is_file():
-            tex_doc = tex_path.read_text().splitlines()
-            tex_macros = self._parse_latex_macros(tex_doc)
+            table = macro_table_cache().load(tex_path, self._parse_latex_macros, self._macros_fingerprint(FileType.LaTeX))
+            self._macros[FileType.LaTeX], self._macro_matchers[FileType.LaTeX] = table
         else:
             # TODO: LOg
-            tex_macros = {}
+            self._macros[FileType.LaTeX], self._macro_matchers[FileType.LaTeX] = {}, MacroMatcher(())
             print(f"Failed to load LaTeX macros, file {tex_path} does not exist")
 
         if typst_path.is_file():
-            typst_doc = typst_path.read_text().splitlines()
-            typst_macros = self._parse_typst_macros(typst_doc)
+            table = macro_table_cache().load(typst_path, self._parse_typst_macros, self._macros_fingerprint(FileType.Typst))
+            self._macros[FileType.Typst], self._macro_matchers[FileType.Typst] = table
         else:
-            typst_macros = {}
+            self._macros[FileType.Typst], self._macro_matchers[FileType.Typst] = {}, MacroMatcher(())
             print(f"Failed to load Typst macros, file {typst_path} does not exist")
-        self._macros = {FileType.Typst: typst_macros, FileType.LaTeX: tex_macros}
         return self._macros
 
+    def macro_matchers(self) -> dict[FileType, MacroMatcher]:
+        """ Returns MacroMatcher for the macros of each filetype. Matchers are loaded along with macros() and shared by
+        every CleanStage """
+        if self._macro_matchers is None:
+            self.macros()
+        assert self._macro_matchers is not None
+        return self._macro_matchers
 
-    def _parse_latex_macros(self, lines: list[str]) -> dict[str, str]:
-        macros = dict()
-        pattern = r'\\newcommand\{(.*?)\}\[(.*?)\]'
-        # Makes assumtion that the only characters in 'line' are part of command with the exception of whitespace
-        for line in lines:
-            match = re.search(pattern, line)
+    def _macros_fingerprint(self, filetype: FileType) -> str:
+        """ Configuration the macros of filetype are parsed with, a cached macro table is only used when it matches """
+        if filetype == FileType.LaTeX:
+            return _macros_fingerprint("latex", sorted(self.macro_names))
+        return _macros_fingerprint("typst", sorted(d[FileType.Typst.value] for d in self.section_names.values() if FileType.Typst.value in d))
 
-            if not match:
-                continue
-            name = match.group(1).lstrip("\\")
+    def _parse_latex_macros(self, lines: list[str]) -> dict[str, dict]:
+        return _parse_latex_macros(lines, self.macro_names)
 
-            if name in self.macro_names:
-                tex_cmd = line.replace(match.group(0), "").strip()[1:-1] # remove enclosing curly braces
-                macros[name] = {"num_args": match.group(2), "command": tex_cmd}
-        return macros
 
-
-    def _parse_typst_macros(self, lines: list[str]) -> dict:
-        #TODO: for now we just import required packages (probably better solution anyways)
-        return {}
+    def _parse_typst_macros(self, lines: list[str]) -> dict[str, dict]:
+        """ Parses '#let' definitions, see parse_typst_macros. Section commands are never expanded """
+        section_commands = [names[FileType.Typst.value] for names in self.section_names.values() if FileType.Typst.value in names]
+        return parse_typst_macros(lines, reserved=section_commands)
 
 CONFIG = Config()
 
 
-# TODO delete
-def get_hack_macros():
-    """tmp fix for removing macros"""
-    return {"framedtext": {"num_args": '1', "command": ""}}
+def macro_table_cache() -> MacroTableCache:
+    return MacroTableCache(Config.cache_dir() / "macros")
 
-# TODO re work this
-def load_macros(macros_path: Path, macro_names: list[str]) -> dict[str,dict]:
-    r""" Gets all user commands from macro_path
-    Macros beign parsed have the form:
-        \newcommand{macro name}[nargs(int)]{
-            command
-            }
-    returns: dict of the form {cmd_name: {args: #, tex_cmd: ""}}
-    """
+def _macros_fingerprint(*parts: object) -> str:
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+def _parse_latex_macros(lines: list[str], macro_names: list[str]) -> dict[str, dict]:
     macros = dict()
-    document = Path(macros_path).read_text().splitlines()
     pattern = r'\\newcommand\{(.*?)\}\[(.*?)\]'
     # Makes assumtion that the only characters in 'line' are part of command with the exception of whitespace
-    for line in document:
+    for line in lines:
         match = re.search(pattern, line)
 
         if not match:
@@ -250,3 +248,22 @@ def load_macros(macros_path: Path, macro_names: list[str]) -> dict[str,dict]:
             tex_cmd = line.replace(match.group(0), "").strip()[1:-1] # remove enclosing curly braces
             macros[name] = {"num_args": match.group(2), "command": tex_cmd}
     return macros
+
+
+# TODO delete
+def get_hack_macros():
+    """tmp fix for removing macros"""
+    return {"framedtext": {"num_args": '1', "command": ""}}
+
+# TODO re work this
+def load_macros(macros_path: Path, macro_names: list[str]) -> dict[str,dict]:
+    r""" Gets all user commands from macro_path
+    Macros beign parsed have the form:
+        \newcommand{macro name}[nargs(int)]{
+            command
+            }
+    Served from the persisted macro table (see MacroTableCache) while macros_path is unchanged
+    returns: dict of the form {cmd_name: {args: #, tex_cmd: ""}}
+    """
+    parse = lambda lines: _parse_latex_macros(lines, macro_names)
+    return macro_table_cache().load(Path(macros_path), parse, _macros_fingerprint("latex", sorted(macro_names))).macros
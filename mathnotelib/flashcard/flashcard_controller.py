@@ -9,11 +9,12 @@ from PyQt6.QtGui import QStandardItem, QStandardItemModel
 from PyQt6.QtWidgets import QListView, QMessageBox, QWidget
 
 from mathnotelib.models.flashcard import Flashcard
+from ..models import SourceLocation
 
 from .window import FlashcardMainWindow
 from .flashcard_model import FlashcardSession
 from ..exceptions import EndofFlashcards, FlashcardNotFoundException, LaTeXCompilationError, TypstCompilationError
-from ..services import CourseRepository, open_file_with_editor, open_pdf
+from ..services import CourseRepository, DocumentGenerator, IncludeGraph, open_file_with_editor, open_pdf
 from ..config import CONFIG, Config
 
 logger = logging.getLogger("mathnote")
@@ -46,6 +47,7 @@ class FlashcardController:
         self.session = session
         self.view = view
         self.course_repo = CourseRepository(config)
+        self.include_graph = IncludeGraph(config.cache_dir() / "includes")
         self.flashcards = []
         self.current_data = {"Question": "", "Answer": "", "Proof": None}
         self._setBindings()
@@ -155,14 +157,16 @@ class FlashcardController:
             message = "No flashcards have been loaded"
             return
         else:
-            message = f"Source: {info}"
+            location = self._get_source_location()
+            message = f"Source: {info}" if location is None else f"Source: {info}:{location.range()}"
         self.view.flashcard_info_button().set_message(message)
 
     # Why do we default to all sections?
     def create_flashcards_from_file(self, path: Path, shuffle=False):
         section_names = [member for member in CONFIG.section_names.keys()]
         logger.info(f"Creating flashcards from {path}")
-        load_thread = threading.Thread(target=self.session.load_flashcards, args=(section_names, [path], shuffle))
+        load_thread = threading.Thread(target=self.session.load_flashcards, args=(section_names, [path], shuffle),
+                                       kwargs={"precompile": True})
         load_thread.start()
 
     def create_flashcards(self):
@@ -174,15 +178,21 @@ class FlashcardController:
             self.view.set_error_message(f"Invalid selection course={course}, section names={section_names}. You must select a course name and at least one section")
             logger.debug(f"Invalid selection (course={course}, section_names={section_names}) for generating flashcards")
             return
-        # fix
-#        paths = [lecture.path for lecture in course.lectures if course.get_week(lecture) in weeks]
-        paths = [lecture.path for lecture in course.lectures]
-        logger.info(f"Creating flashcards from {len(paths)} paths")
-        load_thread = threading.Thread(target=self.session.load_flashcards, args=(section_names, paths, random))
+        # Lectures outside the selected weeks are never read
+        paths = [lecture.path for lecture in course.lectures_in_weeks(weeks)]
+        logger.info(f"Creating flashcards from {len(paths)} of {len(course.lectures)} lectures (weeks={weeks})")
+        data_iterable = None
+        if course.main_file.path.is_file():
+            # Sections of the main file and of nested includes, in document order. Lectures not included yet come last
+            excluded = {lecture.path for lecture in course.lectures} - set(paths)
+            data_iterable = DocumentGenerator([course.main_file.path], extra=paths, exclude=excluded, graph=self.include_graph)
+        load_thread = threading.Thread(target=self.session.load_flashcards, args=(section_names, paths, random),
+                                       kwargs={"data_iterable": data_iterable, "precompile": True})
         load_thread.start()
 
-    def get_flashcard_pipeline_config(self) -> tuple[str, dict[str, dict[str, str]], set[int], bool]:
-        """ Retreives user config from widgets. We need to do error checking... what if no boxes are checked """
+    def get_flashcard_pipeline_config(self) -> tuple[str, dict[str, dict[str, str]], set[int] | None, bool]:
+        """ Retreives user config from widgets. We need to do error checking... what if no boxes are checked
+        weeks is None when every week is selected """
         random = self.view.random_checkbox().isChecked()
         course_name = self.view.course_combo().currentText()
         checked_sections = self._get_checked_items_from_listView(self.view.section_list())
@@ -190,7 +200,7 @@ class FlashcardController:
         weeks_text = [week.text() for week in weeks_items]
         # Clean filter by weeks params
         if "ALL" in [week.upper() for week in weeks_text] or not weeks_text:
-            weeks = {i for i in range(1, 13+1)} # TODO: verify weeks
+            weeks = None
         else:
             weeks = {int(week.split(" ")[-1]) for week in weeks_text}
 
@@ -222,6 +232,12 @@ class FlashcardController:
         source = card.main_section.content.source
         return source
 
+    def _get_source_location(self) -> SourceLocation | None:
+        card = self.session.current_card
+        if card is None:
+            return None
+        return card.main_section.location
+
     def open_main(self):
         course_name, *_ = self.get_flashcard_pipeline_config()
         course = self.course_repo.get_course(course_name)
@@ -231,4 +247,5 @@ class FlashcardController:
     def launch_iterm(self):
         source = self._get_pdf_source()
         if source is not None:
-            open_file_with_editor(str(source))
+            location = self._get_source_location()
+            open_file_with_editor(str(source), None if location is None else location.line)
@@ -3,17 +3,22 @@ import threading
 import time
 import logging
 from pathlib import Path
-from typing import Optional, Deque
+from typing import Iterable, Optional, Deque
 from collections import deque
 
-from ..models import Flashcard, FlashcardDoubleLinkedList
+from .._enums import ExtractionBackend
+from ..models import Flashcard, FlashcardDoubleLinkedList, TrackedText
 from ..config import CONFIG
 from ..services import FlashcardCompiler
 from ..utils import StoppableThread
-from ..services import FlashcardBuilderStage, CleanStage, DataGenerator, ProcessingPipeline
+from ..services import FlashcardBuilderStage, CleanStage, CleanBuildStage, CompileStage, DataGenerator, DeduplicateStage, LazyFlashcardStage, ProcessingPipeline, ExtractionCache, TypstQueryStage
 
 logger = logging.getLogger("mathnote")
 
+# Lectures larger than this many bytes are read in chunks (see DataGenerator), so parsing one huge file does not hold
+# back its first cards or load the whole file at once
+CHUNK_SIZE = 4 * 2**20
+
 
 # build into stage
 
@@ -33,6 +38,8 @@ class FlashcardSession:
         self.current_card: Optional[Flashcard] = None # threadsafe, never accessed by thread
         self._compile_thread = StoppableThread(callback=self._compile)
         self._macros = None
+        self._generation = 0 # incremented each time load_flashcards replaces the deck
+        self.extraction_cache = ExtractionCache(CONFIG.cache_dir() / "extraction")
 
     def start(self):
         self._compile_thread.start()
@@ -70,11 +77,30 @@ class FlashcardSession:
         with self.flashcard_lock:
             self.compiled_flashcards.append(card)
 
-    def load_flashcards(self, section_names: list[str], paths: list[Path], shuffle=True) -> None:
+    def load_flashcards(self,
+                        section_names: list[str],
+                        paths: list[Path],
+                        shuffle=True,
+                        workers: int = 1,
+                        precompile: bool = False,
+                        data_iterable: Iterable[TrackedText | None] | None = None,
+                        dedup: bool = True,
+                        backend: ExtractionBackend = ExtractionBackend.Staged,
+                        chunk_size: int | None = CHUNK_SIZE
+                        ) -> None:
         r""" Load flash cards with raw tex. Threadsafe... hopefully as I run it on its own thread. Even though this
         is bound by CPU, threading allows for the compilation and generation process to alternate (not sure if this is actually true)
         -- Params --
         section_names: names of box's defined by user. i.e \defin{Integer}{Content} is a section called 'defin'
+        workers: number of processes used to parse files, files are parsed on the calling thread when workers <= 1
+        precompile: compile cards as soon as they are extracted, overlapping compilation with parsing of the remaining files.
+                    Ignored when workers > 1
+        data_iterable: chunks to parse instead of the files in paths, e.g., a DocumentGenerator following the includes of
+                       a course's main file
+        dedup: merge cards with the same content (see DeduplicateStage), e.g., a theorem restated in a later lecture
+        backend: stages extracting the cards, CleanStage then FlashcardBuilderStage by default, CleanBuildStage, or
+                 TypstQueryStage for Typst lectures (requires typst and the section metadata, see TypstQueryStage)
+        chunk_size: files in paths larger than chunk_size bytes are read in chunks (see DataGenerator), None to read files whole
         """
         logger.debug(f"Calling load_flashcards(section_names={section_names}, paths={paths})")
         # Implement thread safe 'clearing'
@@ -82,27 +108,56 @@ class FlashcardSession:
             self.compiled_flashcards.clear()
             self.current_card = None
             self.flashcards.clear()
+            self._generation += 1
         # Since FlashcardsPipeline is a generator we can not shuffle all card together.
         # As a work around paths in each batch are shuffled and as each batch is added we shuffle all batches together
         if shuffle:
             random.shuffle(paths)
 
-        data_iterable = DataGenerator(paths)
+        if data_iterable is None:
+            data_iterable = DataGenerator(paths, chunk_size=chunk_size)
         # TODO fix get_hack_macros
-        clean_data_stage = CleanStage(CONFIG.macros())
+        clean_data_stage = CleanStage(CONFIG.macros(), CONFIG.macro_matchers())
         build_stage = FlashcardBuilderStage(section_names)
         # TODO why?
         build_stage.add_subsection_finder("PROOF", ["THEOREM", "PROPOSITION", "LEMMA", "COROLLARY"])
-        pipeline = ProcessingPipeline(data_iterable)
-        pipeline.add_stage(clean_data_stage)
-        pipeline.add_stage(build_stage)
-        for flash_cards in pipeline:
+        pipeline = ProcessingPipeline(data_iterable, cache=self.extraction_cache)
+        extract_stage: FlashcardBuilderStage | CleanBuildStage = build_stage
+        if backend == ExtractionBackend.Fused:
+            # Same cards as adding clean_data_stage then build_stage, macros are only expanded inside sections
+            extract_stage = CleanBuildStage(clean_data_stage, build_stage)
+        elif backend != ExtractionBackend.TypstQuery:
+            pipeline.add_stage(clean_data_stage)
+        if backend == ExtractionBackend.TypstQuery:
+            # Typst lectures are queried whole with typst, other files go through clean_data_stage and build_stage
+            query_stage = TypstQueryStage(section_names, root=CONFIG.root_path, fallback=[clean_data_stage, build_stage])
+            query_stage.add_subsection("PROOF", ["THEOREM", "PROPOSITION", "LEMMA", "COROLLARY"])
+            pipeline.add_stage(query_stage)
+        elif workers > 1 or precompile or shuffle:
+            pipeline.add_stage(extract_stage)
+        else:
+            # Cards are queued for compilation as soon as their section is parsed, rather than once the whole file is
+            pipeline.add_stage(LazyFlashcardStage(extract_stage))
+        if dedup:
+            # Duplicates are dropped before they are compiled, the copy kept is the same whatever order files are parsed in
+            pipeline.add_stage(DeduplicateStage())
+        if workers > 1:
+            results = pipeline.parallel(workers, ordered=not shuffle)
+        elif precompile:
+            pipeline.add_stage(CompileStage(self.compiler))
+            results = pipeline.stream()
+        else:
+            results = pipeline
+        for flash_cards in results:
             if shuffle:
+                flash_cards = list(flash_cards)
                 random.shuffle(flash_cards)
-            with self.flashcard_lock:
-                for flashcard in flash_cards:
+            count = 0
+            for flashcard in flash_cards:
+                with self.flashcard_lock:
                     self.flashcards.append(flashcard)
-            logger.debug(f"Loaded flashcards: {flash_cards}")
+                count += 1
+            logger.debug(f"Loaded {count} flashcards")
 
     def next_flashcard(self) -> Flashcard:
         """ Retreive next flashcard, implements blocking behaviour when there are no compiled cards however one is currently being compiled """
@@ -148,20 +203,34 @@ class FlashcardSession:
         with self.flashcard_lock:
             if len(self.flashcards) == 0:
                 return
-
-            card = self.flashcards.popleft()
+            # Cards missing to have compile_num cards ahead, at most a batch. Their LaTeX is compiled with one latexmk run
+            # (see FlashcardCompiler.compile_batch)
+            count = min(len(self.flashcards), max(self.compiler.batch_size, 1), max(compile_num + 1 - self._count_precompiled_cards(), 1))
+            cards = [self.flashcards.popleft() for _ in range(count)]
+            generation = self._generation
+
+        # Compiled without the lock, so loading and navigating cards are not blocked
+        try:
+            self.compiler.compile_batch(cards)
+        except Exception as e:
+            logger.error(f"Failed to compile batch: {str(e)[:1000]}")
+        for card in cards:
             logger.debug(repr(card))
             try:
                 self.compiler.compile_card(card)
                 logger.debug(f"Compiled card: {repr(card)}")
-                self._prepend_compiled_flashcard(card)
+                with self.flashcard_lock:
+                    # Cards of a deck replaced by load_flashcards while compiling are dropped
+                    if generation != self._generation:
+                        return None
+                    self._prepend_compiled_flashcard(card)
 
             except Exception as e:
                 msg = str(e)
                 if len(msg) > 1000:
                     msg = msg[:1000]
                 logger.error(f"Failed to compile: {msg}")
-#            flashcard_hash = (set(self.compiler.get_hash(str(flashcard.question)) for flashcard in self.flashcards)
-#                              | set(self.compiler.get_hash(str(value)) for _card in self.flashcards for value in _card.additional_info.values()))
+#        flashcard_hash = (set(self.compiler.get_hash(str(flashcard.question)) for flashcard in self.flashcards)
+#                          | set(self.compiler.get_hash(str(value)) for _card in self.flashcards for value in _card.additional_info.values()))
 
-            return None
+        return None
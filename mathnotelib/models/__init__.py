@@ -1,8 +1,9 @@
 from .note import Note, Category, Metadata
 from .courses import Course
 from .source_file import (SourceFile, ProjectSourceFile, Lecture, Assignment, TrackedText,
-                          langauage_char_registry, LanguageChars, StandaloneSourceFile)
+                          TrackedTextView, TrackedTextBuilder, SourceChunk, langauage_char_registry, LanguageChars, StandaloneSourceFile)
 from .flashcard import Flashcard, Section, FlashcardDoubleLinkedList
+from .source_map import SourceMap, SourceLocation, SourceRange
 
 __all__ = [
         "Note",
@@ -14,10 +15,16 @@ __all__ = [
         "Lecture",
         "Assignment",
         "TrackedText",
+        "TrackedTextView",
+        "TrackedTextBuilder",
+        "SourceChunk",
         "StandaloneSourceFile",
         "langauage_char_registry",
         "LanguageChars",
         "Flashcard",
         "Section",
         "FlashcardDoubleLinkedList",
+        "SourceMap",
+        "SourceLocation",
+        "SourceRange",
         ]
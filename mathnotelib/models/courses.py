@@ -1,4 +1,4 @@
-from typing import Callable
+from typing import Callable, Iterable
 from math import ceil
 from pathlib import Path
 from datetime import datetime
@@ -118,6 +118,14 @@ class Course:
             return 0
         return ceil(lecture.number() / len(self.days()))
 
+    def lectures_in_weeks(self, weeks: Iterable[int] | None = None) -> list[Lecture]:
+        """ Lectures of the given weeks (see get_week), used to select the files to parse before any of them is read.
+        All lectures when weeks is None. Lectures whose week can not be determined (week 0) are always included """
+        if weeks is None:
+            return list(self.lectures)
+        weeks = set(weeks)
+        return [lecture for lecture in self.lectures if (week := self.get_week(lecture)) == 0 or week in weeks]
+
     # adjust this
     def include_template(self) -> Callable[[str], str]:
         if self.filetype == FileType.LaTeX:
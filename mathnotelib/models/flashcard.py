@@ -1,32 +1,47 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Generic, Iterator, TypeVar
 
 from .source_file import TrackedText, FileType
+from .source_map import SourceLocation
 from ..exceptions import FlashcardNotFoundException
 
 
-@dataclass
+# Slotted, decks hold thousands of cards and their sections
+@dataclass(slots=True)
 class Section:
     name: str # TODO make Enum
     content: TrackedText
     pdf_path: Path | None = None
     title: TrackedText | None = None
     title_pdf: Path | None = None
+    location: SourceLocation | None = None # location of the whole section (command to closing delimiter) in its source file
 
 
 
-@dataclass
+@dataclass(slots=True)
 class Flashcard:
     main_section: Section
     proof_section: Section | None = None
     seen: bool = False
+    duplicates: tuple[Section, ...] = () # copies of main_section found in other places, see DeduplicateStage
 
     def filetype(self) -> FileType:
         return self.main_section.content.filetype()
 
+    def sources(self) -> list[Path]:
+        """ Source files of main_section and of its duplicates, in the order they were found """
+        sources: list[Path] = []
+        for section in (self.main_section, *self.duplicates):
+            source = section.content.source
+            if source is not None and source not in sources:
+                sources.append(source)
+        return sources
+
 
 class Node:
+    __slots__ = ("data", "next", "prev")
+
     def __init__(self, data: Flashcard) -> None:
         self.data = data
         self.next: Node | None = None
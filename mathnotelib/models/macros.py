@@ -0,0 +1,264 @@
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Iterable, NamedTuple
+import hashlib
+import logging
+import os
+import pickle
+import re
+import tempfile
+
+logger = logging.getLogger("mathnote")
+
+
+class MacroMatcher:
+    """Trie of macro names, used to find the macro invoked at a command prefix.
+
+    A name only matches when it is followed by a non alphabetic character, e.g., 'op' does not match 'operatorname'.
+    Lookup costs O(length of the longest match) regardless of the number of macros.
+
+    Usage:
+        matcher = MacroMatcher.from_macros(macros)
+        name = matcher.match(text, index + 1) # index of command prefix
+    """
+    _TERMINAL = None
+
+    def __init__(self, names: Iterable[str]):
+        self._root: dict = {}
+        self._size = 0
+        for order, name in enumerate(names):
+            if not name:
+                continue
+            node = self._root
+            for char in name:
+                node = node.setdefault(char, {})
+            # When names collide the first one inserted wins, same as a linear search over names
+            node.setdefault(self._TERMINAL, (order, name))
+            self._size += 1
+
+    @classmethod
+    def from_macros(cls, macros: dict[str, dict]) -> "MacroMatcher":
+        """ macros: dict of form {macro name: macro info,...}, see Config.macros. Macros without a command can not be expanded and are skipped """
+        return cls(name for name, info in macros.items() if info.get("command") is not None)
+
+    def match(self, buffer: str, start: int = 0, end: int | None = None) -> str | None:
+        """ Returns name of macro that buffer[start:end] begins with, None if no macro matches """
+        end = len(buffer) if end is None else end
+        node = self._root
+        best: tuple[int, str] | None = None
+        index = start
+        while index < end:
+            node = node.get(buffer[index])
+            if node is None:
+                break
+            index += 1
+            terminal = node.get(self._TERMINAL)
+            if terminal is not None and index < end and not buffer[index].isalpha():
+                if best is None or terminal[0] < best[0]:
+                    best = terminal
+        return None if best is None else best[1]
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __repr__(self) -> str:
+        return f"MacroMatcher(size={self._size})"
+
+
+
+class MacroTable(NamedTuple):
+    macros: dict[str, dict]
+    matcher: MacroMatcher
+
+
+class MacroTableCache:
+    """Persistent cache of the macros parsed from each macros file, along with their MacroMatcher, so processes only
+    parse a macros file after it changed.
+
+    Entries are stored as one pickle per macros file. An entry is used when the file's mtime and size are unchanged, or,
+    when they differ (e.g., the file was touched or copied), when the file's sha256 is unchanged. The fingerprint of the
+    parser configuration (e.g., macro names) must also match. Unreadable entries are ignored and rewritten.
+
+    Usage:
+        cache = MacroTableCache(CONFIG.cache_dir() / "macros")
+        table = cache.load(path, parse, fingerprint) # MacroTable(macros, matcher)
+    """
+    # Bump when the entry format, the parsers or MacroMatcher change
+    version = 1
+
+    def __init__(self, cache_dir: Path):
+        self.cache_root = cache_dir
+
+    def load(self, path: Path, parse: Callable[[list[str]], dict[str, dict]], fingerprint: str) -> MacroTable:
+        """ Returns the macros of path, parse(lines of path), and their matcher. path must exist """
+        stat = path.stat()
+        entry_path = self._entry_path(path)
+        entry = self._read(entry_path)
+        if entry is not None and entry.get("fingerprint") == fingerprint:
+            if entry.get("mtime_ns") == stat.st_mtime_ns and entry.get("size") == stat.st_size:
+                return entry["table"]
+        data = path.read_bytes()
+        digest = hashlib.sha256(data).hexdigest()
+        if entry is not None and entry.get("fingerprint") == fingerprint and entry.get("sha256") == digest:
+            table = entry["table"]
+        else:
+            logger.debug(f"Parsing macros file {path}")
+            macros = parse(data.decode("utf-8").splitlines())
+            table = MacroTable(macros, MacroMatcher.from_macros(macros))
+        self._write(entry_path, {
+            "version": self.version,
+            "path": str(path),
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha256": digest,
+            "fingerprint": fingerprint,
+            "table": table
+            })
+        return table
+
+    def clear(self) -> None:
+        for entry_path in self.cache_root.glob("*.pickle"):
+            entry_path.unlink(missing_ok=True)
+
+    def _entry_path(self, path: Path) -> Path:
+        name = hashlib.sha256(str(path.resolve()).encode("utf-8")).hexdigest()[:16]
+        return self.cache_root / f"{name}.pickle"
+
+    def _read(self, entry_path: Path) -> dict | None:
+        try:
+            with entry_path.open("rb") as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, ValueError, TypeError) as e:
+            logger.warning(f"Ignoring invalid macro table {entry_path}: {e}")
+            return None
+        if not isinstance(entry, dict) or entry.get("version") != self.version or not isinstance(entry.get("table"), MacroTable):
+            return None
+        return entry
+
+    def _write(self, entry_path: Path, entry: dict) -> None:
+        # Write then rename, so concurrent readers never see a partial entry
+        try:
+            self.cache_root.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_root, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, entry_path)
+        except OSError as e:
+            logger.warning(f"Failed to write macro table {entry_path}: {e}")
+
+    def __repr__(self) -> str:
+        return f"MacroTableCache({self.cache_root})"
+
+
+_TYPST_LET = re.compile(r"^\s*#let\s+(?P<name>[A-Za-z_][A-Za-z0-9_-]*)\s*(?:\((?P<params>[^()]*)\))?\s*=\s*(?P<body>.*?)\s*$")
+_TYPST_IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_-]*")
+
+
+def parse_typst_macros(lines: Iterable[str], reserved: Iterable[str] = ()) -> dict[str, dict]:
+    """ Parses '#let' definitions of a Typst macros file. Simple definitions are converted to templates that
+    CleanStage inlines, where '#1' marks the argument:
+
+        #let name = [content] or $math$           ->  {"num_args": "0", "command": "content" or "$math$"}
+        #let name(x) = [... #x ...] or $... #x ...$ ->  {"num_args": "1", "command": "... #1 ..."}
+
+    In math bodies parameters with names longer than one letter may also be used without '#'.
+
+    Any other definition (several parameters, code bodies, definitions spanning lines, ...) is recorded with
+    "command": None, it can not be inlined and cards using it still import the notes package.
+
+    -- Params --
+    lines: lines of macros file
+    reserved: names never inlined, e.g., section commands
+    returns: dict of the form {name: {"num_args": "0" | "1" | None, "command": template | None}}
+    """
+    reserved = set(reserved)
+    macros: dict[str, dict] = {}
+    for line in lines:
+        match = _TYPST_LET.match(line)
+        if match is None:
+            continue
+        name = match.group("name")
+        if name in reserved or name in macros:
+            continue
+        params = match.group("params")
+        macros[name] = _typst_template(match.group("body"), None if params is None else [p.strip() for p in params.split(",") if p.strip()])
+    return macros
+
+
+def _typst_template(body: str, params: list[str] | None) -> dict:
+    not_simple = {"num_args": None if params is None else str(len(params)), "command": None}
+    if params is not None and (len(params) != 1 or _TYPST_IDENTIFIER.fullmatch(params[0]) is None):
+        return not_simple
+    if len(body) >= 2 and body[0] == "[" and body[-1] == "]" and balanced(body[1:-1], "[", "]"):
+        template = body[1:-1]
+    elif len(body) >= 2 and body[0] == "$" and body[-1] == "$" and body.count("$") == 2:
+        template = body
+    else:
+        return not_simple
+    if params is None:
+        return {"num_args": "0", "command": template}
+
+    param = re.escape(params[0])
+    template = re.sub(fr"#{param}(?![A-Za-z0-9_-])", "#1", template)
+    if template[0] == "$" and len(params[0]) > 1:
+        # In math, identifiers of more than one letter refer to variables without '#'
+        template = re.sub(fr"(?<![A-Za-z0-9_#-]){param}(?![A-Za-z0-9_-])", "#1", template)
+    # Any other use of the parameter (e.g., in code) can not be substituted textually
+    if re.search(fr"(?<![A-Za-z0-9_-]){param}(?![A-Za-z0-9_-])", template.replace("#1", "")):
+        return not_simple
+    return {"num_args": "1", "command": template}
+
+
+def balanced(text: str, open_delim: str, close_delim: str) -> bool:
+    """ True if every close_delim in text closes an earlier open_delim and every open_delim is closed """
+    depth = 0
+    for char in text:
+        if char == open_delim:
+            depth += 1
+        elif char == close_delim:
+            depth -= 1
+            if depth < 0:
+                return False
+    return depth == 0
+
+
+def requires_package(text: str, macros: dict[str, dict]) -> bool:
+    """ True if text has to import the package defining macros, i.e., a macro is still referenced after CleanStage
+    inlined the simple calls: a '#name' call that was not inlined (see parse_typst_macros), or a function or variable
+    used from math without '#'. Plain words in markup and single letters in math are not references, e.g.,
+    'Let $x in bb(R)$ be real' does not reference a macro 'R'. Without any parsed macros the package contents are
+    unknown, so it is always required """
+    if not macros:
+        return True
+    names = tuple(sorted(macros))
+    if _calls_pattern(names).search(text) is not None:
+        return True
+    # In math, identifiers of more than one letter refer to variables, '_' and '-' are not part of them
+    math_names = tuple(name for name in names if len(name) > 1 and _MATH_IDENTIFIER.fullmatch(name))
+    if not math_names:
+        return False
+    pattern = _math_names_pattern(math_names)
+    return any(pattern.search(math) is not None for math in _math_segments(text))
+
+
+_MATH_IDENTIFIER = re.compile(r"[A-Za-z][A-Za-z0-9]*")
+_MATH_DELIMITER = re.compile(r"(?<!\\)\$")
+
+
+def _math_segments(text: str) -> list[str]:
+    """ Contents of the '$...$' equations of text. Math inside content blocks nested in math is not told apart """
+    return _MATH_DELIMITER.split(text)[1::2]
+
+
+@lru_cache(maxsize=32)
+def _calls_pattern(names: tuple[str, ...]) -> re.Pattern:
+    alternation = "|".join(re.escape(name) for name in names)
+    return re.compile(fr"#(?:{alternation})(?![A-Za-z0-9_-])")
+
+
+@lru_cache(maxsize=32)
+def _math_names_pattern(names: tuple[str, ...]) -> re.Pattern:
+    alternation = "|".join(re.escape(name) for name in names)
+    return re.compile(fr"(?<![A-Za-z0-9])(?:{alternation})(?![A-Za-z0-9])")
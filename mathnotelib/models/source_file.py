@@ -1,8 +1,11 @@
+from array import array
 from dataclasses import dataclass
 from pathlib import Path
+import operator
 import re
 from typing import Callable, Iterable, Iterator, SupportsIndex, Union
 from .._enums import FileType
+from .source_map import SourceLocation, SourceMap
 
 """
 TODO: we get errors from latexmk, but output is still produced. Look into different error code meanings.
@@ -114,10 +117,36 @@ langauage_char_registry: dict[FileType, LanguageChars] = {
 #TODO: convert source from Path to ProjectSourceFile? Makes sense if individual projects have possibly custom preambles and we
 #compile sections
 class TrackedText:
-    """A string wrapper that tracks the original source file and preseves metadata"""
-    def __init__(self, text: str, source: Path | None = None):
+    """A string wrapper that tracks the original source file and preseves metadata
+
+    Slicing, indexing and iterating return TrackedTextView objects that share this text's buffer instead of copying it.
+    origin, when set, maps offsets of the buffer back to lines and columns of the source file, views share it.
+    Instances are slotted, parsing creates many short lived texts and views
+    """
+    __slots__ = ("text", "source", "origin")
+    _own_attributes = frozenset({"text", "source", "buffer", "start", "end", "origin"})
+
+    def __init__(self, text: str, source: Path | None = None, origin: SourceMap | None = None):
         self.text = text
         self.source = source
+        self.origin = origin
+
+    def span(self) -> tuple[str, int, int]:
+        """ Returns (buffer, start, end), where buffer[start:end] is the text. Allows scanning text without copying it """
+        return self.text, 0, len(self.text)
+
+    def view(self, start: int = 0, end: int | None = None) -> "TrackedTextView":
+        """ Zero copy view of text[start:end], start and end must satisfy 0 <= start <= end <= len(self) """
+        buffer, offset, stop = self.span()
+        end = stop - offset if end is None else end
+        return TrackedTextView(buffer, offset + start, offset + end, source=self.source, origin=self.origin)
+
+    def location(self) -> SourceLocation | None:
+        """ Location of this text in its source file, None if origin is unknown. Resolved lazily, see SourceLocation """
+        if self.origin is None:
+            return None
+        _, start, end = self.span()
+        return self.origin.location(start, end)
 
     def join(self, iterable: Iterable["TrackedText"]) -> "TrackedText":
         if not iterable:
@@ -126,6 +155,9 @@ class TrackedText:
         return TrackedText(joined_text, source = self.source)
 
     def __getattr__(self, name: str):
+        # Guard against recursion when attributes are looked up before __init__ has run (e.g., copy, pickle)
+        if name in self._own_attributes or name.startswith("__"):
+            raise AttributeError(name)
         attr = getattr(self.text, name)
         if callable(attr):
             def wrapper(*args, **kwargs):
@@ -153,16 +185,53 @@ class TrackedText:
     def encode(self, encoding: str = 'utf-8', errors: str = 'strict') -> bytes:
         return self.text.encode(encoding=encoding, errors=errors)
 
+    def startswith(self, prefix: str | tuple[str, ...]) -> bool:
+        buffer, start, end = self.span()
+        return buffer.startswith(prefix, start, end)
+
+    def endswith(self, suffix: str | tuple[str, ...]) -> bool:
+        buffer, start, end = self.span()
+        return buffer.endswith(suffix, start, end)
+
+    def find(self, sub: str, begin: int = 0, stop: int | None = None) -> int:
+        buffer, start, end = self.span()
+        # Negative indices count from the end of this text, as with str.find
+        length = end - start
+        if begin < 0:
+            begin = max(begin + length, 0)
+        if stop is None:
+            stop = length
+        elif stop < 0:
+            stop = max(stop + length, 0)
+        index = buffer.find(sub, start + begin, start + min(stop, length))
+        return index if index == -1 else index - start
+
+    def count(self, sub: str) -> int:
+        buffer, start, end = self.span()
+        return buffer.count(sub, start, end)
+
     def __getitem__(self, __key: SupportsIndex | slice) -> 'TrackedText':
-        return TrackedText(self.text.__getitem__(__key), source=self.source)
+        if isinstance(__key, slice):
+            start, stop, step = __key.indices(len(self))
+            if step != 1:
+                return TrackedText(str(self)[__key], source=self.source)
+            return self.view(start, max(start, stop))
+
+        index = operator.index(__key)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("TrackedText index out of range")
+        return self.view(index, index + 1)
 
     def __bool__(self) -> bool:
-        return len(self.text) != 0
+        return len(self) != 0
 
     def __add__(self, other: 'TrackedText') -> "TrackedText":
         """
         Other must be of type TrackedText and be of the same file type
         Left add has priority except for the special case where the string on the left has None as source.
+        Adjacent views of the same buffer are joined without copying.
 
         Example:
 
@@ -175,20 +244,45 @@ class TrackedText:
 
         if not isinstance(other, TrackedText):
             raise TypeError(f"Other must be type str not type {type(other)}")
-        elif other.source is None or self.source is None:
-            return TrackedText(self.text + other.text, source=self.source)
-        elif other.source.suffix != self.source.suffix:
+        elif other.source is not None and self.source is not None and other.source.suffix != self.source.suffix:
             raise TypeError(f"Incompatible source file types, expected filetype {self.source.suffix}, got {other.source.suffix}")
-        return TrackedText(self.text + other.text, source=self.source)
+
+        buffer, start, end = self.span()
+        other_buffer, other_start, other_end = other.span()
+        if buffer is other_buffer and end == other_start:
+            return TrackedTextView(buffer, start, other_end, source=self.source, origin=self.origin)
+        return TrackedText(str(self) + str(other), source=self.source)
 
     def split(self, sep: str | None = None, maxsep: SupportsIndex = -1) -> list['TrackedText']:
-        return [TrackedText(e, source=self.source) for e in self.text.split(sep, maxsep)]
+        """ Same as str.split, pieces are views of this text """
+        buffer, start, end = self.span()
+        maxsep = operator.index(maxsep)
+        pieces: list[TrackedText] = []
+        if sep is None:
+            for match in _NON_WHITESPACE.finditer(buffer, start, end):
+                if maxsep >= 0 and len(pieces) == maxsep:
+                    pieces.append(TrackedTextView(buffer, match.start(), end, source=self.source, origin=self.origin))
+                    break
+                pieces.append(TrackedTextView(buffer, match.start(), match.end(), source=self.source, origin=self.origin))
+            return pieces
+        if not sep:
+            raise ValueError("empty separator")
+
+        piece_start = start
+        while maxsep < 0 or len(pieces) < maxsep:
+            index = buffer.find(sep, piece_start, end)
+            if index == -1:
+                break
+            pieces.append(TrackedTextView(buffer, piece_start, index, source=self.source, origin=self.origin))
+            piece_start = index + len(sep)
+        pieces.append(TrackedTextView(buffer, piece_start, end, source=self.source, origin=self.origin))
+        return pieces
 
     def __str__(self) -> str:
         return self.text
 
     def __iter__(self) -> Iterator["TrackedText"]:
-        return (TrackedText(c, source=self.source) for c in self.text)
+        return (self.view(index, index + 1) for index in range(len(self)))
 
     def __len__(self) -> int:
         return len(self.text)
@@ -197,6 +291,128 @@ class TrackedText:
         return (f"TrackedText({self.text}, self.source={self.source})")
 
     def __contains__(self, item: Union["TrackedText", str]) -> bool:
-        if isinstance(item, TrackedText):
-            return item.text in self.text
-        return item in self.text
+        buffer, start, end = self.span()
+        return buffer.find(str(item), start, end) != -1
+
+
+class TrackedTextView(TrackedText):
+    """Zero copy TrackedText, stores a shared buffer and the span (start, end) of the buffer this text covers.
+    The string is only materialized when str(view) (or view.text) is called.
+
+    Usage:
+        text = TrackedText(...)
+        view = text[10:20] # TrackedTextView, no copy of text is made
+        str(view) == str(text)[10:20]
+    """
+    __slots__ = ("buffer", "start", "end")
+
+    def __init__(self, buffer: str, start: int = 0, end: int | None = None, source: Path | None = None, origin: SourceMap | None = None):
+        self.buffer = buffer
+        self.start = start
+        self.end = len(buffer) if end is None else end
+        self.source = source
+        self.origin = origin
+
+    @property
+    def text(self) -> str:
+        return self.buffer[self.start:self.end]
+
+    def span(self) -> tuple[str, int, int]:
+        return self.buffer, self.start, self.end
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def __repr__(self) -> str:
+        return (f"TrackedTextView({self.text}, start={self.start}, end={self.end}, self.source={self.source})")
+
+    def __reduce__(self):
+        # Pickle only the span, not the shared buffer. The origin is derived for the span, so the copy still maps back
+        # to the source file
+        origin = None
+        if self.origin is not None:
+            origin = self.origin.derive((array("q", [0]), array("q", [self.start]), array("q", [self.end - self.start])))
+        return (TrackedText, (self.text, self.source, origin))
+
+
+class SourceChunk(TrackedText):
+    """TrackedText holding part of its source file, e.g., produced when large files are read in chunks
+
+    Attributes:
+        offset: text offset of the first character of the chunk in the source file
+        byte_offset: byte offset of the first character of the chunk in the source file
+    """
+    __slots__ = ("offset", "byte_offset")
+    _own_attributes = TrackedText._own_attributes | {"offset", "byte_offset"}
+
+    def __init__(self, text: str, source: Path | None = None, offset: int = 0, byte_offset: int = 0, origin: SourceMap | None = None):
+        super().__init__(text, source=source, origin=origin)
+        self.offset = offset
+        self.byte_offset = byte_offset
+
+    def __repr__(self) -> str:
+        return (f"SourceChunk({self.text}, offset={self.offset}, self.source={self.source})")
+
+
+class TrackedTextBuilder:
+    """Assembles a TrackedText from spans of existing buffers and replacement strings. Segments are only recorded,
+    the new string is materialized once by build(), so assembling n characters costs O(n)
+
+    When origin is given, spans are taken to be spans of the buffer origin maps and the built text gets a SourceMap
+    mapping its offsets back to the source file
+
+    Usage:
+        builder = TrackedTextBuilder(source=text.source, origin=text.origin)
+        builder.append_span(*text.span())
+        builder.append("replacement")
+        new_text = builder.build()
+    """
+    def __init__(self, source: Path | None = None, origin: SourceMap | None = None):
+        self.source = source
+        self.origin = origin
+        self._segments: list[str | tuple[str, int, int]] = []
+        self._length = 0
+
+    def append(self, string: str) -> None:
+        if string:
+            self._segments.append(string)
+            self._length += len(string)
+
+    def append_span(self, buffer: str, start: int, end: int) -> None:
+        """ Record buffer[start:end] without copying it """
+        if end > start:
+            self._segments.append((buffer, start, end))
+            self._length += end - start
+
+    def extend(self, other: "TrackedTextBuilder") -> None:
+        """ Append all segments recorded by other, segments are shared not copied """
+        self._segments.extend(other._segments)
+        self._length += other._length
+
+    def build(self) -> TrackedText:
+        if self.origin is None:
+            string = "".join(segment if isinstance(segment, str) else segment[0][segment[1]:segment[2]] for segment in self._segments)
+            return TrackedText(string, source=self.source)
+
+        # Record (new offset, offset in origin's buffer, length) of every span, the origin is derived from these
+        pieces: list[str] = []
+        positions, offsets, lengths = array("q"), array("q"), array("q")
+        position = 0
+        for segment in self._segments:
+            if isinstance(segment, str):
+                pieces.append(segment)
+                position += len(segment)
+                continue
+            buffer, start, end = segment
+            pieces.append(buffer[start:end])
+            positions.append(position)
+            offsets.append(start)
+            lengths.append(end - start)
+            position += end - start
+        return TrackedText("".join(pieces), source=self.source, origin=self.origin.derive((positions, offsets, lengths)))
+
+    def __len__(self) -> int:
+        return self._length
+
+
+_NON_WHITESPACE = re.compile(r"\S+")
@@ -0,0 +1,191 @@
+from array import array
+from bisect import bisect_right
+from dataclasses import dataclass
+from typing import Iterator
+
+import numpy as np
+
+
+@dataclass(frozen=True)
+class SourceRange:
+    """(line, column) range in a source file, lines and columns are 1 indexed. end is the position of the last character"""
+    start_line: int
+    start_column: int
+    end_line: int
+    end_column: int
+
+    def __str__(self) -> str:
+        return f"{self.start_line}:{self.start_column}-{self.end_line}:{self.end_column}"
+
+
+class SourceMap:
+    """Maps offsets of a buffer back to (line, column) positions in the file it was derived from.
+
+    The line start offsets of the file are computed once. A buffer derived from the file (e.g., with comments removed)
+    keeps the same line starts and a list of segments (buffer offset, file offset, length) copied from the file, text
+    inserted in between (e.g., an expanded macro) maps to the end of the preceding segment. Segments of a derived map
+    are only composed with its parent's on the first lookup. Lookups bisect both tables, so resolving a position costs O(log n).
+
+    Usage:
+        source_map = SourceMap.from_text(file_contents)
+        line, column = source_map.line_column(offset)
+    """
+    def __init__(self,
+                 line_starts: array,
+                 segments: tuple[array, array, array] | None = None,
+                 first_line: int = 1,
+                 parent: "SourceMap | None" = None
+                 ):
+        """
+        -- Params --
+        line_starts: sorted file offsets at which a line starts, line_starts[0] == 0
+        segments: (buffer offsets, file offsets, lengths) of the copied segments sorted by buffer offset, None if the
+                  buffer is the file itself
+        first_line: line number of the first line, for buffers holding part of a file
+        parent: when given, segments map to offsets of the parent's buffer instead of the file
+        """
+        self.line_starts = line_starts
+        self._segments = segments
+        self._parent = parent
+        self.first_line = first_line
+
+    @classmethod
+    def from_text(cls, text: str, first_line: int = 1) -> "SourceMap":
+        """ Identity map of text, text is either a file or part of a file starting at a line start """
+        return cls(_line_starts(text), first_line=first_line)
+
+    def derive(self, segments: tuple[array, array, array]) -> "SourceMap":
+        """ Map of a buffer built from segments (new buffer offsets, offsets in this map's buffer, lengths) of this map's buffer """
+        return SourceMap(self.line_starts, segments, self.first_line, parent=self)
+
+    @property
+    def segments(self) -> tuple[array, array, array] | None:
+        """ (buffer offsets, file offsets, lengths) of the segments copied from the file, None if the buffer is the file """
+        if self._parent is not None:
+            assert self._segments is not None
+            self._segments = self._parent._compose(self._segments)
+            self._parent = None
+        return self._segments
+
+    def _compose(self, segments: tuple[array, array, array]) -> tuple[array, array, array]:
+        """ Maps segments of this map's buffer to file segments """
+        buffer_offsets, file_offsets, lengths = array("q"), array("q"), array("q")
+        for position, offset, length in zip(*segments):
+            for piece_offset, file_offset, piece_length in self.pieces(offset, offset + length):
+                new_offset = position + piece_offset
+                # Merge with the previous segment when both buffer and file offsets continue it
+                if lengths and buffer_offsets[-1] + lengths[-1] == new_offset and file_offsets[-1] + lengths[-1] == file_offset:
+                    lengths[-1] += piece_length
+                    continue
+                buffer_offsets.append(new_offset)
+                file_offsets.append(file_offset)
+                lengths.append(piece_length)
+        return buffer_offsets, file_offsets, lengths
+
+    def pieces(self, start: int, end: int) -> Iterator[tuple[int, int, int]]:
+        """ Yields (offset relative to start, file offset, length) for the parts of buffer[start:end] copied from the file """
+        if end <= start:
+            return
+        segments = self.segments
+        if segments is None:
+            yield 0, start, end - start
+            return
+        buffer_offsets, file_offsets, lengths = segments
+        index = max(bisect_right(buffer_offsets, start) - 1, 0)
+        while index < len(buffer_offsets) and buffer_offsets[index] < end:
+            segment_start = buffer_offsets[index]
+            segment_end = segment_start + lengths[index]
+            overlap_start, overlap_end = max(start, segment_start), min(end, segment_end)
+            if overlap_start < overlap_end:
+                yield overlap_start - start, file_offsets[index] + overlap_start - segment_start, overlap_end - overlap_start
+            index += 1
+
+    def file_offset(self, offset: int) -> int:
+        """ Offset in the file (or part of the file) of buffer offset """
+        segments = self.segments
+        if segments is None:
+            return offset
+        buffer_offsets, file_offsets, lengths = segments
+        index = bisect_right(buffer_offsets, offset) - 1
+        if index < 0:
+            return file_offsets[0] if file_offsets else 0
+        return file_offsets[index] + min(offset - buffer_offsets[index], lengths[index])
+
+    def line_column(self, offset: int) -> tuple[int, int]:
+        """ (line, column) of buffer offset, both 1 indexed """
+        file_offset = self.file_offset(offset)
+        line = max(bisect_right(self.line_starts, file_offset) - 1, 0)
+        return line + self.first_line, file_offset - self.line_starts[line] + 1
+
+    def location(self, start: int, end: int) -> "SourceLocation":
+        """ Unresolved location of buffer[start:end] """
+        return SourceLocation(self, start, end)
+
+    def __repr__(self) -> str:
+        segments = "identity" if self._segments is None else len(self._segments[0])
+        return f"SourceMap(lines={len(self.line_starts)}, segments={segments}, first_line={self.first_line})"
+
+
+def _line_starts(text: str) -> array:
+    if text.isascii():
+        codes = np.frombuffer(text.encode("ascii"), dtype=np.uint8)
+    else:
+        # utf-32 stores one code point per str index, so array offsets equal string offsets
+        codes = np.frombuffer(text.encode("utf-32-le", errors="surrogatepass"), dtype=np.uint32)
+    starts = np.flatnonzero(codes == ord("\n")).astype(np.int64) + 1
+    line_starts = array("q", [0])
+    line_starts.frombytes(starts.tobytes())
+    return line_starts
+
+
+class SourceLocation:
+    """Location of a span of a buffer, resolved to a SourceRange on first use
+
+    Usage:
+        location = source_map.location(start, end)
+        location.range().start_line
+    """
+    __slots__ = ("_source_map", "_start", "_end", "_range")
+
+    def __init__(self, source_map: SourceMap | None, start: int = 0, end: int = 0, resolved: SourceRange | None = None):
+        self._source_map = source_map
+        self._start = start
+        self._end = end
+        self._range = resolved
+
+    @classmethod
+    def from_range(cls, source_range: SourceRange) -> "SourceLocation":
+        return cls(None, resolved=source_range)
+
+    def range(self) -> SourceRange:
+        if self._range is None:
+            assert self._source_map is not None
+            start_line, start_column = self._source_map.line_column(self._start)
+            end_line, end_column = self._source_map.line_column(max(self._end - 1, self._start))
+            self._range = SourceRange(start_line, start_column, end_line, end_column)
+            self._source_map = None # resolved, the map is no longer needed
+        return self._range
+
+    @property
+    def line(self) -> int:
+        return self.range().start_line
+
+    @property
+    def column(self) -> int:
+        return self.range().start_column
+
+    def __getstate__(self):
+        return (self._source_map, self._start, self._end, self._range)
+
+    def __setstate__(self, state) -> None:
+        self._source_map, self._start, self._end, self._range = state
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, SourceLocation):
+            return NotImplemented
+        return self.range() == other.range()
+
+    def __repr__(self) -> str:
+        if self._range is None:
+            return f"SourceLocation(start={self._start}, end={self._end}, unresolved)"
+        return f"SourceLocation({self._range})"
@@ -1,11 +1,19 @@
+from ..models import TrackedTextView
 from .compiler import CompileOptions, compile_source, open_pdf
 from .flashcard_compiler import FlashcardCompiler
+from .extraction_cache import ExtractionCache
+from .mapped_source import MappedSource
+from .instrumentation import PipelineInstrumentation, StageRecord
 from .parse import get_header_footer
 from .course_repo import CourseRepository
+from .include_graph import DocumentGenerator, IncludeGraph
+from .flashcard_index import FlashcardIndexer, IndexStats, card_record
 from .filesystem import open_cmd, open_file_with_editor
 from .note_repo import NotesRepository
 from .pipeline import (MainSectionFinder, ProcessingPipeline, FlashcardBuilderStage,
-                       CleanStage, DataGenerator, TrackedText)
+                       CleanStage, CleanBuildStage, CompileStage, DataGenerator, DeduplicateStage, LazyFlashcardStage,
+                       TrackedText)
+from .typst_query import TypstQueryStage
 
 
 __all__ = [
@@ -14,6 +22,15 @@ __all__ = [
         "get_header_footer",
         "CourseRepository",
         "FlashcardCompiler",
+        "ExtractionCache",
+        "FlashcardIndexer",
+        "DocumentGenerator",
+        "IncludeGraph",
+        "IndexStats",
+        "card_record",
+        "MappedSource",
+        "PipelineInstrumentation",
+        "StageRecord",
         "open_cmd",
         "open_file_with_editor",
         "open_pdf",
@@ -21,7 +38,13 @@ __all__ = [
         "ProcessingPipeline",
         "FlashcardBuilderStage",
         "CleanStage",
+        "CleanBuildStage",
+        "CompileStage",
+        "DeduplicateStage",
+        "LazyFlashcardStage",
+        "TypstQueryStage",
         "DataGenerator",
         "TrackedText",
+        "TrackedTextView",
         "NotesRepository"
         ]
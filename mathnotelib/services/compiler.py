@@ -138,6 +138,24 @@ def compile_latex_to_pdf(filepath: Path, options: CompileOptions, verbose_err_ms
         error_msg += f"\nLatexmk cmd stdour: {result.stderr.decode("utf-8", errors="replace")}"
     return (result.returncode, error_msg, result.stdout.decode("utf-8"))
 
+def can_split_pdf() -> bool:
+    return shutil.which("pdfseparate") is not None
+
+def split_pdf(pdf_path: Path, output_dir: Path) -> list[Path] | None:
+    """ Writes each page of pdf_path to its own pdf in output_dir (pdfseparate, from poppler). Returns the page files in
+    order, None if pdfseparate is not installed or fails """
+    if not can_split_pdf():
+        return None
+    result = subprocess.run(
+        ["pdfseparate", str(pdf_path), str(output_dir / f"{pdf_path.stem}-page-%d.pdf")],
+        stdout = subprocess.PIPE,
+        stderr = subprocess.PIPE,
+        )
+    if result.returncode != 0:
+        return None
+    pages = output_dir.glob(f"{pdf_path.stem}-page-*.pdf")
+    return sorted(pages, key=lambda page: int(page.stem.rsplit("-", 1)[1]))
+
 def compile_latex(filepath: Path, options: CompileOptions):
     svg_cmd = ["pdf2svg",
                f"{options.resolved_output_dir() / options.resolved_output_file_stem()}.pdf",
@@ -0,0 +1,126 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable
+import logging
+
+import numpy as np
+
+logger = logging.getLogger("mathnote")
+
+
+@dataclass(frozen=True)
+class UnbalancedDelimiter:
+    """Location of a delimiter without a partner, line and column are 1 indexed"""
+    char: str
+    offset: int
+    line: int
+    column: int
+    source: Path | None = None
+
+    def __str__(self) -> str:
+        return f"{self.source}:{self.line}:{self.column}: unbalanced '{self.char}'"
+
+
+class DelimiterIndex:
+    """Matching delimiter table for a buffer, built once in a single vectorized pass. Each delimiter pair (e.g., '{}')
+    is matched independently of the others.
+
+    For every pair the delimiters are located with NumPy, the nesting depth is the cumulative sum of +1 (open) / -1 (close),
+    and an opening delimiter is matched with the next closing delimiter at the same depth. This gives the same result as
+    counting from the opening delimiter until the depth returns to zero.
+
+    Usage:
+        index = DelimiterIndex(buffer, [("{", "}")])
+        end = index.closing(start) # buffer[end] closes buffer[start], None if unmatched
+    """
+    def __init__(self,
+                 buffer: str,
+                 pairs: Iterable[tuple[str, str]],
+                 exclude: Iterable[tuple[int, int]] = (),
+                 source: Path | None = None
+                 ):
+        """
+        -- Params --
+        buffer: text to index, offsets used by this class are offsets into buffer
+        pairs: (opening delimiter, closing delimiter) for each pair to match
+        exclude: (start, end) spans whose delimiters are ignored, e.g., comments
+        source: file buffer was read from, used when reporting unbalanced delimiters
+        """
+        self.buffer = buffer
+        self.source = source
+        self._closing: dict[int, int] = {}
+        self._unbalanced: list[tuple[int, str]] = []
+
+        if not buffer:
+            return
+        # utf-32 stores one code point per str index, so array offsets equal string offsets
+        codes = np.frombuffer(buffer.encode("utf-32-le", errors="surrogatepass"), dtype=np.uint32)
+        excluded = self._exclusion_mask(len(buffer), exclude)
+        for open_delim, close_delim in dict.fromkeys(pairs):
+            if open_delim and close_delim:
+                self._match_pair(codes, excluded, open_delim, close_delim)
+        self._unbalanced.sort()
+
+    @staticmethod
+    def _exclusion_mask(length: int, exclude: Iterable[tuple[int, int]]) -> np.ndarray | None:
+        spans = np.array(list(exclude), dtype=np.int64).reshape(-1, 2)
+        if spans.size == 0:
+            return None
+        boundaries = np.zeros(length + 1, dtype=np.int64)
+        np.add.at(boundaries, np.clip(spans[:, 0], 0, length), 1)
+        np.add.at(boundaries, np.clip(spans[:, 1], 0, length), -1)
+        return np.cumsum(boundaries[:-1]) > 0
+
+    def _match_pair(self, codes: np.ndarray, excluded: np.ndarray | None, open_delim: str, close_delim: str) -> None:
+        opens = codes == ord(open_delim)
+        closes = codes == ord(close_delim)
+        if excluded is not None:
+            opens &= ~excluded
+            closes &= ~excluded
+
+        positions = np.flatnonzero(opens | closes)
+        if positions.size == 0:
+            return
+        is_open = opens[positions]
+        depth = np.cumsum(np.where(is_open, 1, -1))
+        # Depth after an opening delimiter equals depth before its closing delimiter
+        level = depth + (~is_open).astype(np.int64)
+
+        order = np.lexsort((positions, level))
+        positions, is_open, level = positions[order], is_open[order], level[order]
+        matched = is_open[:-1] & ~is_open[1:] & (level[:-1] == level[1:])
+        open_positions, close_positions = positions[:-1][matched], positions[1:][matched]
+        self._closing.update(zip(open_positions.tolist(), close_positions.tolist()))
+
+        paired = np.zeros(positions.size, dtype=bool)
+        paired[:-1] |= matched
+        paired[1:] |= matched
+        for offset, opening in zip(positions[~paired].tolist(), is_open[~paired].tolist()):
+            self._unbalanced.append((offset, open_delim if opening else close_delim))
+
+    def closing(self, index: int) -> int | None:
+        """ Returns offset of delimiter closing buffer[index], None if buffer[index] is not a matched opening delimiter """
+        return self._closing.get(index)
+
+    def unbalanced(self) -> list[UnbalancedDelimiter]:
+        """ Returns all delimiters without a partner, in order of appearance """
+        if not self._unbalanced:
+            return []
+        offsets = np.array([offset for (offset, _) in self._unbalanced], dtype=np.int64)
+        newlines = np.flatnonzero(np.frombuffer(self.buffer.encode("utf-32-le", errors="surrogatepass"), dtype=np.uint32) == ord("\n"))
+        lines = np.searchsorted(newlines, offsets)
+        line_starts = np.where(lines > 0, newlines[np.maximum(lines - 1, 0)] + 1, 0) if newlines.size else np.zeros_like(offsets)
+        return [
+                UnbalancedDelimiter(char, offset, int(line) + 1, int(offset - line_start) + 1, self.source)
+                for (offset, char), line, line_start in zip(self._unbalanced, lines, line_starts)
+                ]
+
+    def log_unbalanced(self) -> None:
+        for delimiter in self.unbalanced():
+            logger.warning(f"Skipping unbalanced delimiter {delimiter}")
+
+    def __len__(self) -> int:
+        return len(self._closing)
+
+    def __repr__(self) -> str:
+        return f"DelimiterIndex(source={self.source}, matched={len(self._closing)}, unbalanced={len(self._unbalanced)})"
@@ -0,0 +1,117 @@
+from dataclasses import astuple
+from pathlib import Path
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from ..models import Flashcard, Section, SourceChunk, SourceLocation, SourceRange, TrackedText
+
+
+logger = logging.getLogger("mathnote")
+
+
+class ExtractionCache:
+    """Persistent cache of the flashcards extracted from each file.
+
+    Entries are stored as one json file per source file. An entry is only used when its key matches, the key is built from
+    the file contents and a fingerprint of the pipeline configuration (macros, section names, ...), so editing a lecture or
+    the configuration invalidates the entry.
+
+    Usage:
+        cache = ExtractionCache(CONFIG.cache_dir() / "extraction")
+        flashcards = cache.get(text, fingerprint)
+        if flashcards is None:
+            flashcards = ...
+            cache.put(text, fingerprint, flashcards)
+    """
+    # Bump when the entry format, or the output of the pipeline for the same input, changes
+    version = 4
+
+    def __init__(self, cache_dir: Path):
+        self.cache_root = cache_dir
+        self.cache_root.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(*parts: object) -> str:
+        """ Stable hash of json serializable parts, used to fingerprint pipeline configuration """
+        data = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def key(self, text: TrackedText, fingerprint: str) -> str:
+        digest = hashlib.sha256(text.encode(errors="surrogatepass"))
+        digest.update(f"{self.version}:{fingerprint}".encode('utf-8'))
+        return digest.hexdigest()
+
+    def _entry_path(self, text: TrackedText) -> Path:
+        # Each chunk of a file read in chunks gets its own entry
+        location = f"{text.source}:{text.offset}" if isinstance(text, SourceChunk) else str(text.source)
+        name = hashlib.sha256(location.encode('utf-8')).hexdigest()[:16]
+        return self.cache_root / f"{name}.json"
+
+    def get(self, text: TrackedText, fingerprint: str) -> list[Flashcard] | None:
+        """ Returns flashcards extracted from text, None if text has not been cached with the same fingerprint """
+        entry_path = self._entry_path(text)
+        try:
+            with entry_path.open("r", encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if entry.get("key") != self.key(text, fingerprint):
+            return None
+        try:
+            return [self._load_flashcard(card, text.source) for card in entry["flashcards"]]
+        except (KeyError, TypeError) as e:
+            logger.warning(f"Ignoring invalid extraction cache entry {entry_path}: {e}")
+            return None
+
+    def put(self, text: TrackedText, fingerprint: str, flashcards: list[Flashcard]) -> None:
+        entry = {
+                "key": self.key(text, fingerprint),
+                "source": str(text.source),
+                "flashcards": [self._dump_flashcard(card) for card in flashcards]
+                }
+        entry_path = self._entry_path(text)
+        # Write then rename, so concurrent readers never see a partial entry
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_root, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, entry_path)
+        except OSError as e:
+            logger.warning(f"Failed to write extraction cache entry {entry_path}: {e}")
+
+    def clear(self) -> None:
+        for entry_path in self.cache_root.glob("*.json"):
+            entry_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def _dump_section(section: Section) -> dict:
+        return {
+                "name": section.name,
+                "content": str(section.content),
+                "title": None if section.title is None else str(section.title),
+                "location": None if section.location is None else astuple(section.location.range())
+                }
+
+    @staticmethod
+    def _load_section(data: dict, source: Path | None) -> Section:
+        title = None if data["title"] is None else TrackedText(data["title"], source=source)
+        location = data.get("location")
+        location = None if location is None else SourceLocation.from_range(SourceRange(*location))
+        return Section(data["name"], TrackedText(data["content"], source=source), title=title, location=location)
+
+    def _dump_flashcard(self, card: Flashcard) -> dict:
+        return {
+                "main_section": self._dump_section(card.main_section),
+                "proof_section": None if card.proof_section is None else self._dump_section(card.proof_section)
+                }
+
+    def _load_flashcard(self, data: dict, source: Path | None) -> Flashcard:
+        proof = None if data["proof_section"] is None else self._load_section(data["proof_section"], source)
+        return Flashcard(self._load_section(data["main_section"], source), proof)
+
+    def __repr__(self) -> str:
+        return f"ExtractionCache(cache_dir={self.cache_root!r})"
@@ -16,7 +16,8 @@ def open_cmd() -> str:
         cmd = "start"
     return cmd
 
-def open_file_with_editor(filename: str) -> None:
+def open_file_with_editor(filename: str, line: int | None = None) -> None:
+    """ Opens filename with CONFIG.editor in a new iterm2 window, at line if given (vim and nvim both accept +line) """
     import iterm2
 
     async def _main(connection, filename: str):
@@ -28,7 +29,8 @@ def open_file_with_editor(filename: str) -> None:
         session = tab.sessions[0]
 
         await new_window.async_set_frame(iterm2.Frame(iterm2.Point(500, 500), iterm2.Size(1000, 1000)))
-        await session.async_send_text(f"{CONFIG.editor} {filename}\n")
+        line_arg = "" if line is None else f"+{line} "
+        await session.async_send_text(f"{CONFIG.editor} {line_arg}{filename}\n")
 
     main = partial(_main, filename=filename)
     iterm2.run_until_complete(main)
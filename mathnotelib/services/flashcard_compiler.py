@@ -2,12 +2,15 @@ from pathlib import Path
 import logging
 from typing import OrderedDict
 import hashlib
+import shutil
 import tempfile
 
 from ..models import SourceFile
 
-from .compiler import CompileOptions, compile_source
+from .compiler import CompileOptions, can_split_pdf, compile_latex_to_pdf, compile_source, split_pdf
+from ..config import CONFIG
 from ..models import TrackedText, Flashcard
+from ..models.macros import requires_package
 from .._enums import FileType, OutputFormat
 
 
@@ -15,26 +18,43 @@ logger = logging.getLogger(__name__)
 
 
 # TODO make package dynamic
+LATEX_PACKAGES = r"""\usepackage{amsmath,amsfonts,amsthm,amssymb,mathtools}
+\usepackage{mathrsfs}"""
+
 def latex_template(tex: str) -> str:
     """ Flashcard contents are compiled with the following template """
     return fr"""
 \documentclass[preview, border=0.1in]{{standalone}}
-\usepackage{{amsmath,amsfonts,amsthm,amssymb,mathtools}}
-\usepackage{{mathrsfs}}
+{LATEX_PACKAGES}
 
 \begin{{document}}
 {tex}
 \end{{document}}"""
 
+def latex_batch_template(fragments: list[str]) -> str:
+    """ Same as latex_template with one page per fragment, in order. Counters are reset on each page so equations are
+    numbered as when the fragment is compiled on its own """
+    pages = "\n".join(f"\\begin{{flashcardpage}}\n{tex}\n\\end{{flashcardpage}}" for tex in fragments)
+    return fr"""
+\documentclass[preview, border=0.1in, multi=flashcardpage]{{standalone}}
+{LATEX_PACKAGES}
+\newenvironment{{flashcardpage}}{{\setcounter{{equation}}{{0}}\setcounter{{footnote}}{{0}}}}{{}}
+
+\begin{{document}}
+{pages}
+\end{{document}}"""
+
 # TODO make package dynamic
-def typst_template(typ: str, packages: list[dict[str, list[str]]] | None = None) -> str:
+def typst_template(typ: str, packages: list[dict[str, list[str]]] | None = None, import_notes: bool = True) -> str:
+    """ import_notes: import the notes package, only needed when typ uses macros CleanStage could not inline """
+    notes_import = '#import "@local/notes:1.0.0": *' if import_notes else ""
     return fr"""
 #set page(
         width: 14cm,
         height: auto,
         margin: 5pt
         )
-#import "@local/notes:1.0.0": *
+{notes_import}
 
 {typ}
 """
@@ -93,6 +113,14 @@ class FlashcardCache:
         cache_paths_sorted = OrderedDict(sorted(cache_paths.items(), key=lambda item_pair: item_pair[1].stat().st_mtime, reverse=True))
         return cache_paths_sorted
 
+    def add(self, markdown: str, pdf_path: Path) -> Path:
+        """ Moves pdf_path into the cache as the pdf of markdown, returns its new path. Unlike setting an item, never
+        removes older files, they may still be shown """
+        key = self.hash_markdown(markdown)
+        path = Path(shutil.move(pdf_path, self.cache_pdf / f"{key}.pdf")).resolve()
+        self.update({key: path})
+        return path
+
     def keys(self):
         """Return cache keys."""
         return self._cache.keys()
@@ -122,7 +150,8 @@ class FlashcardCache:
         cache = dict()
         for file in self.cache_pdf.iterdir():
             if file.is_file():
-                cache[file.name] = file
+                # Same key as get, i.e., the hash without extension
+                cache[file.stem] = file
         return cache
 
     def __eq__(self, other) -> bool:
@@ -182,8 +211,23 @@ class FlashcardCache:
 # Currently packages to be used in compilation are specified in format callable. It might be worth making this more dynamic
 # Need to add typst template callable
 class FlashcardCompiler:
-    def __init__(self, cache: FlashcardCache):
+    def __init__(self, cache: FlashcardCache, typst_macros: dict[str, dict] | None = None, batch_size: int = 8):
+        """
+        -- Params --
+        cache: compiled pdf cache
+        typst_macros: Typst macros, see Config.macros. Cards only import the notes package when they use a macro that
+                      is not inlined. Loaded from CONFIG when not given
+        batch_size: number of LaTeX fragments compiled in one document by compile_batch, 1 disables batching
+        """
         self.cache = cache
+        self._typst_macros = typst_macros
+        self.batch_size = batch_size
+
+    @property
+    def typst_macros(self) -> dict[str, dict]:
+        if self._typst_macros is None:
+            self._typst_macros = CONFIG.macros()[FileType.Typst]
+        return self._typst_macros
 
     def compile_card(self, card: Flashcard) -> None:
         """ Attemps to compile flashcard question/answer latex. If compilation fails """
@@ -194,14 +238,83 @@ class FlashcardCompiler:
         if card.proof_section is not None:
             card.proof_section.pdf_path = self._compile_tracked_text(card.proof_section.content)
 
+    def compile_batch(self, cards: list[Flashcard]) -> None:
+        """ Compiles the LaTeX titles, contents and proofs of cards that are not cached yet, batch_size per latexmk run,
+        and adds each fragment's pdf to the cache, so compile_card then loads them from the cache. A fragment that fails
+        in a batch is left to compile_card, which compiles it on its own. Does nothing when pdfseparate is not installed
+
+        Usage:
+            compiler.compile_batch(cards)
+            for card in cards:
+                compiler.compile_card(card)
+        """
+        if self.batch_size < 2 or not can_split_pdf():
+            return
+        fragments: dict[str, None] = {} # ordered set of the fragments to compile
+        for card in cards:
+            sections = [card.main_section] if card.proof_section is None else [card.main_section, card.proof_section]
+            for text in [card.main_section.title] + [section.content for section in sections]:
+                if text is None or text.filetype() != FileType.LaTeX:
+                    continue
+                string = str(text)
+                if string.strip() and self.cache.get(string) is None:
+                    fragments[string] = None
+        fragments_list = list(fragments)
+        for i in range(0, len(fragments_list), self.batch_size):
+            self._compile_latex_batch(fragments_list[i:i + self.batch_size])
+
+    def _compile_latex_batch(self, fragments: list[str], failing: bool = False) -> bool:
+        """ Compiles fragments as one document and caches each page. Returns False if compilation failed.
+
+        A failing batch is split in halves down to pairs, whose fragments are left to compile_card. When the first half
+        compiles the second one is known to fail, it is split without being compiled. One failing fragment in a batch of
+        8 costs 3 to 5 latexmk runs before compile_card compiles the pair it is in.
+
+        -- Params --
+        failing: fragments are known to fail together, they are only split
+        """
+        if len(fragments) < 2:
+            return False
+        if not failing and self._compile_pages(fragments):
+            return True
+        if len(fragments) > 2:
+            half = len(fragments) // 2
+            first_compiled = self._compile_latex_batch(fragments[:half])
+            self._compile_latex_batch(fragments[half:], failing=first_compiled)
+        return False
+
+    def _compile_pages(self, fragments: list[str]) -> bool:
+        """ Compiles fragments with latex_batch_template and caches each page. Returns False if compilation failed """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source_file_path = Path(tmpdir) / "batch.tex"
+            source_file_path.write_text(latex_batch_template(fragments), encoding='utf-8')
+            options = CompileOptions(source_file_path, OutputFormat.PDF)
+            return_code, error_msg, _ = compile_latex_to_pdf(source_file_path, options)
+            pdf_file_path = options.resolved_output_path()
+            if return_code != 0 or not pdf_file_path.is_file():
+                logger.debug(f"Batch of {len(fragments)} fragments failed to compile: {error_msg}")
+                return False
+
+            pages = split_pdf(pdf_file_path, Path(tmpdir))
+            if pages is None or len(pages) != len(fragments):
+                # Compiled, but pages can not be matched to fragments, splitting would not help. compile_card compiles them
+                logger.warning(f"Could not split batch of {len(fragments)} fragments into pages "
+                               f"({'pdfseparate failed' if pages is None else f'{len(pages)} pages'})")
+                return True
+            for fragment, page in zip(fragments, pages):
+                self.cache.add(fragment, page)
+            logger.info(f"Successfully generated {len(pages)} pdfs")
+            return True
+
     def _compile_tracked_text(self, text: TrackedText) -> Path | None:
         source = text.source
         ext = text.filetype().extension
+        string = str(text)
         if text.filetype() == FileType.LaTeX:
             template_func = latex_template
         else:
-            template_func = typst_template
-        string = str(text)
+            import_notes = requires_package(string, self.typst_macros)
+            template_func = lambda typ: typst_template(typ, import_notes=import_notes)
 
 
         if (file := self.cache.get(string)):
@@ -223,7 +336,7 @@ class FlashcardCompiler:
                     return None
 
             logger.info(f"Successfully generated pdf")
-            new_path = pdf_file_path.rename(self.cache.cache_pdf / f"{self.cache.hash_markdown(string)}.pdf").resolve()
+            new_path = self.cache.add(string, pdf_file_path)
         return new_path
 
 
@@ -0,0 +1,224 @@
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, TextIO
+import json
+import logging
+import os
+import time
+
+from .._enums import ExtractionBackend
+from ..config import Config
+from ..models import Course, Flashcard, Section, TrackedText
+from .course_repo import CourseRepository
+from .extraction_cache import ExtractionCache
+from .include_graph import DocumentGenerator, IncludeGraph
+from .pipeline import (CleanBuildStage, CleanStage, DataGenerator, DeduplicateStage, FlashcardBuilderStage, LazyFlashcardStage,
+                       ProcessingPipeline)
+from .typst_query import TypstQueryStage
+
+logger = logging.getLogger("mathnote")
+
+# Sections that may be followed by a proof, same as FlashcardSession.load_flashcards
+PROOF_PARENTS = ["THEOREM", "PROPOSITION", "LEMMA", "COROLLARY"]
+
+
+@dataclass
+class IndexStats:
+    """Totals of a FlashcardIndexer run
+
+    Attributes:
+        files: number of lecture files read
+        bytes: size of the lecture files in bytes
+        cards: number of flashcards written
+        duplicates: number of flashcards merged into an earlier one, see DeduplicateStage
+        wall_time: elapsed seconds
+    """
+    files: int = 0
+    bytes: int = 0
+    cards: int = 0
+    duplicates: int = 0
+    wall_time: float = 0.0
+
+    def __str__(self) -> str:
+        rate = self.cards / self.wall_time if self.wall_time else 0.0
+        duplicates = f" ({self.duplicates} duplicates merged)" if self.duplicates else ""
+        return (f"Indexed {self.cards} flashcards{duplicates} from {self.files} files ({self.bytes / 1e6:.2f} MB) "
+                f"in {self.wall_time:.2f}s ({rate:.0f} cards/s)")
+
+
+class FlashcardIndexer:
+    """Extracts the flashcards of every lecture of the courses in a CourseRepository without a gui, e.g., to export cards
+    to other tools or to fill the extraction cache. Each flashcard is written as one json object per line, see card_record.
+
+    Usage:
+        indexer = FlashcardIndexer(CONFIG, workers=4)
+        stats = indexer.write(sys.stdout)
+    """
+    def __init__(self,
+                 config: Config,
+                 section_names: list[str] | None = None,
+                 workers: int | None = None,
+                 cache: ExtractionCache | None = None,
+                 includes: IncludeGraph | None = None,
+                 dedup: bool = False,
+                 backend: ExtractionBackend = ExtractionBackend.Staged,
+                 chunk_size: int | None = None
+                 ):
+        """
+        -- Params --
+        config: project configuration, provides courses, macros and section names
+        section_names: sections extracted, defaults to every section in config.section_names
+        workers: number of worker processes, defaults to os.cpu_count(). Files are parsed in this process when workers <= 1
+        cache: when set, unchanged files are loaded from the extraction cache and new results are added to it
+        includes: when set, each course is read from its main file following includes (see DocumentGenerator), so
+                  sections in the main file and in included files are indexed. Otherwise only lectures are read
+        dedup: merge flashcards with the same content (see DeduplicateStage), each record then lists the duplicates
+        backend: stages extracting the flashcards, CleanStage then FlashcardBuilderStage by default, CleanBuildStage, or
+                 TypstQueryStage for Typst lectures
+        chunk_size: lectures larger than chunk_size bytes are read in chunks of roughly chunk_size bytes (see DataGenerator),
+                    so workers share the sections of a large file. Ignored with includes
+        """
+        self.config = config
+        self.section_names = section_names if section_names is not None else list(config.section_names)
+        if (unknown := set(self.section_names) - config.section_names.keys()):
+            raise ValueError(f"Unknown section(s): {', '.join(sorted(unknown))}")
+        self.workers = workers or os.cpu_count() or 1
+        self.cache = cache
+        self.includes = includes
+        self.dedup = dedup
+        self.backend = backend
+        self.chunk_size = chunk_size
+
+    def courses(self, course_names: Iterable[str] | None = None) -> dict[str, Course]:
+        """ All courses, or only those in course_names, by name """
+        courses = CourseRepository(self.config).courses(sort=True)
+        if course_names is not None:
+            names = set(course_names)
+            if (missing := names - courses.keys()):
+                raise ValueError(f"Unknown course(s): {', '.join(sorted(missing))}")
+            courses = {name: course for name, course in courses.items() if name in names}
+        return courses
+
+    def lectures(self, course_names: Iterable[str] | None = None, weeks: Iterable[int] | None = None) -> dict[Path, str]:
+        """ Maps the path of every lecture to its course name, for all courses or only those in course_names, and all
+        lectures or only those of weeks (see Course.lectures_in_weeks) """
+        return {lecture.path: name for name, course in self.courses(course_names).items() for lecture in course.lectures_in_weeks(weeks)}
+
+    def data(self, courses: dict[str, Course], weeks: Iterable[int] | None = None) -> Iterable[TrackedText | None]:
+        """ Chunks to index: the lectures of weeks, or when includes is set the main file of every course with the files it
+        includes, lectures outside of weeks excluded and lectures that are not included appended """
+        selected = [lecture.path for course in courses.values() for lecture in course.lectures_in_weeks(weeks)]
+        if self.includes is None:
+            return DataGenerator(selected, chunk_size=self.chunk_size)
+        excluded = {lecture.path for course in courses.values() for lecture in course.lectures} - set(selected)
+        main_paths = [course.main_file.path for course in courses.values() if course.main_file.path.is_file()]
+        return DocumentGenerator(main_paths, extra=selected, exclude=excluded, graph=self.includes)
+
+    def pipeline(self, data_iterable: Iterable[TrackedText | None]) -> ProcessingPipeline:
+        build_stage = FlashcardBuilderStage(self.section_names)
+        build_stage.add_subsection_finder("PROOF", PROOF_PARENTS)
+        clean_stage = CleanStage(self.config.macros(), self.config.macro_matchers())
+        pipeline = ProcessingPipeline(data_iterable, cache=self.cache)
+        # Cards are written as soon as they are found, worker processes return the cards of a whole file
+        if self.backend == ExtractionBackend.Fused:
+            pipeline.add_stage(LazyFlashcardStage(CleanBuildStage(clean_stage, build_stage)))
+        elif self.backend == ExtractionBackend.TypstQuery:
+            # Typst files are queried whole, imports are resolved from the root directory (e.g., Preambles/Typst)
+            query_stage = TypstQueryStage(self.section_names, root=self.config.root_path, fallback=[clean_stage, build_stage])
+            query_stage.add_subsection("PROOF", PROOF_PARENTS)
+            pipeline.add_stage(query_stage)
+        else:
+            pipeline.add_stage(clean_stage)
+            pipeline.add_stage(LazyFlashcardStage(build_stage))
+        if self.dedup:
+            # Runs in this process, after the worker processes
+            pipeline.add_stage(DeduplicateStage())
+        return pipeline
+
+    def records(self,
+                course_names: Iterable[str] | None = None,
+                stats: IndexStats | None = None,
+                weeks: Iterable[int] | None = None
+                ) -> Iterator[dict]:
+        """ Yields card_record of every flashcard, in document order. Totals are added to stats when given. With dedup,
+        records are only yielded once every file has been read, copies found later are merged into earlier cards """
+        courses = self.courses(course_names)
+        logger.info(f"Indexing flashcards from {len(courses)} courses with {self.workers} workers")
+        course_paths = {course.path.resolve(): name for name, course in courses.items()}
+
+        pipeline = self.pipeline(_counted(self.data(courses, weeks), stats))
+        results = pipeline.parallel(self.workers) if self.workers > 1 else iter(pipeline)
+        cards: Iterable[Flashcard] = (card for flashcards in results for card in flashcards)
+        dedup_stage = next((stage for stage in pipeline.stages if isinstance(stage, DeduplicateStage)), None)
+        if dedup_stage is not None:
+            cards = list(cards)
+            if stats is not None:
+                stats.duplicates = dedup_stage.merged
+        for card in cards:
+            source = card.main_section.content.source
+            if stats is not None:
+                stats.cards += 1
+            yield card_record(card, None if source is None else _course_of(source, course_paths))
+
+    def write(self, output: TextIO, course_names: Iterable[str] | None = None, weeks: Iterable[int] | None = None) -> IndexStats:
+        """ Writes one json object per flashcard to output, returns the totals of the run """
+        stats = IndexStats()
+        start = time.perf_counter()
+        for record in self.records(course_names, stats, weeks):
+            output.write(json.dumps(record, ensure_ascii=False))
+            output.write("\n")
+        output.flush()
+        stats.wall_time = time.perf_counter() - start
+        logger.info(str(stats))
+        return stats
+
+    def __repr__(self) -> str:
+        return f"FlashcardIndexer(workers={self.workers}, sections={len(self.section_names)}, cache={self.cache!r}, includes={self.includes!r}, dedup={self.dedup}, backend={self.backend.value}, chunk_size={self.chunk_size})"
+
+
+def _counted(data_iterable: Iterable[TrackedText | None], stats: IndexStats | None) -> Iterator[TrackedText | None]:
+    """ Yields data_iterable, adding the files and bytes read to stats """
+    sources: set[Path] = set()
+    for chunk in data_iterable:
+        if stats is not None and chunk is not None:
+            if chunk.source not in sources and chunk.source is not None:
+                sources.add(chunk.source)
+                stats.files += 1
+            stats.bytes += len(chunk.encode(errors="surrogatepass"))
+        yield chunk
+
+def _course_of(source: Path, course_paths: dict[Path, str]) -> str | None:
+    """ Name of the course directory containing source """
+    for parent in source.resolve().parents:
+        if parent in course_paths:
+            return course_paths[parent]
+    return None
+
+
+def section_record(section: Section) -> dict:
+    """ Json serializable section. location holds the 1 indexed (line, column) range of the section in its source file """
+    return {
+            "section": section.name,
+            "title": None if section.title is None else str(section.title),
+            "content": str(section.content),
+            "location": None if section.location is None else asdict(section.location.range())
+            }
+
+def card_record(card: Flashcard, course: str | None = None) -> dict:
+    """ Json serializable flashcard: course, source path, the main section's fields (see section_record), its proof and
+    the source and location of each duplicate (see DeduplicateStage) """
+    source = card.main_section.content.source
+    return {
+            "course": course,
+            "source": None if source is None else str(source),
+            **section_record(card.main_section),
+            "proof": None if card.proof_section is None else section_record(card.proof_section),
+            "duplicates": [duplicate_record(section) for section in card.duplicates]
+            }
+
+def duplicate_record(section: Section) -> dict:
+    source = section.content.source
+    return {
+            "source": None if source is None else str(source),
+            "location": None if section.location is None else asdict(section.location.range())
+            }
@@ -0,0 +1,264 @@
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Generator, Iterable
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+
+from ..models import LanguageChars, SourceChunk, SourceMap, TrackedText, langauage_char_registry
+from .._enums import FileType
+
+logger = logging.getLogger("mathnote")
+
+
+@dataclass(frozen=True)
+class Include:
+    """Include directive of a file, e.g., '\\input{lectures/lec_01}' or '#include "lectures/lec_01.typ"'
+
+    Attributes:
+        start: text offset of the directive
+        end: text offset one past the directive
+        target: path as written in the directive
+        nested: True when the directive is inside a delimiter pair (e.g., a section), such includes are not followed
+    """
+    start: int
+    end: int
+    target: str
+    nested: bool = False
+
+
+class IncludeGraph:
+    """Include directives of every file reached from a main file. The directives of a file only depend on its contents,
+    they are cached per file, in memory (the max_nodes most recently used files) and, when cache_dir is given, on disk
+    (one entry per file, as ExtractionCache). An entry is only used when the hash of the file contents matches, so editing
+    a file only invalidates its own node, the rest of the graph is reused.
+
+    LaTeX targets are resolved relative to the main file's directory ('.tex' is added when there is no extension), Typst
+    targets relative to the including file, or to the main file's directory when they start with '/'. Comments are
+    excluded the same way CleanStage removes them. LaTeX includes before '\\begin{document}' load the preamble (macros,
+    packages), not notes, and are not followed.
+
+    Usage:
+        graph = IncludeGraph(CONFIG.cache_dir() / "includes")
+        paths = graph.files(course.main_file.path) # main file and every included file, in document order
+        pipeline = ProcessingPipeline(DocumentGenerator([course.main_file.path], graph=graph))
+    """
+    # Bump when the entry format, or the directives found in the same contents, change
+    version = 3
+
+    def __init__(self, cache_dir: Path | None = None, max_nodes: int = 4096):
+        """
+        -- Params --
+        cache_dir: directory of the on disk entries, entries are only kept in memory when None
+        max_nodes: number of files whose directives are kept in memory, least recently used files are evicted first
+        """
+        self.cache_root = cache_dir
+        self.max_nodes = max_nodes
+        self._nodes: OrderedDict[Path, tuple[str, list[Include]]] = OrderedDict() # path -> (key, includes)
+
+    def includes(self, text: str, path: Path) -> list[Include]:
+        """ Include directives of text, the contents of path, in order """
+        filetype = TrackedText("", source=path).filetype()
+        key = hashlib.sha256(f"{filetype.value}:".encode("utf-8") + text.encode("utf-8", errors="surrogatepass")).hexdigest()
+        node = self._nodes.get(path)
+        if node is not None and node[0] == key:
+            self._nodes.move_to_end(path)
+            return node[1]
+        if (includes := self._read(path, key)) is None:
+            includes = _find_includes(text, langauage_char_registry[filetype])
+            self._write(path, key, includes)
+        self._nodes[path] = (key, includes)
+        self._nodes.move_to_end(path)
+        if len(self._nodes) > self.max_nodes:
+            self._nodes.popitem(last=False)
+        return includes
+
+    def resolve(self, include: Include, including: Path, main_path: Path) -> Path:
+        """ Path of the file include refers to """
+        target = Path(include.target)
+        if TrackedText("", source=including).filetype() == FileType.LaTeX:
+            path = main_path.parent / target
+            return path.with_suffix(FileType.LaTeX.extension) if path.suffix == "" else path
+        if include.target.startswith("/"):
+            return main_path.parent / include.target.lstrip("/")
+        return including.parent / target
+
+    def files(self, main_path: Path) -> list[Path]:
+        """ main_path and every file it includes, directly or not, in document order """
+        files: list[Path] = []
+        for text in DocumentGenerator([main_path], graph=self):
+            if text is not None and text.source is not None and text.source not in files:
+                files.append(text.source)
+        return files
+
+    def _entry_path(self, path: Path) -> Path | None:
+        if self.cache_root is None:
+            return None
+        name = hashlib.sha256(str(path).encode('utf-8')).hexdigest()[:16]
+        return self.cache_root / f"{name}.json"
+
+    def _read(self, path: Path, key: str) -> list[Include] | None:
+        entry_path = self._entry_path(path)
+        if entry_path is None:
+            return None
+        try:
+            with entry_path.open("r", encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("version") != self.version or entry.get("key") != key:
+            return None
+        try:
+            return [Include(*include) for include in entry["includes"]]
+        except (KeyError, TypeError) as e:
+            logger.warning(f"Ignoring invalid include graph entry {entry_path}: {e}")
+            return None
+
+    def _write(self, path: Path, key: str, includes: list[Include]) -> None:
+        entry_path = self._entry_path(path)
+        if entry_path is None or self.cache_root is None:
+            return
+        entry = {
+                "version": self.version,
+                "key": key,
+                "source": str(path),
+                "includes": [[include.start, include.end, include.target, include.nested] for include in includes]
+                }
+        # Write then rename, so concurrent readers never see a partial entry
+        try:
+            self.cache_root.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_root, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, entry_path)
+        except OSError as e:
+            logger.warning(f"Failed to write include graph entry {entry_path}: {e}")
+
+    def __repr__(self) -> str:
+        return f"IncludeGraph(cache={self.cache_root}, nodes={len(self._nodes)})"
+
+
+class DocumentGenerator:
+    """ Generates the chunks of main files and of the files they include, in document order, i.e., the text of a file
+    up to an include directive, then the included file, then the rest of the file. Files without includes are generated
+    whole, as DataGenerator does, otherwise each part is a SourceChunk of its file.
+
+    Only includes outside of every delimiter pair are followed, a section is never split. A sub section (e.g., proof)
+    separated from its parent section by an include is not attached to it. Files that can not be read, and include
+    cycles, are logged and skipped.
+
+    Usage:
+        data = DocumentGenerator([course.main_file.path], extra=lecture_paths)
+        pipeline = ProcessingPipeline(data)
+    """
+    def __init__(self,
+                 main_paths: list[Path],
+                 extra: Iterable[Path] = (),
+                 exclude: Iterable[Path] = (),
+                 graph: IncludeGraph | None = None
+                 ) -> None:
+        """
+        -- Params --
+        main_paths: documents to generate
+        extra: files generated whole after the documents when no document includes them, e.g., lectures not included yet
+        exclude: files that are not generated, nor followed when included
+        graph: caches the include directives of each file, a new in memory graph by default
+        """
+        self.main_paths = main_paths
+        self.extra = list(extra)
+        self.exclude = {path.resolve() for path in exclude}
+        self.graph = graph if graph is not None else IncludeGraph()
+
+    def __iter__(self) -> Generator[TrackedText | None, None, None]:
+        seen: set[Path] = set()
+        for main_path in self.main_paths:
+            yield from self._iter_file(main_path, main_path, seen, [])
+        for path in self.extra:
+            if path.resolve() not in seen and path.resolve() not in self.exclude:
+                yield from self._iter_file(path, path, seen, [], follow=False)
+
+    def _iter_file(self, path: Path, main_path: Path, seen: set[Path], stack: list[Path], follow: bool = True) -> Generator[TrackedText | None, None, None]:
+        resolved = path.resolve()
+        if resolved in stack:
+            logger.warning(f"Include cycle: {' -> '.join(str(p) for p in stack + [resolved])}, {path} is skipped")
+            return
+        if resolved in self.exclude:
+            return
+        try:
+            text = path.read_text(encoding='utf-8')
+        except Exception as e:
+            logger.error(f"Failed to read file {path}\n{e}")
+            yield None
+            return
+        seen.add(resolved)
+
+        includes = [include for include in self.graph.includes(text, resolved) if not include.nested] if follow else []
+        origin = SourceMap.from_text(text)
+        if not includes:
+            yield TrackedText(text, source=path, origin=origin)
+            return
+
+        position = 0
+        byte_position = 0
+        for include in includes:
+            if include.start > position:
+                yield _chunk(text, path, origin, position, include.start, byte_position)
+            target = self.graph.resolve(include, path, main_path)
+            if target.is_file():
+                yield from self._iter_file(target, main_path, seen, stack + [resolved])
+            else:
+                logger.warning(f"{path} includes '{include.target}', {target} does not exist and is skipped")
+            byte_position += len(text[position:include.end].encode("utf-8", errors="surrogatepass"))
+            position = include.end
+        if position < len(text):
+            yield _chunk(text, path, origin, position, len(text), byte_position)
+
+    def __repr__(self) -> str:
+        return f"DocumentGenerator(main_paths={self.main_paths}, extra={len(self.extra)}, exclude={len(self.exclude)})"
+
+
+def _chunk(text: str, path: Path, origin: SourceMap, start: int, end: int, byte_offset: int) -> SourceChunk:
+    """ text[start:end] of path, its origin maps it back to path (chunks may start mid line) """
+    chunk_origin = origin.derive((array("q", [0]), array("q", [start]), array("q", [end - start])))
+    return SourceChunk(text[start:end], source=path, offset=start, byte_offset=byte_offset, origin=chunk_origin)
+
+
+def _find_includes(text: str, char_map: LanguageChars) -> list[Include]:
+    pattern = _include_pattern(char_map)
+    if pattern is None:
+        return []
+    opening = {char_map.arg_open_delim, char_map.opt_arg_open_delim}
+    includes: list[Include] = []
+    depth = 0
+    for match in pattern.finditer(text):
+        group = match.lastgroup
+        if group == "document":
+            # Includes of the preamble are not followed
+            includes.clear()
+        elif group == "delim":
+            depth += 1 if match.group("delim") in opening else -1
+            # Stray closing delimiters are reported by the parsers, do not let them hide every later include
+            depth = max(depth, 0)
+        elif group == "target":
+            includes.append(Include(match.start(), match.end(), match.group("target").strip(), depth > 0))
+    return includes
+
+@lru_cache(maxsize=None)
+def _include_pattern(char_map: LanguageChars) -> re.Pattern | None:
+    # Same comment definition as CleanStage
+    if char_map.cmd_prefix == "\\":
+        directive = r"\\(?:input|include)\s*\{(?P<target>[^{}\n]+)\}|(?P<document>\\begin\s*\{document\})"
+    elif char_map.cmd_prefix == "#":
+        directive = r'#include\s+"(?P<target>[^"\n]+)"'
+    else:
+        return None
+    delims = sorted({char_map.arg_open_delim, char_map.arg_close_delim, char_map.opt_arg_open_delim, char_map.opt_arg_close_delim} - {""})
+    return re.compile(
+            fr"(?P<comment>{re.escape(char_map.comment)} [^\n]*\n)|{directive}|(?P<delim>[{''.join(re.escape(d) for d in delims)}])"
+            )
@@ -0,0 +1,227 @@
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator
+import json
+import threading
+import time
+
+from ..models import Flashcard, TrackedText
+
+# Returned by next when an iterator is exhausted, see PipelineInstrumentation._measure_iterator
+_END = object()
+
+
+@dataclass
+class StageRecord:
+    """Measurements of one stage processing one chunk
+
+    Attributes:
+        stage: stage name, 'read' for reading the chunk
+        source: file the chunk was read from
+        wall_time: elapsed seconds
+        cpu_time: cpu seconds used by the thread running the stage
+        bytes_in: utf-8 size of the stage input
+        bytes_out: utf-8 size of the stage output, for flashcards the size of their sections
+        cards: number of flashcards output, None if the stage does not output flashcards
+        error: repr of the exception raised by the stage, None if it succeeded
+        steps: wall time of named steps inside the stage, see Stage.step
+        counters: named event counts of the stage (e.g., duplicates), see Stage.count
+    """
+    stage: str
+    source: str | None
+    wall_time: float = 0.0
+    cpu_time: float = 0.0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    cards: int | None = None
+    error: str | None = None
+    steps: dict[str, float] = field(default_factory=dict)
+    counters: dict[str, int] = field(default_factory=dict)
+
+
+class StepTimer:
+    """Context manager adding the wall time of its block to record.steps[name]"""
+    def __init__(self, record: StageRecord, name: str):
+        self.record = record
+        self.name = name
+        self._start = 0.0
+
+    def __enter__(self) -> "StepTimer":
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        elapsed = time.perf_counter() - self._start
+        self.record.steps[self.name] = self.record.steps.get(self.name, 0.0) + elapsed
+
+
+class PipelineInstrumentation:
+    """Collects a StageRecord per stage per chunk processed by a ProcessingPipeline. Pipelines are only instrumented
+    when an instance is attached with ProcessingPipeline.instrument, otherwise nothing is measured.
+
+    Usage:
+        instrumentation = pipeline.instrument()
+        instrumentation.add_hook(lambda record: ...) # optional, called with each record as it is added
+        for flashcards in pipeline:
+            ...
+        print(instrumentation.summary())
+        instrumentation.dump(path)
+    """
+    def __init__(self) -> None:
+        self.records: list[StageRecord] = []
+        self.hooks: list[Callable[[StageRecord], None]] = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook: Callable[[StageRecord], None]) -> None:
+        self.hooks.append(hook)
+
+    def add(self, record: StageRecord) -> None:
+        with self._lock:
+            self.records.append(record)
+        for hook in self.hooks:
+            hook(record)
+
+    def extend(self, records: Iterable[StageRecord]) -> None:
+        for record in records:
+            self.add(record)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.records.clear()
+
+    def run(self, stage, data: Any, source: Path | None) -> Any:
+        """ Returns stage.process(data), recording its measurements. Exceptions are recorded and re-raised. When the stage
+        returns an iterator (see LazyFlashcardStage), an iterator over the same items is returned, the record then
+        includes producing every item and is added once the iterator is exhausted """
+        record = StageRecord(type(stage).__name__, None if source is None else str(source), bytes_in=data_size(data))
+        output = self._measure(stage, record, stage.process, data)
+        if isinstance(output, Iterator):
+            return self._measure_iterator(stage, record, output)
+        record.bytes_out = data_size(output)
+        record.cards = card_count(output)
+        self.add(record)
+        return output
+
+    def _measure(self, stage, record: StageRecord, func: Callable, *args) -> Any:
+        """ Returns func(*args), adding its wall and cpu time to record. The record is added when func raises """
+        stage._record = record
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            return func(*args)
+        except Exception as e:
+            record.error = repr(e)
+            self.add(record)
+            raise
+        finally:
+            record.wall_time += time.perf_counter() - wall_start
+            record.cpu_time += time.thread_time() - cpu_start
+            stage._record = None
+
+    def _measure_iterator(self, stage, record: StageRecord, iterator: Iterator) -> Iterator:
+        record.cards = 0
+        try:
+            while (item := self._measure(stage, record, next, iterator, _END)) is not _END:
+                if isinstance(item, Flashcard):
+                    record.cards += 1
+                    record.bytes_out += _flashcard_size(item)
+                yield item
+        finally:
+            if record.error is None:
+                self.add(record)
+
+    def read(self, data_iterable: Iterable) -> Iterable:
+        """ Iterates over data_iterable, recording the time taken to read each chunk as a 'read' record """
+        iterator = iter(data_iterable)
+        while True:
+            wall_start, cpu_start = time.perf_counter(), time.thread_time()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            except Exception as e:
+                self.add(StageRecord("read", None, time.perf_counter() - wall_start, time.thread_time() - cpu_start, error=repr(e)))
+                raise
+            source = chunk.source if isinstance(chunk, TrackedText) else None
+            self.add(StageRecord(
+                "read",
+                None if source is None else str(source),
+                time.perf_counter() - wall_start,
+                time.thread_time() - cpu_start,
+                bytes_out=data_size(chunk)
+                ))
+            yield chunk
+
+    def summary_data(self) -> dict[str, dict[str, float | int]]:
+        """ Totals per stage, and per step and counter as 'stage.step' / 'stage.counter', in order of first appearance """
+        totals: dict[str, dict[str, float | int]] = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            total = totals.setdefault(record.stage, {"chunks": 0, "wall_time": 0.0, "cpu_time": 0.0,
+                                                     "bytes_in": 0, "bytes_out": 0, "cards": 0, "errors": 0})
+            total["chunks"] += 1
+            total["wall_time"] += record.wall_time
+            total["cpu_time"] += record.cpu_time
+            total["bytes_in"] += record.bytes_in
+            total["bytes_out"] += record.bytes_out
+            total["cards"] += record.cards or 0
+            total["errors"] += record.error is not None
+            for step, wall_time in record.steps.items():
+                step_total = totals.setdefault(f"{record.stage}.{step}", {"chunks": 0, "wall_time": 0.0})
+                step_total["chunks"] += 1
+                step_total["wall_time"] += wall_time
+            for counter, count in record.counters.items():
+                counter_total = totals.setdefault(f"{record.stage}.{counter}", {"chunks": 0, "count": 0})
+                counter_total["chunks"] += 1
+                counter_total["count"] += count
+        return totals
+
+    def summary(self) -> str:
+        """ Summary table with one row per stage, step and counter """
+        columns = ["chunks", "wall_time", "cpu_time", "bytes_in", "bytes_out", "cards", "errors", "count"]
+        rows = [["stage"] + columns]
+        for name, total in self.summary_data().items():
+            row = [name]
+            for column in columns:
+                value = total.get(column)
+                if value is None:
+                    row.append("")
+                elif isinstance(value, float):
+                    row.append(f"{value:.4f}")
+                else:
+                    row.append(str(value))
+            rows.append(row)
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        lines = ["  ".join(cell.ljust(width) if i == 0 else cell.rjust(width) for i, (cell, width) in enumerate(zip(row, widths)))
+                 for row in rows]
+        lines.insert(1, "-" * len(lines[0]))
+        return "\n".join(lines)
+
+    def to_json(self) -> str:
+        with self._lock:
+            records = [asdict(record) for record in self.records]
+        return json.dumps({"summary": self.summary_data(), "records": records}, indent=2)
+
+    def dump(self, path: Path) -> None:
+        path.write_text(self.to_json(), encoding='utf-8')
+
+    def __repr__(self) -> str:
+        return f"PipelineInstrumentation(records={len(self.records)})"
+
+
+def data_size(data: Any) -> int:
+    """ utf-8 size of a chunk, or of the sections of a list of flashcards """
+    if isinstance(data, TrackedText):
+        return len(str(data).encode('utf-8', errors='surrogatepass'))
+    if isinstance(data, list):
+        return sum(_flashcard_size(card) for card in data if isinstance(card, Flashcard))
+    return 0
+
+def card_count(data: Any) -> int | None:
+    if isinstance(data, list) and all(isinstance(card, Flashcard) for card in data):
+        return len(data)
+    return None
+
+def _flashcard_size(card: Flashcard) -> int:
+    sections = [card.main_section] if card.proof_section is None else [card.main_section, card.proof_section]
+    return sum(data_size(section.content) + (0 if section.title is None else data_size(section.title)) for section in sections)
@@ -0,0 +1,149 @@
+from dataclasses import dataclass
+from enum import Enum, auto
+from functools import lru_cache
+from typing import Callable, Iterable
+import re
+
+from ..models import LanguageChars, TrackedText, langauage_char_registry
+from .delimiters import DelimiterIndex
+
+
+class TokenKind(Enum):
+    COMMAND = auto()
+    OPEN = auto()
+    CLOSE = auto()
+    COMMENT = auto()
+
+
+@dataclass(frozen=True)
+class Token:
+    """Lexical token, offsets index into the tokenized string
+
+    Attributes:
+        kind: token kind
+        start: offset of first character of token
+        end: offset one past the last character of token
+        value: command name (without prefix) for COMMAND tokens, otherwise the matched characters
+    """
+    kind: TokenKind
+    start: int
+    end: int
+    value: str
+
+
+# Command names in LaTeX are letters only, Typst identifiers may also contain digits, '-' and '_'
+_COMMAND_NAME_PATTERNS = {
+        "\\": r"[A-Za-z]*",
+        "#": r"(?:[A-Za-z_][A-Za-z0-9_-]*)?",
+        }
+# Characters that may continue a command name, a command is only matched when the next character is not one of them
+_COMMAND_NAME_CHARS = {
+        "\\": r"[A-Za-z]",
+        "#": r"[A-Za-z0-9_-]",
+        }
+
+
+@lru_cache(maxsize=None)
+def _token_pattern(char_map: LanguageChars) -> re.Pattern:
+    # Comments are defined the same way CleanStage removes them, i.e., comment character followed by a space
+    delims = {char_map.arg_open_delim, char_map.arg_close_delim, char_map.opt_arg_open_delim, char_map.opt_arg_close_delim}
+    name_pattern = _COMMAND_NAME_PATTERNS.get(char_map.cmd_prefix, r"[A-Za-z]*")
+    return re.compile(
+            fr"(?P<comment>{re.escape(char_map.comment)} [^\n]*\n)"
+            fr"|{re.escape(char_map.cmd_prefix)}(?P<command>{name_pattern})"
+            fr"|(?P<delim>[{''.join(re.escape(d) for d in sorted(delims))}])"
+            )
+
+
+@lru_cache(maxsize=None)
+def _command_pattern(char_map: LanguageChars, commands: tuple[str, ...] | None) -> re.Pattern:
+    comment = fr"(?P<comment>{re.escape(char_map.comment)} [^\n]*\n)"
+    if commands is None:
+        name_pattern = _COMMAND_NAME_PATTERNS.get(char_map.cmd_prefix, r"[A-Za-z]*")
+        return re.compile(fr"{comment}|{re.escape(char_map.cmd_prefix)}(?P<command>{name_pattern})")
+    # Names tokenize can not produce (e.g., containing a digit in LaTeX) never match, same as in tokenize
+    names = [command for command in commands if is_command_name(command, char_map)]
+    if not names:
+        return re.compile(comment)
+    name_chars = _COMMAND_NAME_CHARS.get(char_map.cmd_prefix, r"[A-Za-z]")
+    alternation = "|".join(re.escape(name) for name in sorted(names, key=len, reverse=True))
+    return re.compile(fr"{comment}|{re.escape(char_map.cmd_prefix)}(?P<command>{alternation})(?!{name_chars})")
+
+
+def is_command_name(name: str, char_map: LanguageChars) -> bool:
+    """ True if tokenize can produce a COMMAND token with value name """
+    return bool(name) and re.fullmatch(_COMMAND_NAME_PATTERNS.get(char_map.cmd_prefix, r"[A-Za-z]*"), name) is not None
+
+
+def tokenize(text: str, char_map: LanguageChars) -> list[Token]:
+    """ Scans text once, returning command, delimiter and comment tokens in order of appearance.
+
+    A command prefix that is not followed by a name (e.g., '\\{' or '\\\\') produces a COMMAND token with an empty
+    value that only consumes the prefix, so the following character is tokenized on its own.
+    """
+    if not char_map.cmd_prefix:
+        return []
+    openers = {char_map.arg_open_delim, char_map.opt_arg_open_delim}
+    tokens: list[Token] = []
+    for match in _token_pattern(char_map).finditer(text):
+        kind = match.lastgroup
+        if kind == "command":
+            tokens.append(Token(TokenKind.COMMAND, match.start(), match.end(), match.group("command")))
+        elif kind == "delim":
+            char = match.group("delim")
+            tokens.append(Token(TokenKind.OPEN if char in openers else TokenKind.CLOSE, match.start(), match.end(), char))
+        else:
+            tokens.append(Token(TokenKind.COMMENT, match.start(), match.end(), match.group("comment")))
+    return tokens
+
+
+def tokenize_commands(text: str, char_map: LanguageChars, commands: Iterable[str] | None = None) -> list[Token]:
+    """ The COMMENT tokens and the COMMAND tokens whose value is in commands (every command when None) of
+    tokenize(text, char_map). Delimiters, and when commands is given every other command, are skipped by the regex
+    engine instead of producing tokens, which makes scanning for a few commands (e.g., section commands) much cheaper.
+    """
+    if not char_map.cmd_prefix:
+        return []
+    names = None if commands is None else tuple(sorted(set(commands)))
+    tokens: list[Token] = []
+    for match in _command_pattern(char_map, names).finditer(text):
+        if match.lastgroup == "command":
+            tokens.append(Token(TokenKind.COMMAND, match.start(), match.end(), match.group("command")))
+        else:
+            tokens.append(Token(TokenKind.COMMENT, match.start(), match.end(), match.group("comment")))
+    return tokens
+
+
+@dataclass
+class TokenizedText:
+    """TrackedText along with its tokens and delimiter index, computed in a single pass over the text
+
+    Usage:
+        tokenized = TokenizedText.from_text(TrackedText(...))
+        for token in tokenized.tokens:
+            ...
+    """
+    text: TrackedText
+    string: str
+    char_map: LanguageChars
+    tokens: list[Token]
+    delimiters: DelimiterIndex
+
+    @classmethod
+    def from_text(cls, text: TrackedText, tokenizer: Callable[[str, LanguageChars], list[Token]] = tokenize) -> "TokenizedText":
+        """ Tokenizes text and indexes its delimiters, delimiters inside comments are ignored. Unbalanced delimiters are logged.
+        tokenizer must return at least the COMMENT tokens of tokenize, e.g., partial(tokenize_commands, commands=...) """
+        char_map = langauage_char_registry[text.filetype()]
+        string = str(text)
+        tokens = tokenizer(string, char_map)
+        pairs = [(char_map.arg_open_delim, char_map.arg_close_delim), (char_map.opt_arg_open_delim, char_map.opt_arg_close_delim)]
+        comments = [(token.start, token.end) for token in tokens if token.kind == TokenKind.COMMENT]
+        delimiters = DelimiterIndex(string, pairs, exclude=comments, source=text.source)
+        delimiters.log_unbalanced()
+        return cls(text, string, char_map, tokens, delimiters)
+
+    def closing(self, index: int, delim: str) -> int | None:
+        """ Offset of the delimiter closing the delimiter at index, None if text[index] is not delim or is never closed """
+        if self.string[index:index+1] != delim:
+            return None
+        return self.delimiters.closing(index)
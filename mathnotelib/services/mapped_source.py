@@ -0,0 +1,140 @@
+from bisect import bisect_right
+from pathlib import Path
+from typing import Iterator
+import logging
+import mmap
+import re
+
+import numpy as np
+
+from ..models import LanguageChars, SourceChunk, SourceMap
+
+logger = logging.getLogger("mathnote")
+
+
+class MappedSource:
+    """Read-only memory map of a utf-8 source file. The file is scanned as bytes, only the chunks requested are decoded.
+
+    Byte offsets are converted to text (str index) offsets with a table of checkpoints, the number of characters
+    before every checkpoint_size bytes. The table is built lazily, on first conversion, by counting the bytes that
+    start a utf-8 character.
+
+    Usage:
+        with MappedSource(path) as source:
+            for start, end in source.chunk_bounds(1 << 20, char_map):
+                chunk = source.chunk(start, end)
+    """
+    def __init__(self, path: Path, checkpoint_size: int = 1 << 16):
+        """
+        -- Params --
+        path: utf-8 encoded file
+        checkpoint_size: bytes between checkpoints of the byte to text offset table
+        """
+        self.path = path
+        self.checkpoint_size = checkpoint_size
+        self._checkpoints: list[int] | None = None
+        self._line_count: tuple[int, int] = (0, 1) # (byte offset, line number at offset) of the last line_at query
+        with path.open("rb") as f:
+            self.size = f.seek(0, 2)
+            # mmap can not map empty files
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+
+    def _char_count(self, start: int, end: int) -> int:
+        """ Number of characters starting in bytes [start, end), i.e., bytes that are not utf-8 continuation bytes """
+        if end <= start:
+            return 0
+        data = np.frombuffer(self._map, dtype=np.uint8, count=end - start, offset=start)
+        return int(np.count_nonzero((data & 0xC0) != 0x80))
+
+    def checkpoints(self) -> list[int]:
+        """ Text offset of byte k * checkpoint_size, for every checkpoint in the file """
+        if self._checkpoints is None:
+            checkpoints = [0]
+            for start in range(0, self.size, self.checkpoint_size):
+                checkpoints.append(checkpoints[-1] + self._char_count(start, min(start + self.checkpoint_size, self.size)))
+            self._checkpoints = checkpoints
+        return self._checkpoints
+
+    def byte_to_text(self, offset: int) -> int:
+        """ Text offset of the character starting at byte offset """
+        if not 0 <= offset <= self.size:
+            raise IndexError(f"Byte offset {offset} out of range for {self.path}")
+        block = offset // self.checkpoint_size
+        block_start = block * self.checkpoint_size
+        return self.checkpoints()[block] + self._char_count(block_start, offset)
+
+    def text_to_byte(self, offset: int) -> int:
+        """ Byte offset of the character at text offset """
+        checkpoints = self.checkpoints()
+        if not 0 <= offset <= checkpoints[-1]:
+            raise IndexError(f"Text offset {offset} out of range for {self.path}")
+        block = bisect_right(checkpoints, offset) - 1
+        index = min(block * self.checkpoint_size, self.size)
+        remaining = offset - checkpoints[block]
+        # Walk the block, each character starts at a byte that is not a continuation byte
+        while index < self.size:
+            if self._map[index] & 0xC0 != 0x80:
+                if remaining == 0:
+                    return index
+                remaining -= 1
+            index += 1
+        return self.size
+
+    def chunk_bounds(self, chunk_size: int, char_map: LanguageChars) -> Iterator[tuple[int, int]]:
+        """ Splits the file into byte spans of roughly chunk_size bytes. Spans only end at a blank line outside of every
+        delimiter pair (comments excluded), so no section is split. A span grows past chunk_size until such a line is found.
+        """
+        pattern = _boundary_pattern(char_map)
+        opening = {ord(char_map.arg_open_delim), ord(char_map.opt_arg_open_delim)}
+        start, depth = 0, 0
+        for match in pattern.finditer(self._map):
+            group = match.lastgroup
+            if group == "delim":
+                depth += 1 if match.group("delim")[0] in opening else -1
+                # Stray closing delimiters are reported by the parsers, do not let them hide every later boundary
+                depth = max(depth, 0)
+            elif group == "blank" and depth == 0 and match.start() + 1 - start >= chunk_size:
+                end = match.start() + 1
+                yield start, end
+                start = end
+        if start < self.size:
+            yield start, self.size
+
+    def chunk(self, start: int, end: int) -> SourceChunk:
+        """ Decodes bytes [start, end), start and end must be character boundaries """
+        text = bytes(self._map[start:end]).decode("utf-8")
+        origin = SourceMap.from_text(text, first_line=self.line_at(start))
+        return SourceChunk(text, source=self.path, offset=self.byte_to_text(start), byte_offset=start, origin=origin)
+
+    def line_at(self, offset: int) -> int:
+        """ Line number (1 indexed) of byte offset. Newlines are counted one checkpoint block at a time, starting from the
+        previous query when offset is past it, so querying the start of every chunk in order scans the file once """
+        counted, lines = self._line_count if offset >= self._line_count[0] else (0, 1)
+        for start in range(counted, offset, self.checkpoint_size):
+            count = min(self.checkpoint_size, offset - start)
+            lines += int(np.count_nonzero(np.frombuffer(self._map, dtype=np.uint8, count=count, offset=start) == ord("\n")))
+        self._line_count = (offset, lines)
+        return lines
+
+    def close(self) -> None:
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+    def __enter__(self) -> "MappedSource":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __repr__(self) -> str:
+        return f"MappedSource(path={self.path}, size={self.size})"
+
+
+def _boundary_pattern(char_map: LanguageChars) -> re.Pattern:
+    # Same comment definition as CleanStage, delimiters and prefix characters are ascii so matching bytes is exact
+    delims = sorted({char_map.arg_open_delim, char_map.arg_close_delim, char_map.opt_arg_open_delim, char_map.opt_arg_close_delim} - {""})
+    delim_class = "".join(re.escape(d) for d in delims) or r"\x00"
+    comment = re.escape(char_map.comment)
+    return re.compile(
+            fr"(?P<comment>{comment} [^\n]*\n)|(?P<delim>[{delim_class}])|(?P<blank>\n[ \t]*\n)".encode("ascii")
+            )
@@ -1,13 +1,30 @@
-from functools import reduce
+import hashlib
 import logging
-from typing import Optional, Union, Generator, Generic, get_args, get_origin, TypeVar
-from collections.abc import Iterable
+import os
+import re
+import queue
+import threading
+from bisect import bisect_left, bisect_right
+from collections import deque
+from contextlib import AbstractContextManager, nullcontext
+from dataclasses import dataclass, replace
+from functools import lru_cache, partial
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Any, Callable, Optional, Union, Generator, Generic, get_args, get_origin, TypeVar
+from collections.abc import Iterable, Iterator
 from pathlib import Path
 from abc import abstractmethod, ABC
 
-from ..models import Flashcard, langauage_char_registry, Section, TrackedText
+from ..models import Flashcard, langauage_char_registry, Section, SourceMap, TrackedText, TrackedTextBuilder
+from ..models.macros import MacroMatcher, balanced
 from .._enums import FileType
 from ..config import CONFIG
+from .lexer import Token, TokenKind, TokenizedText, is_command_name, tokenize, tokenize_commands
+from .delimiters import DelimiterIndex
+from .extraction_cache import ExtractionCache
+from .mapped_source import MappedSource
+from .instrumentation import PipelineInstrumentation, StageRecord, StepTimer
+from .flashcard_compiler import FlashcardCompiler
 
 logger = logging.getLogger("mathnote")
 
@@ -16,141 +33,327 @@ Output = TypeVar("Output")
 
 
 class Stage(ABC, Generic[Input, Output]):
+    # Record of the chunk being processed, only set while an instrumented pipeline runs this stage
+    _record: StageRecord | None = None
+    # Output depends on the chunks processed before (e.g., DeduplicateStage). ProcessingPipeline runs a stateful stage
+    # and every stage after it in the calling process, on every output including cached ones, and never caches them
+    stateful: bool = False
+
     @abstractmethod
     def process(self, data: Input) -> Output:
         pass
 
+    def step(self, name: str) -> AbstractContextManager:
+        """ Times the enclosed block as step name of the current StageRecord, does nothing when not instrumented
+
+        Usage:
+            with self.step("remove_comments"):
+                ...
+        """
+        if self._record is None:
+            return nullcontext()
+        return StepTimer(self._record, name)
+
+    def count(self, name: str, value: int = 1) -> None:
+        """ Adds value to counter name of the current StageRecord, does nothing when not instrumented """
+        if self._record is not None and value:
+            self._record.counters[name] = self._record.counters.get(name, 0) + value
+
+    def fingerprint(self, filetype: FileType) -> str | None:
+        """ Identifies the configuration that determines this stage's output for files of filetype. Stage output is only
+        cached by ProcessingPipeline when every stage returns a fingerprint. Default: None, i.e., not cacheable """
+        return None
+
 class DataGenerator:
-    """ Generates data in chunks. Each chunk corresponds to the contents of a file """
-    def __init__(self, file_paths: list[Path]) -> None:
+    """ Generates data in chunks. Each chunk corresponds to the contents of a file, or to part of a file when chunk_size is set """
+    def __init__(self, file_paths: list[Path], chunk_size: int | None = None) -> None:
+        """
+        -- Params --
+        file_paths: files to read
+        chunk_size: files larger than chunk_size bytes are memory mapped and generated as SourceChunk's of roughly
+                    chunk_size bytes, split at blank lines outside of every section (see MappedSource.chunk_bounds).
+                    A sub section (e.g., proof) split from its parent section by a chunk boundary is not attached to it.
+                    Default None, i.e., files are read whole
+        """
         super().__init__()
         self.file_paths = file_paths
+        self.chunk_size = chunk_size
 
     def __iter__(self) -> Generator[TrackedText | None]:
         for file_path in self.file_paths:
             try:
+                if self.chunk_size is not None and file_path.stat().st_size > self.chunk_size:
+                    yield from self._iter_chunks(file_path)
+                    continue
                 file_contents = file_path.read_text(encoding='utf-8')
             except Exception as e:
                 logger.error(f"Failed to read file {file_path}\n{e}")
                 yield None
                 continue
 
-            return_value = TrackedText(file_contents, source=file_path)
+            return_value = TrackedText(file_contents, source=file_path, origin=SourceMap.from_text(file_contents))
             yield return_value
 
+    def _iter_chunks(self, file_path: Path) -> Generator[TrackedText]:
+        char_map = langauage_char_registry[TrackedText("", source=file_path).filetype()]
+        with MappedSource(file_path) as source:
+            for start, end in source.chunk_bounds(self.chunk_size, char_map):
+                yield source.chunk(start, end)
+
 
 class CleanStage(Stage[TrackedText, TrackedText]):
     """
-    Stage for cleaning LaTeX/Typst code, i.e., remove comments and user defined macros
+    Stage for cleaning LaTeX/Typst code, i.e., remove comments and user defined macros. Accepts TrackedText or
+    TrackedTextView, macro arguments are scanned in place without copying the remaining text
 
     Usage:
         macros, text = {...}, TrackedText(...)
         clean_stage = CleanStage(macros)
         cleaned_text = clean_stage.process(text)
     """
-    def __init__(self, macros: dict) -> None:
+    def __init__(self, macros: dict, matchers: dict[FileType, MacroMatcher] | None = None) -> None:
+        """
+        -- Params --
+        macros: dict of form {filetype: {macro name: macro info,...}}, see Config.macros
+        matchers: compiled MacroMatcher for each filetype, see Config.macro_matchers. Built from macros when not given
+        """
         super().__init__()
         self.macros = macros
+        if matchers is None:
+            matchers = {filetype: MacroMatcher.from_macros(file_macros) for filetype, file_macros in macros.items()}
+        self.matchers = matchers
         self.char_map = None
+        self.delimiters: DelimiterIndex | None = None
+
+    def fingerprint(self, filetype: FileType) -> str | None:
+        return ExtractionCache.fingerprint(self.__class__.__name__, self.macros.get(filetype, {}))
 
     def process(self, data: TrackedText) -> TrackedText:
         logger.debug(f"Starting {self.process}")
         self.char_map = langauage_char_registry[data.filetype()]
         macros = self.macros[data.filetype()]
-        tracked_string = self._remove_comments(data)
-        tracked_string = self._remove_macros(tracked_string, macros)
+        with self.step("remove_comments"):
+            tracked_string = self._remove_comments(data)
+        with self.step("index_delimiters"):
+            pairs = [(self.char_map.arg_open_delim, self.char_map.arg_close_delim), (self.char_map.opt_arg_open_delim, self.char_map.opt_arg_close_delim)]
+            self.delimiters = DelimiterIndex(str(tracked_string), pairs, source=data.source)
+        with self.step("remove_macros"):
+            tracked_string = self._remove_macros(tracked_string, macros, self.matchers[data.filetype()])
+        self.delimiters = None # Only valid while processing data, also keeps the stage cheap to pickle
         logger.debug(f"Finished {self.process}")
         return tracked_string
 
     def _remove_comments(self, text: TrackedText) -> TrackedText:
+        """ Removes comments, kept text is recorded in a TrackedTextBuilder so the result maps back to the source file """
         assert self.char_map is not None
-        pattern = fr'{self.char_map.comment} .*?\n'
-        return text.sub(pattern, '')
-
-    def _find_cmd(self, text: TrackedText, macros: list[str]) -> Union[str, None]:
-        """ It is assumed tex string starts with command prefix character. e.g., '\\' in LaTeX or '#' in typst """
-        for pattern in macros:
-            if text.startswith(pattern) and not text[len(pattern)].isalpha(): # Not sure this covers all cases. We make sure line starts with command and next letter is not alphanumeric as that would indicate we got partial match. ie matching operator on operatorname
-                return pattern
-        return None
+        pattern = _comment_pattern(self.char_map.comment)
+        buffer, start, end = text.span()
+        builder = TrackedTextBuilder(source=text.source, origin=self._origin(text))
+        kept_start = start
+        for match in pattern.finditer(buffer, start, end):
+            builder.append_span(buffer, kept_start, match.start())
+            kept_start = match.end()
+        builder.append_span(buffer, kept_start, end)
+        return builder.build()
+
+    @staticmethod
+    def _origin(text: TrackedText) -> SourceMap:
+        """ SourceMap of the buffer text spans, text is assumed to be a whole file when it has none """
+        if text.origin is not None:
+            return text.origin
+        buffer, _, _ = text.span()
+        return SourceMap.from_text(buffer)
 
     def _find_arg(self, text: TrackedText) -> Union[TrackedText, None]:
-        """ It is assume the tex string passed starts with curly bracket """
+        """ It is assume the tex string passed starts with curly bracket. Returns None if the bracket is never closed """
         assert self.char_map is not None
         paren_stack = []
 
         if str(text[0]) != self.char_map.arg_open_delim:
             raise ValueError(f"String passed does not begin with curly opening brace: {text[:50]}, {text.source}")
 
-        for index, char in enumerate(str(text)):
+        buffer, start, end = text.span()
+        if self.delimiters is not None and self.delimiters.buffer is buffer:
+            closing = self.delimiters.closing(start)
+            if closing is None or closing >= end:
+                return None
+            return text[1:closing - start]
+
+        for index in range(start, end):
+            char = buffer[index]
             if char == self.char_map.arg_open_delim:
                 paren_stack.append(char)
             elif char == self.char_map.arg_close_delim:
                 paren_stack.pop()
             if not paren_stack:
-                return text[1:index]
+                return text[1:index - start]
         return None
 
-    def _remove_macros(self, text: TrackedText, macros: dict) -> TrackedText:
+    def _remove_macros(self, text: TrackedText, macros: dict, matcher: MacroMatcher | None = None) -> TrackedText:
         """ Replaces all user defined macros with 'pure tex' in the sence that it would compile without a specific macros.tex/preamble.tex
         ** Limited to replacing macros of the form: \\macro_name{title}{tex}. This can not handle more complex macros
         :param tex: latex code as string
         :param macros: dictionary with key values of the form; macro_name: macro_dict_info. ie {defin: {command_in_tex: tex, ....},...}
+        :param matcher: MacroMatcher built from macros, built on the spot if not given
 
-        TODO: Currently we perform operation on TrackedText and the string representation. Change so that we only deal with one type...
+        Kept text and replacements are recorded in a TrackedTextBuilder and joined once, so cleaning is linear in the size of text
         """
         assert self.char_map is not None
-        # TODO HAck
-        if text.filetype == FileType.Typst:
-            return text
-        text_pcs: list[TrackedText] = []
-        counter: int = 0
-
-        while counter < len(text):
+        if matcher is None:
+            matcher = MacroMatcher.from_macros(macros)
+        builder = TrackedTextBuilder(source=text.source, origin=self._origin(text))
+        if text.filetype() == FileType.Typst:
+            self._expand_typst_macros(text, macros, matcher, builder)
+        else:
+            self._expand_macros(text, macros, matcher, builder)
+        return builder.build()
 
-            if str(text[counter]) != self.char_map.cmd_prefix:
-                text_pcs.append(text[counter])
-                counter += 1
+    def _expand_macros(self, text: TrackedText, macros: dict, matcher: MacroMatcher, builder: TrackedTextBuilder) -> None:
+        """ Records text in builder with every macro (and recursively, every macro inside its argument) expanded """
+        assert self.char_map is not None
+        cmd_prefix = self.char_map.cmd_prefix
+        buffer, start, end = text.span()
+        kept_start = start # start of text that has not yet been recorded in builder
+        index = buffer.find(cmd_prefix, start, end)
+
+        while index != -1:
+            counter = index - start
+            cmd = matcher.match(buffer, index + 1, end)
+            if cmd is None:
+                index = buffer.find(cmd_prefix, index + 1, end)
                 continue
 
-            cmd = self._find_cmd(text[counter+1:], list(macros.keys()))
-
-            if cmd == None:
-                text_pcs.append(text[counter])
-                counter += 1
+            end_cmd_index = counter + len(cmd)
+            arg = self._find_arg(text[end_cmd_index +1:])
+            if arg is None: # unbalanced argument, macro is left as is
+                logger.warning(f"Failed to expand macro '{cmd}' at offset {index}, argument is never closed. {text.source}")
+                index = buffer.find(cmd_prefix, index + 1, end)
                 continue
 
-            end_cmd_index = counter + len(cmd)  # -1 to accound for backslash character being in command, we want all end_*_index variables to be inclusive
-            arg = self._find_arg(text[end_cmd_index +1:])
-            if arg is None:
-                logging.warn("Something went wrong while calling clean_self.tex")
-                break
+            builder.append_span(buffer, kept_start, index)
+            # Add space character to prevent joining text, however ensure previous charcater is
+            if str(text[counter-1]).isalpha():
+                builder.append(" ")
 
             cmd_template = macros[cmd]["command"]
-            cleaned_arg = self._remove_macros(arg, macros)
-            cleaned_arg = self._add_arg_spaces(cmd_template, str(cleaned_arg))
-
+            leading, trailing = self._arg_padding(cmd_template)
             # TODO This only works for LaTeX
-            new_cmd = cmd_template.replace("#1", str(cleaned_arg))
+            template_pcs = cmd_template.split("#1")
+            cleaned_arg = TrackedTextBuilder()
+            if len(template_pcs) > 1:
+                self._expand_macros(arg, macros, matcher, cleaned_arg)
+            builder.append(template_pcs[0])
+            for template_pc in template_pcs[1:]:
+                builder.append(leading)
+                builder.extend(cleaned_arg)
+                builder.append(trailing)
+                builder.append(template_pc)
+            builder.append(" ")
+
             num_brackets_ignored = 2
+            kept_start = start + len(arg) + end_cmd_index + num_brackets_ignored +1 # +1 to move to character after command
+            index = buffer.find(cmd_prefix, kept_start, end)
+        builder.append_span(buffer, kept_start, end)
+
+    def _expand_typst_macros(self, text: TrackedText, macros: dict, matcher: MacroMatcher, builder: TrackedTextBuilder) -> None:
+        """ Records text in builder with every simple Typst macro call expanded, see parse_typst_macros. A call is either
+        '#name' (no parameters) or '#name(arg)' / '#name[arg]' (one parameter). The argument is substituted for '#1'
+        with its delimiters, i.e., as '#(arg)' or '#[arg]', so it is evaluated the same way as in the macro. The
+        expansion itself is an expression too, '#($math$)' or '#[content]', so a call expands to the same content in
+        markup and in math, e.g., '$x in #R$' becomes '$x in #($bb(R)$)$'. Calls with more arguments than the macro
+        takes, or followed by a field or method access, are left as is.
+        """
+        assert self.char_map is not None
+        cmd_prefix = self.char_map.cmd_prefix
+        arg_delims = (self.char_map.arg_open_delim, self.char_map.opt_arg_open_delim)
+        buffer, start, end = text.span()
+        kept_start = start # start of text that has not yet been recorded in builder
+        index = buffer.find(cmd_prefix, start, end)
+
+        while index != -1:
+            cmd = self._typst_macro_at(buffer, index, end, matcher)
+            if cmd is None:
+                index = buffer.find(cmd_prefix, index + 1, end)
+                continue
+            name_end = index + 1 + len(cmd)
+
+            arg = None
+            call_end = name_end
+            if macros[cmd]["num_args"] == "1":
+                closing = self._group_closing(text, name_end) if buffer[name_end:name_end + 1] in arg_delims else None
+                if closing is None:
+                    logger.warning(f"Failed to expand macro '{cmd}' at offset {index}, argument is missing or never closed. {text.source}")
+                    index = buffer.find(cmd_prefix, index + 1, end)
+                    continue
+                arg = text[name_end - start:closing + 1 - start]
+                call_end = closing + 1
+            if (buffer[call_end:call_end + 1] in arg_delims # further arguments
+                    or (buffer[call_end:call_end + 1] == "." and _is_typst_identifier_char(buffer[call_end + 1:call_end + 2]))):
+                index = buffer.find(cmd_prefix, index + 1, end)
+                continue
 
-            if str(text[counter-1]).isalpha(): # Add space character to prevent joining text, however ensure previous charcater is
-                new_cmd = " " + str(new_cmd)
-            new_cmd += " "
-            text_pcs.append(TrackedText(new_cmd, source=text.source))
-            counter = len(arg) + end_cmd_index + num_brackets_ignored +1 #This sets counter equal to last character in command, +1 to move to character after command
-        new_text = reduce(lambda x, y: x + y, text_pcs)
-        return new_text
-
-    def _add_arg_spaces(self, command: str, arg: str) -> str:
-        if "#1" not in command: #TODO, add __contains__ for TrackedText
-            return ""
+            builder.append_span(buffer, kept_start, index)
+            template = macros[cmd]["command"]
+            # Math templates keep their '$', content templates are put back in a content block
+            opening, closing = (cmd_prefix + "(", ")") if template.startswith("$") else (cmd_prefix + "[", "]")
+            template_pcs = template.split("#1")
+            builder.append(opening)
+            if arg is None or len(template_pcs) == 1:
+                builder.append(template)
+            else:
+                cleaned_arg = TrackedTextBuilder()
+                cleaned_arg.append(cmd_prefix)
+                self._expand_typst_macros(arg, macros, matcher, cleaned_arg)
+                builder.append(template_pcs[0])
+                for template_pc in template_pcs[1:]:
+                    builder.extend(cleaned_arg)
+                    builder.append(template_pc)
+            builder.append(closing)
+            kept_start = call_end
+            index = buffer.find(cmd_prefix, kept_start, end)
+        builder.append_span(buffer, kept_start, end)
+
+    @staticmethod
+    def _typst_macro_at(buffer: str, index: int, end: int, matcher: MacroMatcher) -> str | None:
+        """ Name of the macro called at buffer[index] (a command prefix), None if it is not a macro """
+        cmd = matcher.match(buffer, index + 1, end)
+        # Typst identifiers may contain '-' and '_', e.g., '#vec' does not start '#vec_n'
+        if cmd is None or _is_typst_identifier_char(buffer[index + 1 + len(cmd):index + 2 + len(cmd)]):
+            return None
+        return cmd
+
+    def _group_closing(self, text: TrackedText, index: int) -> int | None:
+        """ Buffer offset of the delimiter closing the group opened at buffer offset index, None if it is not closed in text """
+        assert self.char_map is not None
+        buffer, _, end = text.span()
+        if self.delimiters is not None and self.delimiters.buffer is buffer:
+            closing = self.delimiters.closing(index)
+        else:
+            open_delim = buffer[index]
+            close_delim = self.char_map.arg_close_delim if open_delim == self.char_map.arg_open_delim else self.char_map.opt_arg_close_delim
+            closing, depth = None, 0
+            for position in range(index, end):
+                if buffer[position] == open_delim:
+                    depth += 1
+                elif buffer[position] == close_delim:
+                    depth -= 1
+                    if depth == 0:
+                        closing = position
+                        break
+        return closing if closing is not None and closing < end else None
+
+    def _arg_padding(self, command: str) -> tuple[str, str]:
+        """ Spaces added before and after a macro argument, prevents the argument joining letters in command """
+        if "#1" not in command:
+            return "", ""
         command_split = command.split("#1")
-        if command_split[1][0].isalpha():
-            arg += " "
-        if command_split[0][-1].isalpha():
-            arg = " " + arg
-        return arg
+        trailing = " " if command_split[1][0].isalpha() else ""
+        leading = " " if command_split[0][-1].isalpha() else ""
+        return leading, trailing
+
+
+def _is_typst_identifier_char(char: str) -> bool:
+    return char.isalnum() or char in "_-" if char else False
 
 
 # TODO: All subclasses of SectionFinder assume typst optional arg content is contained in '[]' which is not necessairly true. Look at LanguageChars, this needs to be fixed at some point
@@ -159,6 +362,50 @@ class SectionFinder(ABC):
     def find_section(self, text: TrackedText) -> tuple[Section | None, int]:
         pass
 
+    @abstractmethod
+    def section_name(self, command: str, filetype: FileType) -> str | None:
+        """ Returns name of section started by command (without prefix), None if command does not start a section """
+        pass
+
+    def section_at(self,
+                   tokenized: TokenizedText,
+                   token: Token,
+                   clean: Callable[[TrackedText], TrackedText] | None = None
+                   ) -> tuple[Section | None, int]:
+        """ Builds section started by token, delimiters are looked up in tokenized instead of rescanning the text.
+        When given, clean is applied to the title and content, each passed along with its enclosing delimiters
+
+        returns: (section, offset of closing content delimiter). (None, token.start) if token does not start a section, or
+            the section command is not followed by balanced title/content delimiters (these are logged by TokenizedText)
+        """
+        filetype = tokenized.text.filetype()
+        name = self.section_name(token.value, filetype) if token.kind == TokenKind.COMMAND else None
+        if name is None:
+            return None, token.start
+
+        char_map = tokenized.char_map
+        index = token.end
+        title = None
+        if tokenized.string[index:index+1] == char_map.arg_open_delim:
+            end_title_index = tokenized.closing(index, char_map.arg_open_delim)
+            if end_title_index is None:
+                return None, token.start
+            title = tokenized.text[index+1:end_title_index] if clean is None else clean(tokenized.text[index:end_title_index+1])[1:-1]
+            index = end_title_index + 1
+
+        end_content_index = tokenized.closing(index, char_map.opt_arg_open_delim)
+        if end_content_index is None:
+            logger.debug(f"Section command '{token.value}' at offset {token.start} is not followed by '{char_map.opt_arg_open_delim}', {tokenized.text.source}")
+            return None, token.start
+        content = tokenized.text[index+1:end_content_index] if clean is None else clean(tokenized.text[index:end_content_index+1])[1:-1]
+        section = Section(name, content)
+        section.location = tokenized.text[token.start:end_content_index + 1].location()
+        if title is not None:
+            if filetype == FileType.Typst:
+                title = title.replace("title: ", "").replace('"', "")
+            section.title = title
+        return section, end_content_index
+
     @staticmethod
     def _content_inside_paren(text: TrackedText, paren: tuple[str, str]) -> TrackedText:
         """ It is assume the tex string passed starts paren[0] and for every opening paren we have a matching close paren """
@@ -166,13 +413,15 @@ class SectionFinder(ABC):
         if str(text[0]) != paren[0]:
             raise ValueError(f"String passed does not begin with '{paren[0]}'. Text: {text[:50]}, {text.source}") # }}} <= keep lsp happy
 
-        for index, char in enumerate(str(text)):
+        buffer, start, end = text.span()
+        for index in range(start, end):
+            char = buffer[index]
             if char == paren[0]:
                 paren_stack.append(char)
             elif char == paren[1]:
                 paren_stack.pop()
             if not paren_stack:
-                return text[1:index]
+                return text[1:index - start]
         raise ValueError("Invalid string")
 
 
@@ -211,6 +460,11 @@ class SubSectionFinder(SectionFinder):
 
         return section, end_content_index
 
+    def section_name(self, command: str, filetype: FileType) -> str | None:
+        if command == self.name_ptrn.get(filetype.value):
+            return self.name
+        return None
+
     # Should this be ...?
     def is_section(self, text: TrackedText, cmd_prefix: str) -> tuple[bool, tuple[str, str]] | tuple[bool, None]:
         if len(text) < 2 or str(text[0]) != cmd_prefix:
@@ -242,6 +496,14 @@ class MainSectionFinder(SectionFinder):
         names: dict of form {Section name: section pattern,...}. e.g., {"DEFINITION": "defin"}
         """
         self.names = {n: d for (n, d) in CONFIG.section_names.items() if n in names}
+        # command -> section name, the first section listed wins when several share a command
+        self.commands: dict[FileType, dict[str, str]] = {FileType.LaTeX: {}, FileType.Typst: {}}
+        for name, d in self.names.items():
+            for filetype, commands in self.commands.items():
+                commands.setdefault(d[filetype.value], name)
+
+    def section_name(self, command: str, filetype: FileType) -> str | None:
+        return self.commands.get(filetype, {}).get(command)
 
     def find_section(self, text: TrackedText) -> tuple[Section | None, int]:
         char_map = langauage_char_registry[text.filetype()]
@@ -293,35 +555,43 @@ class FlashcardBuilderStage(Stage[TrackedText, list[Flashcard]]):
     def __init__(self, names: list[str]):
         self.main_section_finder = MainSectionFinder(names)
         self.sub_section_finders = []
-        self.char_map = None
-
-    def _index_of_line_end(self, text: TrackedText) -> int:
-        """
-        :param tex: latex code as string
-        :returns int: index of line end, None if no newline character, could occur on last line in file
-        """
-        assert self.char_map is not None
-        for index, char in enumerate(text):
-            if char == self.char_map.comment:
-                return index +1
-        return 0
 
     def process_chunk(self, data: TrackedText):
-        """
+        """ Tokenizes data once and builds flashcards from the command tokens. Only comments and section commands are
+        tokenized (see tokenize_commands), the text in between is skipped by the regex engine. Sections nested inside
+        another section, and commands inside comments, are skipped.
         :param data: data as TrackedText
-        :param section_names: gets all data from sections contained in section_names
         :returns list: [(name, section_contents)....] """
-        assert self.char_map is not None
-
-        flashcards: list[Flashcard] = []
-        counter: int = 0
+        with self.step("tokenize"):
+            tokenized = self._tokenize(data)
+        with self.step("find_sections"):
+            return self._build_flashcards(tokenized)
+
+    def iter_process(self, data: TrackedText) -> Iterator[Flashcard]:
+        """ Same flashcards as process, each yielded as soon as it is complete (see _iter_flashcards) instead of once the
+        whole chunk has been parsed """
+        yield from self._iter_flashcards(self._tokenize(data))
+
+    def _tokenize(self, data: TrackedText) -> TokenizedText:
+        return TokenizedText.from_text(data, partial(tokenize_commands, commands=self.section_commands(data.filetype())))
+
+    def _build_flashcards(self, tokenized: TokenizedText, clean: Callable[[TrackedText], TrackedText] | None = None) -> list[Flashcard]:
+        """ clean: applied to section titles and contents, see SectionFinder.section_at """
+        return list(self._iter_flashcards(tokenized, clean))
+
+    def _iter_flashcards(self, tokenized: TokenizedText, clean: Callable[[TrackedText], TrackedText] | None = None) -> Iterator[Flashcard]:
+        """ Yields the flashcards of tokenized in order. A card is yielded once no later section can change it, i.e., as
+        soon as its main section is closed, or when a sub section (e.g., proof) may attach to it, once the next main
+        section is found. clean: applied to section titles and contents, see SectionFinder.section_at """
+        position: int = 0 # offset of first character not consumed by a previous section
         parent_section: str | None = None
+        pending: Flashcard | None = None # last card, while a sub section may still attach to it
+        # tokenized may hold every command (e.g., CleanBuildStage looks for macro calls), only section commands are tried
+        section_commands = self.section_commands(tokenized.text.filetype())
+        parents = {parent for finder in self.sub_section_finders for parent in finder.parents}
 
-        while counter < len(data): # check this is what i want
-
-            if data[counter] == self.char_map.comment: # TODO: Adjust for typst + old note which I can no longer decifer: Do this everywhere
-                comment_len = self._index_of_line_end(data[counter+1:])
-                counter += comment_len
+        for token in tokenized.tokens:
+            if token.kind != TokenKind.COMMAND or token.start < position or token.value not in section_commands:
                 continue
 
             # add subsections to flashcard
@@ -329,28 +599,47 @@ class FlashcardBuilderStage(Stage[TrackedText, list[Flashcard]]):
                 for subsection_finder in self.sub_section_finders:
                     if parent_section not in subsection_finder.parents:
                         continue
-                    section, end_index = subsection_finder.find_section(data[counter:])
-                    if section != None:
-                        flashcards[-1].proof_section =  Section(subsection_finder.name, section.content, None)
-                        counter += end_index
+                    section, end_index = subsection_finder.section_at(tokenized, token, clean)
+                    if section is not None:
+                        assert pending is not None
+                        pending.proof_section = Section(subsection_finder.name, section.content, None, location=section.location)
+                        position = end_index + 1
+                        break
+                if token.start < position:
+                    continue
 
             # Add main section. i.e question, answer
-            new_section, end_index = self.main_section_finder.find_section(data[counter:])
-
+            new_section, end_index = self.main_section_finder.section_at(tokenized, token, clean)
             if new_section is None:
-                counter += 1
                 continue
 
+            if pending is not None:
+                yield pending
+                pending = None
             parent_section = new_section.name
-
-            flashcards.append(
-                    Flashcard(new_section)
-                    )
-            counter += end_index + 1  # This sets counter equal to last character in command, +1 to move to character after command
-        return flashcards
+            flashcard = Flashcard(new_section)
+            position = end_index + 1
+            if parent_section in parents:
+                pending = flashcard
+            else:
+                yield flashcard
+        if pending is not None:
+            yield pending
+
+    def section_commands(self, filetype: FileType) -> set[str]:
+        """ Commands (without prefix) of the main sections and sub sections of filetype. Sub sections none of whose parents
+        are selected can never attach to a card, their commands are left out so they are not even tokenized """
+        commands = set(self.main_section_finder.commands.get(filetype, {}))
+        for finder in self.sub_section_finders:
+            if filetype.value in finder.name_ptrn and finder.parents.keys() & self.main_section_finder.names.keys():
+                commands.add(finder.name_ptrn[filetype.value])
+        return commands
+
+    def fingerprint(self, filetype: FileType) -> str | None:
+        sub_sections = [(finder.name, finder.name_ptrn, sorted(finder.parents)) for finder in self.sub_section_finders]
+        return ExtractionCache.fingerprint(self.__class__.__name__, self.main_section_finder.commands.get(filetype, {}), sub_sections)
 
     def process(self, data: TrackedText) -> list[Flashcard]:
-        self.char_map = langauage_char_registry[data.filetype()]
         logger.debug(f"Calling {self.__class__.__name__}.process")
         chunk_flashcards = self.process_chunk(data)
 #        chunk_flashcards = self.re_format_flashcards(chunk_flashcards)
@@ -361,11 +650,367 @@ class FlashcardBuilderStage(Stage[TrackedText, list[Flashcard]]):
         self.sub_section_finders.append(SubSectionFinder(sub_section_name, parents))
 
 
+class CleanBuildStage(Stage[TrackedText, list[Flashcard]]):
+    """
+    Stage fusing CleanStage and FlashcardBuilderStage. Comments are removed and sections found first, macros are then
+    only expanded inside section titles and contents rather than in the whole chunk, most of which is usually prose.
+
+    The flashcards are the same as those of CleanStage followed by FlashcardBuilderStage. Chunks where expanding
+    the macros outside of sections could change the sections found, e.g., a section inside a macro argument or a
+    macro whose template contains a section command (see _fusable), are processed by both stages instead.
+
+    Usage:
+        pipeline.add_stage(CleanBuildStage(CleanStage(macros), builder_stage)) # in place of both stages
+    """
+    def __init__(self, clean_stage: CleanStage, builder_stage: FlashcardBuilderStage) -> None:
+        super().__init__()
+        self.clean_stage = clean_stage
+        self.builder_stage = builder_stage
+        self._unsafe_macros: dict[FileType, frozenset[str]] = {}
+        self._commands: dict[FileType, frozenset[str] | None] = {}
+
+    def fingerprint(self, filetype: FileType) -> str | None:
+        fingerprints = [self.clean_stage.fingerprint(filetype), self.builder_stage.fingerprint(filetype)]
+        if any(fingerprint is None for fingerprint in fingerprints):
+            return None
+        return ExtractionCache.fingerprint(self.__class__.__name__, fingerprints)
+
+    def process(self, data: TrackedText) -> list[Flashcard]:
+        logger.debug(f"Starting {self.process}")
+        prepared = self._prepare(data)
+        if prepared is None:
+            with self.step("fallback"):
+                return self.builder_stage.process(self.clean_stage.process(data))
+
+        tokenized, clean = prepared
+        clean_stage = self.clean_stage
+        clean_stage.delimiters = tokenized.delimiters
+        try:
+            with self.step("find_sections"):
+                flashcards = self.builder_stage._build_flashcards(tokenized, clean)
+        finally:
+            clean_stage.delimiters = None
+        logger.debug(f"Finished {self.process}")
+        return flashcards
+
+    def iter_process(self, data: TrackedText) -> Iterator[Flashcard]:
+        """ Same flashcards as process, each yielded as soon as it is complete, see FlashcardBuilderStage.iter_process.
+        The clean stage's state is restored before each card is searched for, so several chunks may be iterated at once """
+        prepared = self._prepare(data)
+        if prepared is None:
+            yield from self.builder_stage.iter_process(self.clean_stage.process(data))
+            return
+
+        tokenized, clean = prepared
+        clean_stage = self.clean_stage
+        char_map = clean_stage.char_map
+        flashcards = self.builder_stage._iter_flashcards(tokenized, clean)
+        while True:
+            clean_stage.char_map, clean_stage.delimiters = char_map, tokenized.delimiters
+            try:
+                flashcard = next(flashcards, None)
+            finally:
+                clean_stage.delimiters = None
+            if flashcard is None:
+                return
+            yield flashcard
+
+    def _prepare(self, data: TrackedText) -> tuple[TokenizedText, Callable[[TrackedText], TrackedText]] | None:
+        """ Removes the comments of data and finds its macro calls. Returns (tokenized text without comments, clean
+        applied to section titles and contents), None when data must be processed by both stages, see _macro_calls """
+        clean_stage = self.clean_stage
+        filetype = data.filetype()
+        clean_stage.char_map = langauage_char_registry[filetype]
+        with self.step("remove_comments"):
+            text = clean_stage._remove_comments(data)
+        with self.step("tokenize"):
+            tokenized = TokenizedText.from_text(text, partial(tokenize_commands, commands=self._commands_of(filetype)))
+            calls = self._macro_calls(tokenized, filetype)
+        if calls is None:
+            logger.debug(f"Macros may change the sections of {data.source}, cleaning the whole chunk")
+            self.count("fallbacks")
+            return None
+
+        macros, matcher = clean_stage.macros.get(filetype, {}), clean_stage.matchers.get(filetype)
+        def clean(span: TrackedText) -> TrackedText:
+            _, start, end = span.span()
+            if bisect_left(calls, start) == bisect_left(calls, end):
+                return span # no macro called in span
+            return clean_stage._remove_macros(span, macros, matcher)
+        return tokenized, clean
+
+    def _commands_of(self, filetype: FileType) -> frozenset[str] | None:
+        """ Commands _macro_calls and the builder need tokens for: section commands and macros. None (every command) when
+        a macro name is not a single command token, the matcher may then find it at a token with another value """
+        if filetype not in self._commands:
+            char_map = langauage_char_registry[filetype]
+            macros = self.clean_stage.macros.get(filetype, {})
+            names = [name for name, info in macros.items() if info.get("command") is not None]
+            if all(is_command_name(name, char_map) for name in names):
+                self._commands[filetype] = frozenset(self.builder_stage.section_commands(filetype)).union(names)
+            else:
+                self._commands[filetype] = None
+        return self._commands[filetype]
+
+    def _macro_calls(self, tokenized: TokenizedText, filetype: FileType) -> list[int] | None:
+        """ Offsets of the macro calls in tokenized, None if expanding macros only inside sections could give other
+        sections than expanding them everywhere. Sections are the same when every macro called is safe (see _unsafe),
+        its argument is closed, no section command lies inside a macro argument, and no comment can be formed by the
+        expansion """
+        clean_stage = self.clean_stage
+        macros, matcher = clean_stage.macros.get(filetype, {}), clean_stage.matchers.get(filetype)
+        if matcher is None or len(matcher) == 0:
+            return [] # cleaning only removes comments
+
+        char_map = tokenized.char_map
+        string = tokenized.string
+        end = len(string)
+        section_commands = self.builder_stage.section_commands(filetype)
+        unsafe = self._unsafe(filetype, section_commands)
+        openers = (char_map.arg_open_delim, char_map.opt_arg_open_delim)
+        arg_spans: list[tuple[int, int]] = [] # merged (start, end) of macro arguments
+        section_starts: list[int] = []
+        calls: list[int] = []
+        for token in tokenized.tokens:
+            # Comments formed by removing others are ignored by tokenized.delimiters but not by CleanStage
+            if token.kind == TokenKind.COMMENT:
+                return None
+            if token.kind != TokenKind.COMMAND:
+                continue
+            if filetype == FileType.Typst:
+                cmd = CleanStage._typst_macro_at(string, token.start, end, matcher)
+            else:
+                cmd = matcher.match(string, token.start + 1, end)
+            if cmd is None:
+                if token.value in section_commands:
+                    section_starts.append(token.start)
+                continue
+            calls.append(token.start)
+            if cmd in unsafe or token.value in section_commands or string[token.start - 1:token.start] == char_map.comment[-1]:
+                return None
+            if filetype == FileType.Typst and macros[cmd]["num_args"] != "1":
+                continue
+            # LaTeX macros always take an argument, CleanStage raises when it is missing
+            open_index = token.start + 1 + len(cmd)
+            closing = tokenized.delimiters.closing(open_index) if string[open_index:open_index + 1] in openers else None
+            if closing is None:
+                return None
+            if arg_spans and open_index <= arg_spans[-1][1]:
+                arg_spans[-1] = (arg_spans[-1][0], max(arg_spans[-1][1], closing))
+            else:
+                arg_spans.append((open_index, closing))
+
+        arg_starts = [start for start, _ in arg_spans]
+        for section_start in section_starts:
+            index = bisect_right(arg_starts, section_start) - 1
+            if index >= 0 and section_start <= arg_spans[index][1]:
+                return None
+        return calls
+
+    def _unsafe(self, filetype: FileType, section_commands: set[str]) -> frozenset[str]:
+        """ Macros whose expansion could change the sections found: templates with unbalanced delimiters, comments or
+        section commands, or that could join the text around the call into a delimiter group or command """
+        if filetype in self._unsafe_macros:
+            return self._unsafe_macros[filetype]
+        char_map = langauage_char_registry[filetype]
+        pairs = [(char_map.arg_open_delim, char_map.arg_close_delim), (char_map.opt_arg_open_delim, char_map.opt_arg_close_delim)]
+        comment = char_map.comment
+        unsafe = set()
+        for name, info in self.clean_stage.macros.get(filetype, {}).items():
+            template = info.get("command")
+            if template is None:
+                continue
+            stripped = template.replace("#1", "")
+            if filetype == FileType.LaTeX:
+                try:
+                    self.clean_stage._arg_padding(template)
+                except IndexError: # CleanStage fails on every call, keep failing the same way
+                    unsafe.add(name)
+                    continue
+            commands = {token.value for token in tokenize(template, char_map) if token.kind == TokenKind.COMMAND}
+            if (not all(balanced(stripped, open_delim, close_delim) for open_delim, close_delim in pairs)
+                    or comment in template or template[:1] == comment[-1] or template[-1:] == comment[0]
+                    or commands & section_commands
+                    or template[:1] in (char_map.arg_open_delim, char_map.opt_arg_open_delim)
+                    or (filetype == FileType.Typst and (_is_typst_identifier_char(template[:1]) or re.search(r"#[A-Za-z0-9_-]*$", template)))):
+                unsafe.add(name)
+        self._unsafe_macros[filetype] = frozenset(unsafe)
+        return self._unsafe_macros[filetype]
+
+
+class LazyFlashcardStage(Stage[TrackedText, Iterator[Flashcard]]):
+    """
+    Wraps a FlashcardBuilderStage or CleanBuildStage, process returns an iterator yielding each flashcard as soon as it
+    is complete (see FlashcardBuilderStage.iter_process) instead of a list, so the first cards of a long chunk can be
+    used (e.g., compiled) while the rest is parsed. Pipelines cache the cards of a chunk once its iterator is exhausted,
+    ProcessingPipeline.parallel returns lists.
+
+    Usage:
+        pipeline.add_stage(LazyFlashcardStage(CleanBuildStage(clean_stage, builder_stage)))
+        for flashcards in pipeline:
+            for flashcard in flashcards: # yielded while the chunk is parsed
+                ...
+    """
+    def __init__(self, stage: FlashcardBuilderStage | CleanBuildStage) -> None:
+        super().__init__()
+        self.stage = stage
+
+    def fingerprint(self, filetype: FileType) -> str | None:
+        # Same cards as the wrapped stage, so cache entries are shared
+        return self.stage.fingerprint(filetype)
+
+    def process(self, data: TrackedText) -> Iterator[Flashcard]:
+        flashcards = self.stage.iter_process(data)
+        while True:
+            # Steps and counters of the wrapped stage are added to this stage's record
+            self.stage._record = self._record
+            try:
+                flashcard = next(flashcards, None)
+            finally:
+                self.stage._record = None
+            if flashcard is None:
+                return
+            yield flashcard
+
+
+class CompileStage(Stage[list[Flashcard], list[Flashcard]]):
+    """
+    Stage compiling every flashcard as soon as it has been extracted. Intended for ProcessingPipeline.stream, where
+    compilation of one file's cards overlaps with reading and parsing of the next files. LaTeX cards of a chunk are
+    compiled in batches, see FlashcardCompiler.compile_batch.
+
+    Usage:
+        pipeline.add_stage(CompileStage(FlashcardCompiler(cache)))
+        for flashcards in pipeline.stream():
+            ...
+    """
+    def __init__(self, compiler: FlashcardCompiler) -> None:
+        super().__init__()
+        self.compiler = compiler
+
+    def process(self, data: list[Flashcard]) -> list[Flashcard]:
+        data = list(data)
+        with self.step("batch"):
+            try:
+                self.compiler.compile_batch(data)
+            except Exception as e:
+                logger.error(f"Failed to compile batch of {len(data)} cards: {e}")
+        for card in data:
+            try:
+                self.compiler.compile_card(card)
+            except Exception as e:
+                logger.error(f"Failed to compile card from {card.main_section.content.source}: {e}")
+        return data
+
+
+class DeduplicateStage(Stage[Iterable[Flashcard], Iterable[Flashcard]]):
+    """
+    Merges flashcards with the same section, title and content, e.g., a theorem restated in a later lecture or in a
+    course's main file. A card is yielded the first time it is found, later copies are merged into it and dropped. The
+    merged card's main section is the copy first in document order (see document_order), whatever order chunks are
+    processed in (e.g., shuffled files or parallel workers), the other copies are its duplicates (see Flashcard.sources).
+    The proof of the main section's card is kept, or any copy's proof when it has none. Content is compared once
+    comments are removed and whitespace collapsed. Macros are expanded by CleanStage before, so cards only differing by
+    the macros they use are merged too.
+
+    Copies are merged into cards already yielded, so a card's duplicates are only complete once every chunk has been
+    processed. Cards are remembered across chunks, so this stage is stateful: ProcessingPipeline caches the cards of
+    each chunk before deduplication. Lists are returned for lists, iterators for iterators. Call reset before a new run.
+
+    Usage:
+        pipeline.add_stage(CleanBuildStage(clean_stage, builder_stage))
+        pipeline.add_stage(DeduplicateStage())
+    """
+    stateful = True
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.seen: dict[str, Flashcard] = {} # key -> first card
+        self.merged = 0 # number of copies merged since the last reset
+
+    def reset(self) -> None:
+        self.seen.clear()
+        self.merged = 0
+
+    def process(self, data: Iterable[Flashcard]) -> Iterable[Flashcard]:
+        if isinstance(data, list):
+            return list(self._unique(data))
+        return self._unique(data)
+
+    def _unique(self, flashcards: Iterable[Flashcard]) -> Iterator[Flashcard]:
+        for card in flashcards:
+            key = self.key(card)
+            first = self.seen.get(key)
+            if first is None:
+                # Copies are merged into a copy of the card and of its main section, the card itself may still be cached
+                # (see ProcessingPipeline._put_cache)
+                self.seen[key] = first = replace(card, main_section=replace(card.main_section))
+                yield first
+                continue
+            self.merged += 1
+            self.count("duplicates")
+            self._merge(first, card)
+
+    @staticmethod
+    def _merge(first: Flashcard, card: Flashcard) -> None:
+        """ Merges card into first. first and its main section keep their identity, so pdfs compiled for first are kept """
+        main = first.main_section
+        previous = replace(main)
+        sections = sorted([previous, *first.duplicates, card.main_section, *card.duplicates], key=document_order)
+        winner = sections[0]
+        if winner is not previous:
+            main.content, main.title, main.location = winner.content, winner.title, winner.location
+            first.proof_section = card.proof_section or first.proof_section
+        else:
+            first.proof_section = first.proof_section or card.proof_section
+        first.duplicates = tuple(sections[1:])
+
+    def key(self, card: Flashcard) -> str:
+        """ Hash of the card's filetype, section name, title and content, normalized (see normalize) """
+        section = card.main_section
+        filetype = card.filetype()
+        title = "" if section.title is None else self.normalize(section.title, filetype)
+        digest = hashlib.sha256()
+        for part in (filetype.value, section.name, title, self.normalize(section.content, filetype)):
+            digest.update(part.encode("utf-8", errors="surrogatepass"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    @staticmethod
+    def normalize(text: TrackedText, filetype: FileType) -> str:
+        """ text without comments, whitespace runs replaced by one space and stripped """
+        char_map = langauage_char_registry.get(filetype)
+        normalized = str(text)
+        if char_map is not None:
+            # Comments running to the end of the text have no newline yet
+            normalized = _comment_pattern(char_map.comment).sub(" ", normalized + "\n")
+        return " ".join(normalized.split())
+
+    def __repr__(self) -> str:
+        return f"DeduplicateStage(seen={len(self.seen)}, merged={self.merged})"
+
+
+def document_order(section: Section) -> tuple[str, int, int]:
+    """ Sort key of a section: its source path, then its start line and column (0 when it has no location) """
+    source = section.content.source
+    if section.location is None:
+        return (str(source or ""), 0, 0)
+    source_range = section.location.range()
+    return (str(source or ""), source_range.start_line, source_range.start_column)
+
+
 class ProcessingPipeline(Generic[Output]):
-    def __init__(self, data_iterable: Iterable):
+    def __init__(self, data_iterable: Iterable, cache: ExtractionCache | None = None):
+        """
+        -- Params --
+        data_iterable: iterable of TrackedText (e.g., DataGenerator), one chunk per file
+        cache: when set, flashcards extracted from a chunk are cached and unchanged chunks skip all stages
+        """
         self.data_iterable = data_iterable
         self.stages: list[Stage] = []
         self.last_output_type = None
+        self.cache = cache
+        self.instrumentation: PipelineInstrumentation | None = None
 
     def add_stage(self, stage: Stage):
         # TODO make sure first stage takes valid input
@@ -378,20 +1023,306 @@ class ProcessingPipeline(Generic[Output]):
         if input_type is None or output_type is None:
             raise TypeError("Stage must subclass Stage[Input, Output]")
 
-        if len(self.stages) != 0 and self.last_output_type != input_type:
+        if len(self.stages) != 0 and not _accepts(input_type, self.last_output_type):
             raise TypeError(f"Incompatible stage: expected input {self.last_output_type}, got {input_type}")
         self.stages.append(stage)
-        self.last_output_type = output_type
-
-    def __iter__(self) -> Generator[list[Output], None, None]:
-        valid = get_origin(self.last_output_type) == list and get_args(self.last_output_type) == (Flashcard,)
+        # Stages declaring an Iterable output return the same kind of iterable they were given (see DeduplicateStage)
+        if get_origin(output_type) is not Iterable or len(self.stages) == 1:
+            self.last_output_type = output_type
+
+    def instrument(self, instrumentation: PipelineInstrumentation | None = None) -> PipelineInstrumentation:
+        """ Enables per stage instrumentation, records are added to instrumentation (a new one if not given) and it is returned """
+        self.instrumentation = instrumentation if instrumentation is not None else PipelineInstrumentation()
+        return self.instrumentation
+
+    def _data(self) -> Iterable:
+        if self.instrumentation is None:
+            return self.data_iterable
+        return self.instrumentation.read(self.data_iterable)
+
+    def _run_stage(self, stage: Stage, chunk, source: Path | None):
+        if self.instrumentation is None:
+            return stage.process(chunk)
+        return self.instrumentation.run(stage, chunk, source)
+
+    def _chunk_stages(self) -> list[Stage]:
+        """ Stages before the first stateful one, their output only depends on the chunk so it may be cached or computed in a worker """
+        for i, stage in enumerate(self.stages):
+            if stage.stateful:
+                return self.stages[:i]
+        return self.stages
+
+    def _run_tail(self, output, source: Path | None):
+        """ Runs the stateful stage and every stage after it on output of the chunk stages """
+        for stage in self.stages[len(self._chunk_stages()):]:
+            output = self._run_stage(stage, output, source)
+        return output
+
+    def _check_output_type(self) -> None:
+        # Iterator outputs (see LazyFlashcardStage) are yielded as is, consumers must not assume a list
+        valid = get_origin(self.last_output_type) in (list, Iterator) and get_args(self.last_output_type) == (Flashcard,)
         if not valid:
-            raise TypeError(f"Invalid pipeline: expected last stage output type to be list[Flashcard], got {self.last_output_type}")
+            raise TypeError(f"Invalid pipeline: expected last stage output type to be list[Flashcard] or Iterator[Flashcard], got {self.last_output_type}")
 
-        for chunk in self.data_iterable:
+    def __iter__(self) -> Generator[Iterable[Output], None, None]:
+        self._check_output_type()
+        for chunk in self._data():
             if chunk is None:
                 yield []
                 continue
-            for stage in self.stages:
-                chunk = stage.process(chunk)
-            yield chunk
+
+            cached, fingerprint = self._lookup_cache(chunk)
+            if cached is not None:
+                yield self._run_tail(cached, chunk.source)
+                continue
+
+            source_chunk = chunk
+            for stage in self._chunk_stages():
+                chunk = self._run_stage(stage, chunk, source_chunk.source)
+            if fingerprint is not None:
+                chunk = self._put_cache(source_chunk, fingerprint, chunk)
+            yield self._run_tail(chunk, source_chunk.source)
+
+    def parallel(self, max_workers: int | None = None, ordered: bool = True) -> Generator[list[Output], None, None]:
+        """ Same as iterating over the pipeline, except chunks are processed in a pool of worker processes. Stages are
+        pickled once and installed in each worker, so every stage must be picklable. Stateful stages, and those after
+        them, run in this process on the results of the workers.
+
+        -- Params --
+        max_workers: number of worker processes, defaults to os.cpu_count()
+        ordered: if True results are yielded in the order of data_iterable, otherwise as soon as they are ready
+        """
+        self._check_output_type()
+        max_workers = max_workers or os.cpu_count() or 1
+        max_pending = 2 * max_workers # bounds the number of chunks read ahead of the workers
+        pending: deque[tuple[Future, TrackedText | None, str | None]] = deque()
+
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(self._chunk_stages(), self.instrumentation is not None)) as executor:
+            for chunk in self._data():
+                pending.append(self._submit(executor, chunk))
+                while len(pending) >= max_pending:
+                    yield self._collect(pending, ordered)
+            while pending:
+                yield self._collect(pending, ordered)
+
+    def stream(self, maxsize: int = 2) -> Generator[Iterable[Output], None, None]:
+        """ Same as iterating over the pipeline, except reading and every stage run concurrently, each on its own thread.
+        Threads are connected by queues holding at most maxsize chunks, a stage blocks when the next one falls behind.
+        Exceptions raised by a stage are re-raised here. Closing the generator stops all threads.
+        """
+        self._check_output_type()
+        stop = threading.Event()
+        queues: list[queue.Queue[_StreamItem]] = [queue.Queue(maxsize) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._stream_source, args=(queues[0], stop), daemon=True)]
+        n_chunk_stages = len(self._chunk_stages())
+        for i, (stage, stage_input, stage_output) in enumerate(zip(self.stages, queues, queues[1:])):
+            # Output is cached by the last chunk stage when stateful stages follow it, otherwise once it reaches this thread
+            cache_output = i == n_chunk_stages - 1 and n_chunk_stages < len(self.stages)
+            args = (stage, stage_input, stage_output, stop, i >= n_chunk_stages, cache_output)
+            threads.append(threading.Thread(target=self._stream_stage, args=args, daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while (item := _stream_get(queues[-1], stop)) is not None and not item.end:
+                if item.error is not None:
+                    raise item.error
+                if item.fingerprint is not None:
+                    yield self._put_cache(item.source, item.fingerprint, item.value)
+                    continue
+                yield item.value
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _stream_source(self, output: "queue.Queue[_StreamItem]", stop: threading.Event) -> None:
+        try:
+            for chunk in self._data():
+                if chunk is None:
+                    item = _StreamItem([], done=True)
+                else:
+                    cached, fingerprint = self._lookup_cache(chunk)
+                    if cached is not None:
+                        item = _StreamItem(cached, done=True)
+                    else:
+                        item = _StreamItem(chunk, source=chunk, fingerprint=fingerprint)
+                if not _stream_put(output, item, stop):
+                    return
+        except Exception as e:
+            _stream_put(output, _StreamItem(None, error=e), stop)
+            return
+        _stream_put(output, _StreamItem(None, end=True), stop)
+
+    def _stream_stage(self,
+                      stage: Stage,
+                      stage_input: "queue.Queue[_StreamItem]",
+                      output: "queue.Queue[_StreamItem]",
+                      stop: threading.Event,
+                      tail: bool = False,
+                      cache_output: bool = False
+                      ) -> None:
+        """ Runs stage on each item of stage_input. Tail stages (see _chunk_stages) also run on done items, when
+        cache_output is set the output is cached here """
+        while (item := _stream_get(stage_input, stop)) is not None:
+            if not item.end and (tail or not item.done) and item.error is None:
+                try:
+                    item.value = self._run_stage(stage, item.value, item.source.source if item.source is not None else None)
+                    if cache_output and item.source is not None and item.fingerprint is not None:
+                        item.value = self._put_cache(item.source, item.fingerprint, item.value)
+                        item.fingerprint = None
+                except Exception as e:
+                    item = _StreamItem(None, error=e)
+            if not _stream_put(output, item, stop) or item.end:
+                return
+
+    def _submit(self, executor: ProcessPoolExecutor, chunk) -> tuple[Future, TrackedText | None, str | None]:
+        """ Returns (future result, chunk, fingerprint). Fingerprint is None unless the result must be cached """
+        if chunk is None:
+            return _completed_future(([], [])), None, None
+        cached, fingerprint = self._lookup_cache(chunk)
+        if cached is not None:
+            return _completed_future((cached, [])), chunk, None
+        return executor.submit(_process_in_worker, chunk), chunk, fingerprint
+
+    def _collect(self, pending: deque[tuple[Future, TrackedText | None, str | None]], ordered: bool) -> list[Output]:
+        """ Removes a finished entry from pending and returns its result, waits for one to finish if necessary """
+        if ordered:
+            entry = pending.popleft()
+        else:
+            wait([future for (future, _, _) in pending], return_when=FIRST_COMPLETED)
+            entry = next(entry for entry in pending if entry[0].done())
+            pending.remove(entry)
+
+        future, chunk, fingerprint = entry
+        result, records = future.result()
+        if records and self.instrumentation is not None:
+            self.instrumentation.extend(records)
+        if chunk is not None and fingerprint is not None and self.cache is not None:
+            self.cache.put(chunk, fingerprint, result)
+        return _materialize(self._run_tail(result, None if chunk is None else chunk.source))
+
+    def _put_cache(self, chunk: TrackedText, fingerprint: str, output: Iterable[Output]) -> Iterable[Output]:
+        """ Caches the output of the last stage for chunk and returns it. An iterator is cached once it is exhausted,
+        the returned iterator yields the same items """
+        if self.cache is None:
+            return output
+        if isinstance(output, list):
+            self.cache.put(chunk, fingerprint, output)
+            return output
+        return self._put_cache_when_exhausted(chunk, fingerprint, output)
+
+    def _put_cache_when_exhausted(self, chunk: TrackedText, fingerprint: str, output: Iterable[Output]) -> Generator[Output, None, None]:
+        items = []
+        for item in output:
+            items.append(item)
+            yield item
+        assert self.cache is not None
+        self.cache.put(chunk, fingerprint, items)
+
+    def _lookup_cache(self, chunk) -> tuple[list[Output] | None, str | None]:
+        """ Returns (cached result or None, fingerprint of chunk) """
+        fingerprint = self._fingerprint(chunk)
+        if fingerprint is None or self.cache is None:
+            return None, fingerprint
+        cached = self.cache.get(chunk, fingerprint)
+        if cached is not None:
+            logger.debug(f"Loaded {len(cached)} flashcards for {chunk.source} from extraction cache")
+        return cached, fingerprint
+
+    def _fingerprint(self, chunk) -> str | None:
+        """ Fingerprint of the chunk stages for chunk's filetype, None if their output for chunk can not be cached """
+        chunk_stages = self._chunk_stages()
+        if self.cache is None or not isinstance(chunk, TrackedText) or not chunk_stages:
+            return None
+        filetype = chunk.filetype()
+        fingerprints = [stage.fingerprint(filetype) for stage in chunk_stages]
+        if any(fingerprint is None for fingerprint in fingerprints):
+            return None
+        return ExtractionCache.fingerprint(fingerprints)
+
+
+def _accepts(input_type, output_type) -> bool:
+    """ True if a stage taking input_type can follow a stage returning output_type, an Iterable input accepts any
+    list or Iterator of the same items """
+    if input_type == output_type:
+        return True
+    return (get_origin(input_type) is Iterable and get_origin(output_type) in (list, Iterator, Iterable)
+            and get_args(input_type) == get_args(output_type))
+
+@lru_cache(maxsize=None)
+def _comment_pattern(comment: str) -> re.Pattern:
+    # Same pattern CleanStage has always removed comments with, i.e., comment character followed by a space
+    return re.compile(fr'{comment} .*?\n')
+
+
+# Stages used by worker processes of ProcessingPipeline.parallel, installed once per worker by _init_worker
+_worker_stages: list[Stage] = []
+_worker_instrumented: bool = False
+
+def _init_worker(stages: list[Stage], instrumented: bool = False) -> None:
+    global _worker_stages, _worker_instrumented
+    _worker_stages = stages
+    _worker_instrumented = instrumented
+
+def _process_in_worker(chunk) -> tuple[Any, list[StageRecord]]:
+    """ Returns (output of last stage, records of each stage), records are only collected when instrumented """
+    # Iterator outputs can not be sent back to the parent process, they are exhausted here
+    if not _worker_instrumented:
+        for stage in _worker_stages:
+            chunk = stage.process(chunk)
+        return _materialize(chunk), []
+    instrumentation = PipelineInstrumentation()
+    source = chunk.source
+    for stage in _worker_stages:
+        chunk = instrumentation.run(stage, chunk, source)
+    chunk = _materialize(chunk)
+    return chunk, instrumentation.records
+
+def _materialize(output: Any) -> Any:
+    return list(output) if isinstance(output, Iterator) else output
+
+def _completed_future(result) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+@dataclass
+class _StreamItem:
+    """Chunk passed between the threads of ProcessingPipeline.stream
+
+    Attributes:
+        value: chunk, or the output of the last stage that processed it
+        source: chunk as read, kept to cache the final output
+        fingerprint: pipeline fingerprint of chunk, None if the output is not cached
+        done: value is already final (e.g., loaded from cache), stages pass it on untouched
+        end: no more chunks follow
+        error: exception raised while reading or processing
+    """
+    value: Any
+    source: TrackedText | None = None
+    fingerprint: str | None = None
+    done: bool = False
+    end: bool = False
+    error: Exception | None = None
+
+def _stream_put(output: "queue.Queue[_StreamItem]", item: _StreamItem, stop: threading.Event) -> bool:
+    """ Blocking put that gives up once stop is set. Returns False if item was not put """
+    while not stop.is_set():
+        try:
+            output.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _stream_get(stage_input: "queue.Queue[_StreamItem]", stop: threading.Event) -> _StreamItem | None:
+    """ Blocking get that gives up once stop is set, in which case None is returned """
+    while not stop.is_set():
+        try:
+            return stage_input.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return None
@@ -0,0 +1,310 @@
+from pathlib import Path
+from typing import Any
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+
+from ..config import CONFIG
+from ..exceptions import TypstCompilationError
+from ..models import Flashcard, Section, SourceChunk, TrackedText
+from .._enums import FileType
+from .extraction_cache import ExtractionCache
+from .pipeline import Stage
+
+logger = logging.getLogger("mathnote")
+
+
+class TypstQueryStage(Stage[TrackedText, list[Flashcard]]):
+    """
+    Alternative to CleanStage and FlashcardBuilderStage for Typst files: sections are extracted with `typst query` rather
+    than by scanning the source. Typst evaluates the document, so every valid syntax (e.g., '()' in a body, sections
+    produced by other functions, macros) is handled the way the compiled notes show it. Other chunks (LaTeX files, files
+    read in chunks) are passed to the fallback stages, see ExtractionBackend.TypstQuery.
+
+    Sections must be exposed as metadata with a label. The section functions of the Typst preamble template
+    (templates/Typst/preamble.typ) emit it, other section functions (e.g., of the notes package) can do the same:
+
+        #let theorem(title: none, body) = {
+            [#metadata((section: "theorem", title: title, body: body)) <mathnote-section>]
+            ...
+        }
+
+    section is a section name or its Typst command (see Config.section_names), title a string or none and body a
+    string of Typst markup or content, content is converted back to markup (see content_markup). Sub sections (e.g.,
+    proof) attach to the previous card, same as FlashcardBuilderStage.add_subsection_finder. Query results have no source
+    positions, so sections have no location.
+
+    The output of a lecture depends on the files it imports, cached results are keyed by the lecture and the files in
+    dependencies (the Typst macros and preambles, and the notes package by default). Changes to other imported files are
+    not detected, clear the extraction cache after editing them.
+
+    Usage:
+        stage = TypstQueryStage(list(CONFIG.section_names), fallback=[clean_stage, builder_stage])
+        stage.add_subsection("PROOF", ["THEOREM", "LEMMA"])
+        pipeline.add_stage(stage) # one query per Typst lecture
+        flashcards = stage.process_document(course.main_file.path, root=course.path) # one query per course
+    """
+    def __init__(self,
+                 names: list[str],
+                 label: str = "mathnote-section",
+                 root: Path | None = None,
+                 typst: str = "typst",
+                 fallback: list[Stage] | None = None,
+                 dependencies: list[Path] | None = None
+                 ):
+        """
+        -- Params --
+        names: sections extracted, e.g., ["DEFINITION", "THEOREM"]
+        label: label of the section metadata
+        root: project root passed to typst (--root), defaults to the directory of each queried file
+        typst: typst executable
+        fallback: stages turning chunks that can not be queried into flashcards, e.g., [CleanStage, FlashcardBuilderStage].
+                  Such chunks raise a ValueError when not given
+        dependencies: files and directories imported by the queried files, see default_dependencies
+        """
+        super().__init__()
+        self.names = {name: d for (name, d) in CONFIG.section_names.items() if name in names}
+        self.label = label
+        self.root = root
+        self.typst = typst
+        self.fallback = fallback or []
+        self.dependencies = default_dependencies() if dependencies is None else dependencies
+        self._dependencies_digest: tuple[tuple, str] | None = None # (stat of dependencies, digest)
+        self.sub_sections: dict[str, set[str]] = {} # sub section name -> parent section names
+        # command -> section name, the first section listed wins when several share a command (see MainSectionFinder)
+        self.commands: dict[str, str] = {}
+        for name, d in CONFIG.section_names.items():
+            if FileType.Typst.value in d:
+                self.commands.setdefault(d[FileType.Typst.value], name)
+
+    def add_subsection(self, name: str, parents: list[str]) -> None:
+        self.sub_sections[name] = set(parents)
+
+    def fingerprint(self, filetype: FileType) -> str | None:
+        if filetype != FileType.Typst:
+            fingerprints = [stage.fingerprint(filetype) for stage in self.fallback]
+            if not fingerprints or any(fingerprint is None for fingerprint in fingerprints):
+                return None
+            return ExtractionCache.fingerprint(self.__class__.__name__, fingerprints)
+        sub_sections = sorted((name, sorted(parents)) for name, parents in self.sub_sections.items())
+        return ExtractionCache.fingerprint(self.__class__.__name__, sorted(self.names), sub_sections, self.label,
+                                           self.dependencies_digest())
+
+    def process(self, data: TrackedText) -> list[Flashcard]:
+        if data.filetype() != FileType.Typst or data.source is None or isinstance(data, SourceChunk):
+            if not self.fallback:
+                raise ValueError(f"{self.__class__.__name__} only queries whole Typst files, got {data.source}")
+            with self.step("fallback"):
+                for stage in self.fallback:
+                    data = stage.process(data)
+            return list(data)
+        return self.process_document(data.source, self.root)
+
+    def dependencies_digest(self) -> str:
+        """ Hash of the contents of the dependencies, recomputed when one of them is modified """
+        files = _dependency_files(self.dependencies)
+        stats = tuple((str(path), stat.st_mtime_ns, stat.st_size) for path in files if (stat := _stat(path)) is not None)
+        if self._dependencies_digest is None or self._dependencies_digest[0] != stats:
+            digest = hashlib.sha256()
+            for path, _, _ in stats:
+                digest.update(path.encode("utf-8"))
+                digest.update(hashlib.sha256(Path(path).read_bytes()).digest())
+            self._dependencies_digest = (stats, digest.hexdigest())
+        return self._dependencies_digest[1]
+
+    def process_document(self, path: Path, root: Path | None = None, cache: ExtractionCache | None = None) -> list[Flashcard]:
+        """ Flashcards of the document path, e.g., the main file of a course which includes every lecture. When cache is
+        given results are cached, keyed by the contents of every Typst file under root (or path's directory) """
+        cache_text = None
+        fingerprint = self.fingerprint(FileType.Typst)
+        if cache is not None and fingerprint is not None:
+            cache_text = _project_text(path, root or path.parent)
+            if (flashcards := cache.get(cache_text, fingerprint)) is not None:
+                logger.debug(f"Loaded {len(flashcards)} flashcards for {path} from extraction cache")
+                return flashcards
+
+        with self.step("query"):
+            values = self.query(path, root)
+        with self.step("build"):
+            flashcards = self.build_flashcards(values, path)
+        if cache is not None and cache_text is not None and fingerprint is not None:
+            cache.put(cache_text, fingerprint, flashcards)
+        return flashcards
+
+    def query(self, path: Path, root: Path | None = None) -> list[Any]:
+        """ Values of the metadata labelled self.label in path, in document order """
+        cmd = [self.typst, "query"]
+        if root is not None:
+            cmd.extend(["--root", str(root)])
+        cmd.extend([str(path), f"<{self.label}>", "--field", "value", "--format", "json"])
+        logger.debug(f"Running {' '.join(cmd)}")
+        try:
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=path.parent)
+        except FileNotFoundError as e:
+            raise TypstCompilationError(f"Typst executable '{self.typst}' not found") from e
+        if result.returncode != 0:
+            raise TypstCompilationError(f"typst query failed for {path}:\n{result.stderr.decode('utf-8', errors='replace')}")
+        try:
+            values = json.loads(result.stdout.decode("utf-8"))
+        except ValueError as e:
+            raise TypstCompilationError(f"typst query returned invalid json for {path}: {e}") from e
+        if not isinstance(values, list):
+            raise TypstCompilationError(f"typst query returned {type(values).__name__} for {path}, expected a list")
+        return values
+
+    def build_flashcards(self, values: list[Any], source: Path) -> list[Flashcard]:
+        """ Maps query values to flashcards, values that are not sections, or sections not in self.names, are skipped """
+        flashcards: list[Flashcard] = []
+        parent_section: str | None = None
+        for value in values:
+            if not isinstance(value, dict):
+                logger.warning(f"Ignoring <{self.label}> metadata that is not a dictionary in {source}: {value!r:.100}")
+                continue
+            name = self.section_name(str(value.get("section", "")))
+            if name is None:
+                continue
+            content = TrackedText(content_markup(value.get("body")), source=source)
+            title = value.get("title")
+            section = Section(name, content, title=None if title is None else TrackedText(content_markup(title), source=source))
+
+            if name in self.sub_sections:
+                if parent_section in self.sub_sections[name] and flashcards:
+                    flashcards[-1].proof_section = Section(name, content)
+                continue
+            if name not in self.names:
+                continue
+            parent_section = name
+            flashcards.append(Flashcard(section))
+        return flashcards
+
+    def section_name(self, section: str) -> str | None:
+        """ Section name of a section name (any case) or Typst command, None if unknown """
+        if section.upper() in CONFIG.section_names:
+            return section.upper()
+        return self.commands.get(section)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(sections={sorted(self.names)}, label={self.label!r}, root={self.root}, fallback={self.fallback})"
+
+
+def default_dependencies() -> list[Path]:
+    """ Files imported by Typst lectures: the Typst macros and preamble (see Config.template_files), their copies under
+    root/Preambles and the local notes package, if installed """
+    templates = CONFIG.template_files.get(FileType.Typst, {})
+    dependencies = [templates[name] for name in ("macros", "preamble") if name in templates]
+    preambles_dir = CONFIG.root_path / "Preambles" / FileType.Typst.value
+    if preambles_dir.is_dir():
+        dependencies.append(preambles_dir)
+    package_dir = _typst_data_dir() / "packages" / "local" / "notes"
+    if package_dir.is_dir():
+        dependencies.append(package_dir)
+    return dependencies
+
+
+def _typst_data_dir() -> Path:
+    """ Directory of typst's local packages, see https://github.com/typst/packages#local-packages """
+    if sys.platform == "darwin":
+        return Path.home() / "Library" / "Application Support" / "typst"
+    if sys.platform == "win32":
+        return Path(os.environ.get("APPDATA", Path.home())) / "typst"
+    return Path(os.environ.get("XDG_DATA_HOME", Path.home() / ".local" / "share")) / "typst"
+
+
+def _dependency_files(dependencies: list[Path]) -> list[Path]:
+    """ Files of dependencies, directories are expanded to the files they contain """
+    files: list[Path] = []
+    for dependency in dependencies:
+        if dependency.is_dir():
+            files.extend(sorted(path for path in dependency.rglob("*") if path.is_file()))
+        else:
+            files.append(dependency)
+    return files
+
+
+def _stat(path: Path) -> os.stat_result | None:
+    try:
+        return path.stat()
+    except OSError:
+        return None
+
+
+def _project_text(path: Path, root: Path) -> TrackedText:
+    """ Text standing for every Typst file under root, so an extraction cache entry of path is invalidated when any of them changes """
+    digest = hashlib.sha256()
+    for file_path in sorted(root.rglob(f"*{FileType.Typst.extension}")):
+        digest.update(str(file_path.relative_to(root)).encode("utf-8"))
+        digest.update(hashlib.sha256(file_path.read_bytes()).digest())
+    return TrackedText(digest.hexdigest(), source=path)
+
+
+# Markup of content elements that only wrap their body
+_MARKUP_DELIMITERS = {"strong": ("*", "*"), "emph": ("_", "_"), "lr": ("", ""), "item": ("- ", ""), "list.item": ("- ", ""), "enum.item": ("+ ", "")}
+
+def content_markup(content: Any, math: bool = False) -> str:
+    """ Typst markup for content serialized by typst query. Text, spacing, emphasis, lists, headings, raw text and
+    common math elements are converted, other elements are replaced by their body or children """
+    if content is None:
+        return ""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, (int, float, bool)):
+        return str(content)
+    if isinstance(content, list):
+        return "".join(content_markup(child, math) for child in content)
+    if not isinstance(content, dict):
+        return str(content)
+
+    func = content.get("func")
+    if func in ("text", "symbol"):
+        return str(content.get("text", ""))
+    if func == "space":
+        return " "
+    if func == "linebreak":
+        return "\\\n"
+    if func == "parbreak":
+        return "\n\n"
+    if func == "smartquote":
+        return '"' if content.get("double", True) else "'"
+    if func == "sequence":
+        return content_markup(content.get("children", []), math)
+    if func == "raw":
+        text = str(content.get("text", ""))
+        if content.get("block"):
+            return f"```{content.get('lang') or ''}\n{text}\n```"
+        return f"`{text}`"
+    if func == "heading":
+        return f"{'=' * int(content.get('depth', content.get('level', 1)))} {content_markup(content.get('body'), math)}"
+    if func == "equation":
+        body = content_markup(content.get("body"), math=True)
+        return f"$ {body} $" if content.get("block") else f"${body}$"
+    if func == "attach" and math:
+        markup = _math_group(content.get("base"))
+        if content.get("b") is not None:
+            markup += f"_{_math_group(content['b'])}"
+        if content.get("t") is not None:
+            markup += f"^{_math_group(content['t'])}"
+        return markup
+    if func == "frac" and math:
+        return f"{_math_group(content.get('num'))}/{_math_group(content.get('denom'))}"
+    if func == "root" and math:
+        radicand = content_markup(content.get("radicand"), math)
+        if content.get("index") is None:
+            return f"sqrt({radicand})"
+        return f"root({content_markup(content['index'], math)}, {radicand})"
+    if func in _MARKUP_DELIMITERS:
+        start, end = _MARKUP_DELIMITERS[func]
+        return f"{start}{content_markup(content.get('body'), math)}{end}"
+
+    logger.debug(f"No markup for content element '{func}', using its body")
+    if "body" in content:
+        return content_markup(content["body"], math)
+    if "children" in content:
+        return content_markup(content["children"], math)
+    return str(content.get("text", ""))
+
+def _math_group(content: Any) -> str:
+    markup = content_markup(content, math=True)
+    return markup if len(markup) <= 1 else f"({markup})"
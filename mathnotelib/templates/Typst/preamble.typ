@@ -0,0 +1,16 @@
+// Section functions, e.g., #theorem(title: "Pythagorean theorem")[$a^2 + b^2 = c^2$]
+// Each section is also emitted as <mathnote-section> metadata, which `mathnote flashcard index --backend typst-query`
+// reads with `typst query`. Section names must match the keys of "section-names" in config.json
+#let mathnote-section(section, title, body) = {
+  [#metadata((section: section, title: title, body: body)) <mathnote-section>]
+  let name = upper(section.first()) + section.slice(1)
+  let heading = if title == none [#name] else [#name (#title)]
+  block(width: 100%, inset: 8pt, stroke: 0.5pt)[#strong(heading) #body]
+}
+
+#let definition(title: none, body) = mathnote-section("definition", title, body)
+#let theorem(title: none, body) = mathnote-section("theorem", title, body)
+#let lemma(title: none, body) = mathnote-section("lemma", title, body)
+#let proposition(title: none, body) = mathnote-section("proposition", title, body)
+#let corollary(title: none, body) = mathnote-section("corollary", title, body)
+#let proof(body) = mathnote-section("proof", none, body)
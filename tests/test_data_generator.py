@@ -0,0 +1,71 @@
+from pathlib import Path
+import tempfile
+import unittest
+
+from mathnotelib._enums import FileType
+from mathnotelib.models import SourceChunk
+from mathnotelib.services import CleanStage, DataGenerator, FlashcardBuilderStage
+
+
+def lecture(sections: int) -> str:
+    """ Sections with non-ASCII text, blank lines and comments inside sections, proofs directly after theorems """
+    parts = []
+    for i in range(sections):
+        if i % 3 == 0:
+            parts.append(f"\\theo{{Théorème {i}}}{{Soit $x \\in \\mathbb{{R}}$ 🙂\n\n% {{ unbalanced in a comment\nalors {i}}}\n"
+                         f"\\pf{{}}{{Preuve {i} ∎}}\n")
+        else:
+            parts.append(f"\\defin{{Définition {i}}}{{naïve {{nested {{{i}}}}}\n\nsecond paragraph}}\n")
+        parts.append("Text between sections, über.\n\n")
+    return "".join(parts)
+
+
+class ChunkedDataGeneratorTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self._tmpdir.name) / "lec_01.tex"
+        self.text = lecture(60)
+        self.path.write_text(self.text, encoding='utf-8')
+        self.clean_stage = CleanStage({FileType.LaTeX: {}, FileType.Typst: {}})
+        self.build_stage = FlashcardBuilderStage(["DEFINITION", "THEOREM"])
+        self.build_stage.add_subsection_finder("PROOF", ["THEOREM"])
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def cards(self, chunk_size: int | None) -> list[tuple]:
+        cards = []
+        for chunk in DataGenerator([self.path], chunk_size=chunk_size):
+            for card in self.build_stage.process(self.clean_stage.process(chunk)):
+                proof = card.proof_section
+                cards.append((card.main_section.name, str(card.main_section.title), str(card.main_section.content),
+                              card.main_section.location, None if proof is None else (str(proof.content), proof.location)))
+        return cards
+
+    def test_chunk_offsets(self):
+        chunks = list(DataGenerator([self.path], chunk_size=500))
+        self.assertGreater(len(chunks), 5)
+        self.assertEqual("".join(str(chunk) for chunk in chunks), self.text)
+        for chunk in chunks:
+            self.assertIsInstance(chunk, SourceChunk)
+            self.assertEqual(str(chunk), self.text[chunk.offset:chunk.offset + len(chunk)])
+            self.assertEqual(chunk.byte_offset, len(self.text[:chunk.offset].encode("utf-8")))
+            # Chunks start at a section or at the text between sections, never inside one
+            text = str(chunk).lstrip("\n")
+            self.assertTrue(not text or text.startswith(("\\theo", "\\defin", "Text")), text[:40])
+
+    def test_chunks_keep_sections(self):
+        whole = self.cards(None)
+        self.assertEqual(len(whole), 60)
+        self.assertEqual(sum(proof is not None for *_, proof in whole), 20)
+        for chunk_size in (1, 200, 1000, 10_000):
+            self.assertEqual(self.cards(chunk_size), whole, chunk_size)
+
+    def test_small_files_are_read_whole(self):
+        chunks = list(DataGenerator([self.path], chunk_size=len(self.text.encode("utf-8"))))
+        self.assertEqual(len(chunks), 1)
+        self.assertNotIsInstance(chunks[0], SourceChunk)
+
+
+if __name__ == "__main__":
+    unittest.main()
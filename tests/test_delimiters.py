@@ -0,0 +1,86 @@
+from pathlib import Path
+import random
+import unittest
+
+from mathnotelib.services.delimiters import DelimiterIndex, UnbalancedDelimiter
+
+
+PAIRS = [("{", "}"), ("[", "]"), ("(", ")")]
+
+
+def counted_closing(buffer: str, index: int, open_delim: str, close_delim: str, excluded: set[int]) -> int | None:
+    """ Closing delimiter found by counting from buffer[index] until the depth returns to zero """
+    depth = 0
+    for position in range(index, len(buffer)):
+        if position in excluded:
+            continue
+        if buffer[position] == open_delim:
+            depth += 1
+        elif buffer[position] == close_delim:
+            depth -= 1
+            if depth == 0:
+                return position
+    return None
+
+
+class DelimiterIndexTest(unittest.TestCase):
+    def check(self, buffer: str, exclude: list[tuple[int, int]] | None = None):
+        exclude = exclude or []
+        index = DelimiterIndex(buffer, PAIRS, exclude=exclude)
+        excluded = {position for start, end in exclude for position in range(start, end)}
+        closes = {open_delim: close_delim for open_delim, close_delim in PAIRS}
+        matched = set()
+        for position, char in enumerate(buffer):
+            expected = None
+            if char in closes and position not in excluded:
+                expected = counted_closing(buffer, position, char, closes[char], excluded)
+            self.assertEqual(index.closing(position), expected, (buffer, position))
+            if expected is not None:
+                matched.update((position, expected))
+        unbalanced = [position for position, char in enumerate(buffer)
+                      if char in "{}[]()" and position not in excluded and position not in matched]
+        self.assertEqual([delimiter.offset for delimiter in index.unbalanced()], unbalanced, buffer)
+
+    def test_nested(self):
+        self.check("\\defin{A}{x {y [z] (w)} {}}")
+        self.check("{[}]")
+        self.check("((a)[b{c}])")
+
+    def test_unbalanced(self):
+        self.check("}{")
+        self.check("{{}")
+        self.check("{}}{[)")
+
+    def test_random(self):
+        rng = random.Random(0)
+        for _ in range(1000):
+            buffer = "".join(rng.choice("{}[]() é\n") for _ in range(rng.randint(0, 40)))
+            self.check(buffer)
+            start = rng.randint(0, len(buffer))
+            self.check(buffer, [(start, rng.randint(start, len(buffer)))])
+
+    def test_exclude(self):
+        buffer = "{a % }\n}"
+        index = DelimiterIndex(buffer, [("{", "}")], exclude=[(3, 7)])
+        self.assertEqual(index.closing(0), 7)
+        self.assertEqual(index.unbalanced(), [])
+
+    def test_unbalanced_location(self):
+        buffer = "{é}\n  ]\nab {"
+        index = DelimiterIndex(buffer, PAIRS, source=Path("lecture.tex"))
+        self.assertEqual(index.unbalanced(), [
+            UnbalancedDelimiter("]", 6, 2, 3, Path("lecture.tex")),
+            UnbalancedDelimiter("{", 11, 3, 4, Path("lecture.tex")),
+            ])
+        self.assertEqual(str(index.unbalanced()[0]), "lecture.tex:2:3: unbalanced ']'")
+        with self.assertLogs("mathnote", level="WARNING") as logs:
+            index.log_unbalanced()
+        self.assertEqual(len(logs.records), 2)
+
+    def test_empty(self):
+        index = DelimiterIndex("", PAIRS)
+        self.assertEqual((len(index), index.unbalanced(), index.closing(0)), (0, [], None))
+
+
+if __name__ == "__main__":
+    unittest.main()
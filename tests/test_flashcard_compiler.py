@@ -0,0 +1,117 @@
+from pathlib import Path
+from unittest import mock
+import tempfile
+import unittest
+
+from mathnotelib.models import Flashcard, Section, TrackedText
+from mathnotelib.services import flashcard_compiler
+from mathnotelib.services.flashcard_compiler import FlashcardCache, FlashcardCompiler
+
+
+class CompilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        cache_dir = Path(self._tmpdir.name) / "cache"
+        (cache_dir / "pdf").mkdir(parents=True)
+        self.cache = FlashcardCache(cache_dir)
+        self.compiler = FlashcardCompiler(self.cache, typst_macros={})
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+
+class CompileLatexBatchTest(CompilerTestCase):
+    """ _compile_pages is replaced by a fake compiling every batch without a 'bad' fragment """
+    def compile(self, fragments: list[str]) -> tuple[bool, list[list[str]], list[str]]:
+        runs: list[list[str]] = []
+        compiled: list[str] = []
+
+        def compile_pages(batch: list[str]) -> bool:
+            runs.append(batch)
+            if any(fragment.startswith("bad") for fragment in batch):
+                return False
+            compiled.extend(batch)
+            return True
+
+        with mock.patch.object(self.compiler, "_compile_pages", side_effect=compile_pages):
+            result = self.compiler._compile_latex_batch(fragments)
+        return result, runs, compiled
+
+    def test_compiles_once(self):
+        fragments = [f"f{i}" for i in range(8)]
+        self.assertEqual(self.compile(fragments), (True, [fragments], fragments))
+
+    def test_failing_fragment_in_second_half(self):
+        fragments = ["f0", "f1", "f2", "f3", "bad4", "f5", "f6", "f7"]
+        result, runs, compiled = self.compile(fragments)
+        self.assertFalse(result)
+        # The second half is known to fail once the first half compiles, it is split without being compiled
+        self.assertEqual(runs, [fragments, fragments[:4], fragments[4:6], fragments[6:]])
+        self.assertEqual(compiled, ["f0", "f1", "f2", "f3", "f6", "f7"])
+
+    def test_failing_fragment_in_first_half(self):
+        fragments = ["f0", "bad1", "f2", "f3", "f4", "f5", "f6", "f7"]
+        result, runs, compiled = self.compile(fragments)
+        self.assertFalse(result)
+        self.assertEqual(runs, [fragments, fragments[:4], fragments[:2], fragments[2:4], fragments[4:]])
+        self.assertEqual(compiled, ["f2", "f3", "f4", "f5", "f6", "f7"])
+
+    def test_single_fragment(self):
+        self.assertEqual(self.compile(["f0"]), (False, [], []))
+
+
+class CompilePagesTest(CompilerTestCase):
+    """ latexmk and pdfseparate are replaced by fakes writing one file per page """
+    def compile(self, fragments: list[str], pages: int | None = None, return_code: int = 0) -> bool:
+        def compile_latex_to_pdf(source_path: Path, options) -> tuple[int, str, str]:
+            self.assertIn("\\begin{flashcardpage}", source_path.read_text(encoding='utf-8'))
+            options.resolved_output_path().write_text("pdf", encoding='utf-8')
+            return return_code, "error" if return_code else "", ""
+
+        def split_pdf(pdf_path: Path, output_dir: Path) -> list[Path]:
+            paths = []
+            for page in range(len(fragments) if pages is None else pages):
+                path = output_dir / f"{pdf_path.stem}-page-{page + 1}.pdf"
+                path.write_text(f"page {page + 1}", encoding='utf-8')
+                paths.append(path)
+            return paths
+
+        with mock.patch.object(flashcard_compiler, "compile_latex_to_pdf", side_effect=compile_latex_to_pdf), \
+                mock.patch.object(flashcard_compiler, "split_pdf", side_effect=split_pdf):
+            return self.compiler._compile_pages(fragments)
+
+    def test_pages_are_cached_in_order(self):
+        fragments = ["$a$", "$b$", "$c$"]
+        self.assertTrue(self.compile(fragments))
+        for page, fragment in enumerate(fragments, 1):
+            self.assertEqual(self.cache.get(fragment).read_text(encoding='utf-8'), f"page {page}")
+
+    def test_page_count_mismatch(self):
+        with self.assertLogs(flashcard_compiler.logger, level="WARNING"):
+            self.assertTrue(self.compile(["$a$", "$b$"], pages=1))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_compilation_failure(self):
+        self.assertFalse(self.compile(["$a$", "$b$"], return_code=12))
+        self.assertEqual(len(self.cache), 0)
+
+
+class CompileBatchTest(CompilerTestCase):
+    def test_fragments(self):
+        source = Path("lecture.tex")
+        cards = [
+                Flashcard(Section("THEOREM", TrackedText("$a$", source=source), title=TrackedText("A", source=source)),
+                          Section("PROOF", TrackedText("$b$", source=source))),
+                Flashcard(Section("DEFINITION", TrackedText("$a$", source=source), title=TrackedText(" ", source=source))),
+                Flashcard(Section("DEFINITION", TrackedText("$c$", source=Path("lecture.typ")))),
+                ]
+        self.compiler.batch_size = 2
+        with mock.patch.object(flashcard_compiler, "can_split_pdf", return_value=True), \
+                mock.patch.object(self.compiler, "_compile_latex_batch") as compile_latex_batch:
+            self.compiler.compile_batch(cards)
+        # Titles, contents and proofs in order, without duplicates, blank and Typst fragments
+        self.assertEqual([call.args[0] for call in compile_latex_batch.call_args_list], [["A", "$a$"], ["$b$"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+from pathlib import Path
+import json
+import tempfile
+import unittest
+
+from mathnotelib.config import CONFIG
+from mathnotelib.services import FlashcardIndexer
+
+
+class DedupRecordsTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmpdir.name)
+        course = self.root / "Courses" / "Analysis-101"
+        lectures = course / "main" / "lectures"
+        lectures.mkdir(parents=True)
+        (course / "course_info.json").write_text(json.dumps({"weekdays": ""}), encoding='utf-8')
+        (course / "main" / "main.tex").write_text("", encoding='utf-8')
+        (lectures / "lec_01.tex").write_text("\\defin{Heine}{Compact iff closed and bounded}\n", encoding='utf-8')
+        (lectures / "lec_03.tex").write_text("\\defin{Heine}{Compact  iff closed % restated\nand bounded}\n", encoding='utf-8')
+        self._root_path = CONFIG.root_path
+        CONFIG.root_path = self.root
+
+    def tearDown(self):
+        CONFIG.root_path = self._root_path
+        self._tmpdir.cleanup()
+
+    def test_first_record_lists_duplicates(self):
+        for workers in (1, 2):
+            indexer = FlashcardIndexer(CONFIG, section_names=["DEFINITION"], workers=workers, dedup=True)
+            records = list(indexer.records())
+            self.assertEqual(len(records), 1)
+            self.assertTrue(records[0]["source"].endswith("lec_01.tex"))
+            self.assertEqual([Path(duplicate["source"]).name for duplicate in records[0]["duplicates"]], ["lec_03.tex"])
+            self.assertEqual(records[0]["duplicates"][0]["location"]["start_line"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+from pathlib import Path
+import tempfile
+import unittest
+
+from mathnotelib.services import DocumentGenerator, IncludeGraph
+
+
+class DocumentGeneratorTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmpdir.name)
+        (self.root / "lectures").mkdir()
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def write(self, name: str, text: str) -> Path:
+        path = self.root / name
+        path.write_text(text, encoding='utf-8')
+        return path
+
+    def chunks(self, main: Path, **kwargs) -> list[tuple[str, str]]:
+        return [(chunk.source.name, str(chunk)) for chunk in DocumentGenerator([main], **kwargs) if chunk is not None]
+
+    def test_document_order(self):
+        main = self.write("main.tex", "\\input{preamble}\n\\begin{document}\nA\n\\input{lectures/lec_01}\nB\n\\include{lectures/lec_02.tex}\nC\n")
+        self.write("preamble.tex", "\\usepackage{amsmath}\n")
+        self.write("lectures/lec_01.tex", "L1 \\input{lectures/lec_03} L1 end\n")
+        self.write("lectures/lec_02.tex", "L2\n")
+        self.write("lectures/lec_03.tex", "L3\n")
+        self.assertEqual(self.chunks(main), [
+            ("main.tex", "\\input{preamble}\n\\begin{document}\nA\n"),
+            ("lec_01.tex", "L1 "),
+            ("lec_03.tex", "L3\n"),
+            ("lec_01.tex", " L1 end\n"),
+            ("main.tex", "\nB\n"),
+            ("lec_02.tex", "L2\n"),
+            ("main.tex", "\nC\n"),
+            ])
+
+    def test_skipped_includes(self):
+        main = self.write("main.tex", "% \\input{lectures/lec_01}\n\\defin{A}{\\input{lectures/lec_01}}\n")
+        self.write("lectures/lec_01.tex", "L1\n")
+        self.assertEqual(self.chunks(main), [("main.tex", "% \\input{lectures/lec_01}\n\\defin{A}{\\input{lectures/lec_01}}\n")])
+
+    def test_extra_and_exclude(self):
+        main = self.write("main.tex", "\\input{lectures/lec_01}\n\\input{lectures/lec_02}\n")
+        lectures = [self.write(f"lectures/lec_0{i}.tex", f"L{i}\n") for i in (1, 2, 3)]
+        chunks = self.chunks(main, extra=lectures, exclude=[lectures[1]])
+        self.assertEqual([name for name, _ in chunks], ["lec_01.tex", "main.tex", "main.tex", "lec_03.tex"])
+
+    def test_cycles_and_missing_targets(self):
+        main = self.write("main.typ", '#include "lectures/lec_01.typ"\n#include "lectures/missing.typ"\n')
+        self.write("lectures/lec_01.typ", 'L1 #include "/main.typ" #include "lec_02.typ"\n')
+        self.write("lectures/lec_02.typ", "L2\n")
+        with self.assertLogs("mathnote", level="WARNING") as logs:
+            chunks = self.chunks(main)
+        self.assertEqual([name for name, _ in chunks], ["lec_01.typ", "lec_01.typ", "lec_02.typ", "lec_01.typ", "main.typ", "main.typ"])
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn("Include cycle", logs.output[0])
+        self.assertIn("does not exist", logs.output[1])
+
+
+class IncludeGraphCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmpdir.name)
+        self.cache_dir = self.root / "cache"
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def test_one_entry_per_file(self):
+        graph = IncludeGraph(self.cache_dir)
+        path = self.root / "main.tex"
+        first = graph.includes("\\input{a}\n", path)
+        self.assertEqual([include.target for include in first], ["a"])
+        self.assertEqual([include.target for include in graph.includes("\\input{b}\n", path)], ["b"])
+        self.assertEqual(len(list(self.cache_dir.glob("*.json"))), 1)
+        # Entries are validated with the hash of the contents
+        graph = IncludeGraph(self.cache_dir)
+        self.assertEqual([include.target for include in graph.includes("\\input{c}\n", path)], ["c"])
+        self.assertEqual([include.target for include in IncludeGraph(self.cache_dir).includes("\\input{c}\n", path)], ["c"])
+
+    def test_nodes_are_bounded(self):
+        graph = IncludeGraph(max_nodes=2)
+        paths = [self.root / f"lec_0{i}.typ" for i in range(4)]
+        for path in paths:
+            graph.includes(f'#include "{path.name}"\n', path)
+        graph.includes('#include "lec_02.typ"\n', paths[2])
+        graph.includes("", self.root / "other.typ")
+        self.assertEqual(list(graph._nodes), [paths[2], self.root / "other.typ"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+from pathlib import Path
+import random
+import unittest
+
+from mathnotelib._enums import FileType
+from mathnotelib.models import SourceMap, TrackedText, langauage_char_registry
+from mathnotelib.services.lexer import Token, TokenKind, TokenizedText, tokenize, tokenize_commands
+from mathnotelib.services.pipeline import MainSectionFinder
+
+
+LATEX = langauage_char_registry[FileType.LaTeX]
+TYPST = langauage_char_registry[FileType.Typst]
+
+PIECES = ["\\", "#", "{", "}", "[", "]", "(", ")", "% ", "%", "// ", "\n", " ", "a", "1", "-", "_",
+          "defin", "theo", "pf", "definition", "theorem", "proof"]
+
+
+def random_text(rng: random.Random) -> str:
+    return "".join(rng.choice(PIECES) for _ in range(rng.randint(0, 60)))
+
+
+class TokenizeTest(unittest.TestCase):
+    def test_latex(self):
+        text = "\\defin{A}{x \\{ y} % {c}\n\\\\z"
+        self.assertEqual(tokenize(text, LATEX), [
+            Token(TokenKind.COMMAND, 0, 6, "defin"),
+            Token(TokenKind.OPEN, 6, 7, "{"),
+            Token(TokenKind.CLOSE, 8, 9, "}"),
+            Token(TokenKind.OPEN, 9, 10, "{"),
+            Token(TokenKind.COMMAND, 12, 13, ""),
+            Token(TokenKind.OPEN, 13, 14, "{"),
+            Token(TokenKind.CLOSE, 16, 17, "}"),
+            Token(TokenKind.COMMENT, 18, 24, "% {c}\n"),
+            Token(TokenKind.COMMAND, 24, 25, ""),
+            Token(TokenKind.COMMAND, 25, 27, "z"),
+            ])
+
+    def test_typst_names(self):
+        tokens = tokenize('#proof-of[x] #a_1(y) // #no\n', TYPST)
+        self.assertEqual([(token.kind, token.value) for token in tokens], [
+            (TokenKind.COMMAND, "proof-of"), (TokenKind.OPEN, "["), (TokenKind.CLOSE, "]"),
+            (TokenKind.COMMAND, "a_1"), (TokenKind.OPEN, "("), (TokenKind.CLOSE, ")"),
+            (TokenKind.COMMENT, "// #no\n"),
+            ])
+
+    def test_tokenize_commands_matches_tokenize(self):
+        rng = random.Random(0)
+        cases = [(LATEX, ["defin", "theo", "pf", "a1"]), (TYPST, ["definition", "theorem", "proof", "a-1"])]
+        for _ in range(500):
+            text = random_text(rng)
+            for char_map, commands in cases:
+                tokens = [token for token in tokenize(text, char_map) if token.kind in (TokenKind.COMMAND, TokenKind.COMMENT)]
+                self.assertEqual(tokenize_commands(text, char_map), tokens, text)
+                selected = [token for token in tokens if token.kind == TokenKind.COMMENT or token.value in commands]
+                self.assertEqual(tokenize_commands(text, char_map, commands), selected, text)
+
+
+class SectionAtTest(unittest.TestCase):
+    """ section_at must build the same sections as the character walk of find_section """
+    def setUp(self):
+        self.finder = MainSectionFinder(["DEFINITION", "THEOREM", "PROOF"])
+
+    def sections(self, string: str, source: Path) -> list[tuple]:
+        text = TrackedText(string, source=source, origin=SourceMap.from_text(string))
+        tokenized = TokenizedText.from_text(text)
+        sections = []
+        for token in tokenized.tokens:
+            section, end = self.finder.section_at(tokenized, token)
+            if section is None:
+                continue
+            legacy, legacy_end = self.finder.find_section(text[token.start:])
+            self.assertIsNotNone(legacy)
+            # find_section returns the offset of the character before the closing delimiter
+            self.assertEqual(end, token.start + legacy_end + 1)
+            self.assertEqual(string[end], tokenized.char_map.opt_arg_close_delim)
+            self.assertEqual((str(section.title), str(section.content)), (str(legacy.title), str(legacy.content)))
+            sections.append((section.name, str(section.title), str(section.content), section.location.range().start_line))
+        return sections
+
+    def test_latex(self):
+        string = "Intro\n\\defin{Group}{A set {with} an\noperation}\n% \\theo{Commented}{out}\n\\theo{}{x}\\pf{}{\\defin{Inner}{y}}\n"
+        self.assertEqual(self.sections(string, Path("lecture.tex")), [
+            ("DEFINITION", "Group", "A set {with} an\noperation", 2),
+            ("THEOREM", "", "x", 5),
+            ("PROOF", "", "\\defin{Inner}{y}", 5),
+            ("DEFINITION", "Inner", "y", 5),
+            ])
+
+    def test_typst(self):
+        string = '#definition(title: "Group")[A set [with] (an) operation]\n#theorem[x]\n#proof()[y] #definitions[no]\n'
+        self.assertEqual(self.sections(string, Path("lecture.typ")), [
+            ("DEFINITION", "Group", "A set [with] (an) operation", 1),
+            ("THEOREM", "None", "x", 2),
+            ("PROOF", "", "y", 3),
+            ])
+
+    def test_unbalanced(self):
+        text = TrackedText("\\defin{A}{never closed\n\\theo{B}{x}", source=Path("lecture.tex"))
+        with self.assertLogs("mathnote", level="WARNING"):
+            tokenized = TokenizedText.from_text(text)
+        results = [self.finder.section_at(tokenized, token) for token in tokenized.tokens if token.kind == TokenKind.COMMAND]
+        self.assertEqual(results[0], (None, 0))
+        self.assertEqual(str(results[1][0].content), "x")
+
+
+if __name__ == "__main__":
+    unittest.main()
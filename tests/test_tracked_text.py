@@ -0,0 +1,26 @@
+import pickle
+import unittest
+
+from mathnotelib.models import SourceMap, TrackedText
+
+
+class TrackedTextViewTest(unittest.TestCase):
+    def test_find_matches_str_find(self):
+        view = TrackedText("xxabcabcxx")[2:8]
+        text = "abcabc"
+        for sub in ("", "a", "c", "bc", "x"):
+            for begin in range(-8, 9):
+                for stop in (None, *range(-8, 9)):
+                    self.assertEqual(view.find(sub, begin, stop), text.find(sub, begin, stop), (sub, begin, stop))
+
+    def test_pickle_keeps_location(self):
+        buffer = "first\nsecond line\n"
+        view = TrackedText(buffer, origin=SourceMap.from_text(buffer))[6:12]
+        restored = pickle.loads(pickle.dumps(view))
+        self.assertEqual(str(restored), "second")
+        self.assertEqual((restored.location().line, restored.location().column), (2, view.location().column))
+        self.assertEqual(restored.location(), view.location())
+
+
+if __name__ == "__main__":
+    unittest.main()
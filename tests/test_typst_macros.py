@@ -0,0 +1,81 @@
+from pathlib import Path
+import unittest
+
+from mathnotelib._enums import FileType
+from mathnotelib.models import TrackedText
+from mathnotelib.models.macros import parse_typst_macros, requires_package
+from mathnotelib.services import CleanStage
+
+
+MACROS_TYP = """#let R = $bb(R)$
+#let norm(x) = $lr(|| #x ||)$
+#let b(x) = [*#x*]
+#let twice(body) = [#body and #body]
+#let pair(a, b) = $(#a, #b)$
+#let defin(title, body) = block(body)
+""".splitlines()
+
+
+class ParseTypstMacrosTest(unittest.TestCase):
+    def test_templates(self):
+        macros = parse_typst_macros(MACROS_TYP, reserved=["defin"])
+        self.assertEqual(macros["R"], {"num_args": "0", "command": "$bb(R)$"})
+        self.assertEqual(macros["norm"], {"num_args": "1", "command": "$lr(|| #1 ||)$"})
+        self.assertEqual(macros["b"], {"num_args": "1", "command": "*#1*"})
+        self.assertEqual(macros["pair"], {"num_args": "2", "command": None})
+        self.assertNotIn("defin", macros)
+
+
+class ExpandTypstMacrosTest(unittest.TestCase):
+    def setUp(self):
+        self.macros = parse_typst_macros(MACROS_TYP, reserved=["defin"])
+        self.stage = CleanStage({FileType.Typst: self.macros, FileType.LaTeX: {}})
+
+    def clean(self, string: str) -> str:
+        return str(self.stage.process(TrackedText(string, source=Path("lecture.typ"))))
+
+    def test_markup(self):
+        self.assertEqual(self.clean("Let #R be a field, #b[y] holds"), "Let #($bb(R)$) be a field, #[*#[y]*] holds")
+
+    def test_math(self):
+        # The expansion is an expression, the equation is not closed early and '*' stays strong emphasis
+        self.assertEqual(self.clean("$x in #R$"), "$x in #($bb(R)$)$")
+        self.assertEqual(self.clean("$#b[y]$"), "$#[*#[y]*]$")
+        self.assertEqual(self.clean("$#norm($x$)$"), "$#($lr(|| #($x$) ||)$)$")
+
+    def test_nested(self):
+        self.assertEqual(self.clean("#b[#norm[#R]]"), "#[*#[#($lr(|| #[#($bb(R)$)] ||)$)]*]")
+        self.assertEqual(self.clean("#twice[#R]"), "#[#[#($bb(R)$)] and #[#($bb(R)$)]]")
+
+    def test_calls_left_as_is(self):
+        for string in ["#pair(x, y)", "#norm(x)[y]", "#R.at(0)", "#R-x", "R and $R$", "#norm"]:
+            self.assertEqual(self.clean(string), string)
+
+    def test_locations(self):
+        source = "Text\n#b[inside]"
+        cleaned = self.stage.process(TrackedText(source, source=Path("lecture.typ")))
+        index = str(cleaned).index("inside")
+        location = cleaned[index:index + len("inside")].location()
+        self.assertEqual((location.line, location.column), (2, 4))
+
+
+class RequiresPackageTest(unittest.TestCase):
+    def setUp(self):
+        self.macros = parse_typst_macros(MACROS_TYP + ["#let e = [e]"], reserved=["defin"])
+
+    def test_inlined_text(self):
+        self.assertFalse(requires_package("Let $x in bb(R)$ be real.", self.macros))
+        self.assertFalse(requires_package("Let e be the identity.", self.macros))
+        self.assertFalse(requires_package("The norm of $x$", self.macros))
+        self.assertFalse(requires_package("$x in #($bb(R)$)$", self.macros))
+
+    def test_references(self):
+        self.assertTrue(requires_package("#pair(x, y)", self.macros))
+        self.assertTrue(requires_package("$norm(x) + 1$", self.macros))
+
+    def test_no_macros(self):
+        self.assertTrue(requires_package("text", {}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+from pathlib import Path
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+from mathnotelib._enums import FileType
+from mathnotelib.models import TrackedText
+from mathnotelib.services import CleanStage, FlashcardBuilderStage, TypstQueryStage
+from mathnotelib.services.typst_query import content_markup
+
+
+def text(string: str) -> dict:
+    return {"func": "text", "text": string}
+
+
+def sequence(*children: dict) -> dict:
+    return {"func": "sequence", "children": list(children)}
+
+
+class BuildFlashcardsTest(unittest.TestCase):
+    def setUp(self):
+        self.stage = TypstQueryStage(["DEFINITION", "THEOREM"], dependencies=[])
+        self.stage.add_subsection("PROOF", ["THEOREM"])
+
+    def build(self, values: list) -> list:
+        return self.stage.build_flashcards(values, Path("lecture.typ"))
+
+    def test_sections(self):
+        flashcards = self.build([
+            {"section": "definition", "title": "Group", "body": "A set with an operation"},
+            {"section": "THEOREM", "title": None, "body": sequence(text("Every"), {"func": "space"}, text("group"))},
+            ])
+        self.assertEqual([card.main_section.name for card in flashcards], ["DEFINITION", "THEOREM"])
+        self.assertEqual(str(flashcards[0].main_section.title), "Group")
+        self.assertEqual(str(flashcards[0].main_section.content), "A set with an operation")
+        self.assertEqual(str(flashcards[1].main_section.content), "Every group")
+        self.assertEqual(flashcards[0].main_section.title.source, Path("lecture.typ"))
+
+    def test_proof_attaches_to_parent(self):
+        flashcards = self.build([
+            {"section": "definition", "title": "Group", "body": "definition"},
+            {"section": "proof", "title": None, "body": "not attached"},
+            {"section": "theorem", "title": "Lagrange", "body": "statement"},
+            {"section": "proof", "title": None, "body": "proof"},
+            ])
+        self.assertEqual(len(flashcards), 2)
+        self.assertIsNone(flashcards[0].proof_section)
+        self.assertEqual(str(flashcards[1].proof_section.content), "proof")
+
+    def test_skipped_values(self):
+        with self.assertLogs("mathnote", level="WARNING"):
+            flashcards = self.build([
+                "not a section",
+                {"section": "corollary", "title": None, "body": "not selected"},
+                {"section": "unknown", "title": None, "body": "unknown"},
+                {"title": "no section"},
+                ])
+        self.assertEqual(flashcards, [])
+
+
+class ContentMarkupTest(unittest.TestCase):
+    def test_markup(self):
+        content = sequence(
+                {"func": "heading", "depth": 2, "body": text("Groups")},
+                {"func": "parbreak"},
+                {"func": "strong", "body": text("Note")},
+                {"func": "space"},
+                {"func": "emph", "body": text("this")},
+                {"func": "space"},
+                {"func": "raw", "text": "x + 1", "block": False},
+                )
+        self.assertEqual(content_markup(content), "== Groups\n\n*Note* _this_ `x + 1`")
+
+    def test_equation(self):
+        attach = {"func": "attach", "base": text("x"), "b": text("i"), "t": text("10")}
+        frac = {"func": "frac", "num": text("1"), "denom": sequence(text("n"), text("+"), text("1"))}
+        root = {"func": "root", "radicand": text("2")}
+        equation = {"func": "equation", "block": False, "body": sequence(attach, text("="), frac, text("+"), root)}
+        self.assertEqual(content_markup(equation), "$x_i^(10)=1/(n+1)+sqrt(2)$")
+        self.assertEqual(content_markup({"func": "equation", "block": True, "body": text("x")}), "$ x $")
+
+    def test_unknown_elements(self):
+        self.assertEqual(content_markup({"func": "block", "body": text("inner")}), "inner")
+        self.assertEqual(content_markup({"func": "grid", "children": [text("a"), text("b")]}), "ab")
+        self.assertEqual(content_markup(None), "")
+        self.assertEqual(content_markup(3), "3")
+
+
+@unittest.skipUnless(os.name == "posix", "fake typst executable is a script")
+class ProcessTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.dir = Path(self._tmpdir.name)
+        values = [{"section": "definition", "title": "Group", "body": "queried"}]
+        self.typst = self.dir / "typst"
+        self.typst.write_text(f"#!{sys.executable}\nprint({json.dumps(json.dumps(values))})\n", encoding='utf-8')
+        self.typst.chmod(0o755)
+        self.macros = self.dir / "macros.typ"
+        self.macros.write_text("#let R = $bb(R)$\n", encoding='utf-8')
+        build_stage = FlashcardBuilderStage(["DEFINITION"])
+        clean_stage = CleanStage({FileType.LaTeX: {}, FileType.Typst: {}})
+        self.stage = TypstQueryStage(["DEFINITION"], typst=str(self.typst), fallback=[clean_stage, build_stage],
+                                     dependencies=[self.macros])
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def test_typst_files_are_queried(self):
+        path = self.dir / "lec_01.typ"
+        path.write_text("#definition(title: \"Group\")[source]\n", encoding='utf-8')
+        flashcards = self.stage.process(TrackedText(path.read_text(encoding='utf-8'), source=path))
+        self.assertEqual([str(card.main_section.content) for card in flashcards], ["queried"])
+
+    def test_other_files_use_fallback(self):
+        path = self.dir / "lec_01.tex"
+        flashcards = self.stage.process(TrackedText("\\defin{Group}{parsed}\n", source=path))
+        self.assertEqual([str(card.main_section.content) for card in flashcards], ["parsed"])
+        self.assertIsNotNone(self.stage.fingerprint(FileType.LaTeX))
+        with self.assertRaises(ValueError):
+            TypstQueryStage(["DEFINITION"], dependencies=[]).process(TrackedText("", source=path))
+
+    def test_fingerprint_follows_dependencies(self):
+        fingerprint = self.stage.fingerprint(FileType.Typst)
+        self.assertEqual(self.stage.fingerprint(FileType.Typst), fingerprint)
+        self.macros.write_text("#let R = $RR$\n", encoding='utf-8')
+        os.utime(self.macros, ns=(0, 0))
+        self.assertNotEqual(self.stage.fingerprint(FileType.Typst), fingerprint)
+
+
+if __name__ == "__main__":
+    unittest.main()